@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import pytest
+import kernel_utils
+from network_generator import synthetic_pipeline
+
+# The benchmarks need pytest-benchmark (pip install pytest-benchmark); without it there is nothing to collect
+try:
+    import pytest_benchmark
+except ImportError:
+    collect_ignore_glob = ['test_*.py']
+
+# Network sizes in conduits; HRT_BENCH_SIZES="100 1000 10000 100000" adds the large networks
+SIZES = [int(size) for size in os.environ.get('HRT_BENCH_SIZES', '100 1000 10000').split()]
+LOOP_FRACTION = 0.05
+SEED = 0
+
+@pytest.fixture(scope='module', params=SIZES, ids=str)
+def pipeline(request, tmp_path_factory):
+    # Built like the tests' synthetic_network fixture (tests/conftest.py)
+    inp_file_path = str(tmp_path_factory.mktemp('inp') / 'synthetic.inp')
+    return synthetic_pipeline(request.param, SEED, inp_file_path, n_outfalls=3, loop_fraction=LOOP_FRACTION)
+
+@pytest.fixture(params=kernel_utils.BACKENDS)
+def kernels(request, monkeypatch):
+    # Stages running on kernel_utils are timed with each backend; numba is compiled first
+    if request.param == 'numba':
+        pytest.importorskip('numba')
+    monkeypatch.setitem(kernel_utils._STATE, 'backend', request.param)
+    kernel_utils.section_geometry(np.ones((1, 1)), 'CIRCULAR', 2.0)
+    kernel_utils.path_sums(np.array([0, 1]), np.array([0]), np.ones(1))
+    return request.param
+
+@pytest.fixture(autouse=True)
+def describe(benchmark, request):
+    # Stored with each result, so saved runs say what they timed
+    kernels = request.getfixturevalue('kernels') if 'kernels' in request.fixturenames else kernel_utils.backend()
+    benchmark.extra_info['kernels'] = kernels
+    if 'pipeline' in request.fixturenames:
+        benchmark.extra_info['conduits'] = len(request.getfixturevalue('pipeline')['new_df'])
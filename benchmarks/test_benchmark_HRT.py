@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from network_generator import synthetic_targets
+from calibration_HRT_utils import (calculate_HRT, create_graph, calculate_path_HRT, build_edge_index, path_edge_arrays,
+                                   batch_path_HRT, PathHRTIndex, DrainageIndex, CalibrationPaths, ConduitTable,
+                                   calibrate_HRT, solve_conduit_lengths, replace_inp_section)
+# Loaded lazily by solve_conduit_lengths; imported here so the import is not timed as part of the stage
+import scipy.sparse.linalg
+
+# Scaling benchmarks of the HRT pipeline stages on synthetic networks, no SWMM engine needed.
+# The committed baseline lives in benchmarks/baselines (pytest-benchmark storage, one folder per platform):
+#   python -m pytest benchmarks --benchmark-storage=benchmarks/baselines --benchmark-compare='*/0001'
+#                                                           compare against the recorded baseline
+#   ... --benchmark-compare-fail=min:50%                    fail on stages 50% slower than it
+#   python -m pytest benchmarks --benchmark-storage=benchmarks/baselines --benchmark-save=baseline
+#                                                           record a new baseline (0002_baseline, ...)
+# Results are grouped by stage, one entry per network size (and kernel backend where it applies).
+# Single-path calls and calibration steps are timed on a fixed sample
+PATH_SAMPLE = 200
+CALIBRATION_STEPS = 50
+
+@pytest.fixture(scope='module')
+def path_hrt_df(pipeline):
+    return create_graph(pipeline['new_df'], pipeline['merged_df'], pipeline['node_ids'], pipeline['outfalls'])
+
+@pytest.fixture(scope='module')
+def targets(pipeline):
+    index = PathHRTIndex(pipeline['new_df'], pipeline['merged_df'], pipeline['node_ids'], pipeline['outfalls'])
+    return synthetic_targets(index.to_frame(), pipeline['network'], seed=0)
+
+@pytest.mark.benchmark(group='calculate_HRT')
+def test_calculate_HRT(benchmark, pipeline, kernels):
+    benchmark(calculate_HRT, pipeline['cond_df_merged'], pipeline['link_table'])
+
+@pytest.mark.benchmark(group='create_graph')
+def test_create_graph(benchmark, pipeline):
+    benchmark(create_graph, pipeline['new_df'], pipeline['merged_df'], pipeline['node_ids'], pipeline['outfalls'])
+
+@pytest.mark.benchmark(group='calculate_path_HRT')
+def test_calculate_path_HRT(benchmark, pipeline, path_hrt_df):
+    # Per-path calls as the original calibration loop made them
+    rng = np.random.default_rng(0)
+    sample = path_hrt_df['Path'].iloc[rng.choice(len(path_hrt_df), min(PATH_SAMPLE, len(path_hrt_df)), replace=False)]
+    edge_index = build_edge_index(pipeline['new_df'])
+    benchmark(lambda: [calculate_path_HRT(pipeline['new_df'], path, edge_index) for path in sample])
+
+@pytest.mark.benchmark(group='batch_path_HRT')
+def test_batch_path_HRT(benchmark, pipeline, path_hrt_df, kernels):
+    path_ptr, path_edges = path_edge_arrays(path_hrt_df['Path'], build_edge_index(pipeline['new_df']))
+    conduit_hrt = pipeline['new_df']['Conduit HRT (HRS)'].to_numpy(dtype=float)
+    benchmark(batch_path_HRT, path_ptr, path_edges, conduit_hrt)
+
+@pytest.mark.benchmark(group='PathHRTIndex')
+def test_PathHRTIndex(benchmark, pipeline):
+    benchmark(PathHRTIndex, pipeline['new_df'], pipeline['merged_df'], pipeline['node_ids'], pipeline['outfalls'])
+
+@pytest.mark.benchmark(group='calibrate_HRT')
+def test_calibrate_HRT(benchmark, pipeline, targets):
+    # Row-by-row calibration steps, each followed by the incremental path update, as calibration_loop runs them
+    _, median_HRT_df = targets
+    target_hrt = median_HRT_df.set_index('sc.id')['sc_median_hrt']
+
+    def setup():
+        table = ConduitTable(pipeline['new_df'], pipeline['link_table'])
+        index = PathHRTIndex(pipeline['new_df'], pipeline['merged_df'], pipeline['node_ids'], pipeline['outfalls'])
+        paths = CalibrationPaths(index, DrainageIndex(pipeline['inp_file_path'], index.distance), target_hrt, 0.5)
+        return (table, index, paths), {}
+
+    def calibration_steps(table, index, paths):
+        progress_tracker, sorting_order = {wwtp: 0 for wwtp in paths.frame['WWTP'].unique()}, {}
+        for _ in range(CALIBRATION_STEPS):
+            table, _, progress_tracker = calibrate_HRT(table, paths.frame, median_HRT_df, progress_tracker, sorting_order)
+            index.apply_conduit_summary(table)
+            if paths.update():
+                sorting_order.clear()
+
+    benchmark.pedantic(calibration_steps, setup=setup, rounds=3)
+
+@pytest.mark.benchmark(group='solve_conduit_lengths')
+def test_solve_conduit_lengths(benchmark, pipeline, targets):
+    tot_HRT_df, median_HRT_df = targets
+    benchmark(solve_conduit_lengths, pipeline['new_df'], tot_HRT_df, median_HRT_df)
+
+@pytest.mark.benchmark(group='replace_inp_section')
+def test_replace_inp_section(benchmark, pipeline):
+    benchmark(replace_inp_section, pipeline['inp_file_path'], pipeline['link_table'][['Length']] * 1.1, 'CONDUITS')
@@ -0,0 +1,170 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+from inp_utils import referenced_files
+from profiling_utils import get_logger, count
+
+logger = get_logger('cache')
+
+# Bump when the layout or content of cached summaries changes
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = '.hrt_cache'
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+def hash_file(path, hasher):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(block)
+
+def input_key(inp_file_path, options=None):
+    # Content hash of the model, every rainfall file it references and the run options
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps({'version': CACHE_VERSION, 'options': options or {}}, sort_keys=True).encode())
+    hash_file(inp_file_path, hasher)
+    for path in referenced_files(inp_file_path):
+        hasher.update(os.path.basename(path).encode())
+        if os.path.exists(path):
+            hash_file(path, hasher)
+    return hasher.hexdigest()
+
+def save_frame(path, df):
+    # Columnar .npz: one array per column, text columns as strings plus a null mask
+    arrays = {}
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            arrays[f'c{i}'] = values.to_numpy()
+        else:
+            # Drop columns that do not hold scalars (e.g. swmmio coords lists)
+            if values.map(lambda v: isinstance(v, (list, tuple, dict))).any():
+                continue
+            arrays[f'c{i}'] = values.astype(str).to_numpy(dtype=str)
+            arrays[f'n{i}'] = values.isna().to_numpy()
+    meta = {'columns': [str(c) for c in df.columns]}
+    np.savez_compressed(path, __meta__=np.array(json.dumps(meta)), **arrays)
+
+def load_frame(path, index_names=None):
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data['__meta__']))
+        columns = {}
+        for i, col in enumerate(meta['columns']):
+            if f'c{i}' not in data:
+                continue
+            values = data[f'c{i}']
+            if f'n{i}' in data:
+                values = pd.Series(values, dtype=object).mask(data[f'n{i}'])
+            columns[col] = values
+    df = pd.DataFrame(columns)
+    if index_names:
+        df = df.set_index(index_names)
+    return df
+
+class SummaryCache:
+    # Content-addressed store of simulation summaries. Each entry is a folder named after
+    # its input key; its mtime is touched on every hit so eviction drops the least recently
+    # used entries once the folder grows past max_bytes.
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        entry = self._entry(key)
+        meta_path = os.path.join(entry, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        frames = {name: load_frame(os.path.join(entry, f'{name}.npz'), index)
+                  for name, index in meta['frames'].items()}
+        os.utime(entry)
+        return frames, meta
+
+    def put(self, key, frames, meta=None):
+        # frames maps a name to a DataFrame; named indexes are restored on load
+        meta = dict(meta or {})
+        entry = self._entry(key)
+        tmp = entry + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        meta['frames'] = {}
+        for name, df in frames.items():
+            index = [n for n in df.index.names if n is not None]
+            save_frame(os.path.join(tmp, f'{name}.npz'), df.reset_index(drop=not index))
+            meta['frames'][name] = index
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+
+        self.invalidate(meta.get('inp_file'), keep=key)
+        self.evict(keep=key)
+
+    def invalidate(self, inp_file, keep=None):
+        # Drop older entries for the same model file; they can never be hit again once it changed
+        if inp_file is None:
+            return
+        for key in os.listdir(self.cache_dir):
+            meta_path = os.path.join(self._entry(key), 'meta.json')
+            if key == keep or not os.path.exists(meta_path):
+                continue
+            with open(meta_path) as f:
+                if json.load(f).get('inp_file') == inp_file:
+                    shutil.rmtree(self._entry(key), ignore_errors=True)
+
+    def evict(self, keep=None):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = self._entry(key)
+            if key == keep:
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+def cached_model_summary(inp_file_path, read_from_out_file=False, cache=None):
+    # Link/node statistics, node IDs and the swmmio link table for a model, simulated only
+    # when the .inp, its rainfall files or the run mode changed since the last call
+    cache = cache or SummaryCache()
+    key = input_key(inp_file_path, {'read_from_out_file': read_from_out_file})
+    hit = cache.get(key)
+    if hit is not None:
+        frames, meta = hit
+        count('cache_hits')
+        logger.info("Loaded cached simulation summary", extra={'fields': {'key': key[:12], 'inp': inp_file_path}})
+        return frames
+    count('cache_misses')
+
+    from swmmio import Model
+    # SWMM's report and binary output go to a scratch folder, not next to the model
+    with tempfile.TemporaryDirectory(prefix='swmm_run_') as workdir:
+        base = os.path.join(workdir, os.path.splitext(os.path.basename(inp_file_path))[0])
+        if read_from_out_file:
+            from swmm_out_utils import collect_output_stats
+            links, nodes = collect_output_stats(inp_file_path, base + '.out', rpt_file_path=base + '.rpt')
+        else:
+            from simulation_utils import collect_simulation_stats
+            links, nodes = collect_simulation_stats(inp_file_path, rpt_file_path=base + '.rpt', out_file_path=base + '.out')
+
+    model = Model(inp_file_path)
+    frames = {
+        'links': links,
+        'nodes': nodes,
+        'node_ids': pd.DataFrame({'node_id': model.nodes.dataframe.index.astype(str)}),
+        'link_table': model.links.dataframe.drop(columns=['coords'], errors='ignore'),
+    }
+    cache.put(key, frames, {'inp_file': os.path.abspath(inp_file_path)})
+    return frames
@@ -1,328 +1,358 @@
-
-import pandas as pd
-import networkx as nx
-import numpy as np
+import os
+import sys
 import shutil
-import swmmio
-from pyswmm import Simulation, Links, Nodes, Subcatchments
-from swmmio import Model
-from swmmio.utils.modify_model import replace_inp_section
-from calibration_HRT_utils import calculate_HRT, calibrate_HRT, create_graph, replace_inp_section
-
-# inp_file_path = 'HRT_calibration_files/wpg_cm.inp'
-inp_file_path = 'HRT_calibration_files/wpg_concp.inp'
-
-# Read the CSV file
-# median_sc_df = pd.read_csv("HRT_calibration_files/iw-Subcat-HRT.csv")
-median_sc_df = pd.read_csv("HRT_calibration_files/update_iw-Subcat-HRT.csv")
-
-# Format df
-med_sc_df = median_sc_df.drop(median_sc_df.columns[0:1], axis=1)
-# drop_scs = ['sc_1', 'sc_10', 'sc_8']
-# drop_scs = ['sc_13', 'sc_16', 'sc_20']
-# filtered_med_scs = med_sc_df[~med_sc_df['sc.id'].isin(drop_scs)]
-# print(filtered_med_scs)
-filtered_med_scs = median_sc_df
-
-# Initialize variables to store values and correct target hrts
-sc_5_hrt = None
-sc_8_hrt = None
-sc_13_hrt = None
-sc_2_hrt = None
-sc_21_hrt = None
-
-# Loop to get the HRT values
-for index, row in filtered_med_scs.iterrows():
-    if row['sc.id'] == 'sc_5':
-        sc_5_hrt = row['sc_median_hrt']
-    elif row['sc.id'] == 'sc_8':
-        sc_8_hrt = row['sc_median_hrt']
-    elif row['sc.id'] == 'sc_13':
-        sc_13_hrt = row['sc_median_hrt']
-    elif row['sc.id'] == 'sc_2':
-        sc_2_hrt = row['sc_median_hrt']
-    elif row['sc.id'] == 'sc_21':
-        sc_21_hrt = row['sc_median_hrt']
-
-
-# loop to update the HRT values for sc_4 and sc_0 based on sc_20 and sc_16
-for index, row in filtered_med_scs.iterrows():
-    if row['sc.id'] == 'sc_14' and sc_5_hrt is not None:
-        filtered_med_scs.at[index, 'sc_median_hrt'] = sc_5_hrt + 0.25
-    elif row['sc.id'] == 'sc_4' and sc_8_hrt is not None:
-        filtered_med_scs.at[index, 'sc_median_hrt'] = sc_8_hrt + 0.25
-    elif row['sc.id'] == 'sc_6' and sc_13_hrt is not None:
-        filtered_med_scs.at[index, 'sc_median_hrt'] = sc_13_hrt + 0.25
-    elif row['sc.id'] == 'sc_11' and sc_2_hrt is not None:
-        filtered_med_scs.at[index, 'sc_median_hrt'] = sc_2_hrt + 0.25
-    elif row['sc.id'] == 'sc_3' and sc_21_hrt is not None:
-        filtered_med_scs.at[index, 'sc_median_hrt'] = sc_21_hrt + 0.25
-    elif row['sc.id'] == 'sc_18' and sc_21_hrt is not None:
-        filtered_med_scs.at[index, 'sc_median_hrt'] = sc_21_hrt + 0.25
-
-
-# Initialize empty df
-cond_df = pd.DataFrame(columns = ["cond_name", "mean_flow", "mean_depth"])
-
-# Run simulation and loop through conduits
-with Simulation(inp_file_path) as sim:
-    link_obj = Links(sim)
-    conduit_data = {f"ct_{num}": {'flows': [], 'depths': []} for num in range(0, 22)}
-    
-    for step in sim:
-        for num in range(0, 22):
-            cond_name = f"ct_{num}"
-            curr = link_obj[cond_name]
-            # Append flows and depths to conduit_data
-            conduit_data[cond_name]['flows'].append(curr.flow)
-            conduit_data[cond_name]['depths'].append(curr.depth)
-
-# Calculate mean flow and depth for each conduit
-for cond_name, data in conduit_data.items():
-    # loop through conduit_data and calculate mean depth and flow rate
-    mean_flow = sum(data['flows']) / len(data['flows']) if data['flows'] else 0
-    mean_depth = sum(data['depths']) / len(data['depths']) if data['depths'] else 0
-    
-    # Append the results to the main df
-    cond_df = pd.concat([cond_df, pd.DataFrame({"cond_name": [cond_name], "mean_flow": [mean_flow], "mean_depth": [mean_depth]})], ignore_index=True)
-
-# Extract link properties from .inp file
-m = Model(inp_file_path)
-cond_summary = m.links.dataframe[['InletNode', 'OutletNode', 'Length']]
-cond_summary.rename(columns={'InletNode': 'Inlet_Node', 'OutletNode': 'Outlet_Node', 'Length': 'cond_length'}, inplace=True)
-
-# Merge to main df
-cond_df_merged = pd.merge(cond_df, cond_summary, left_on='cond_name', right_on='Name', how='left')
-
-# Call function from utils
-HRT = calculate_HRT(cond_df_merged)
-
-# Merge HRT results to main df
-merged_df = pd.concat([cond_df_merged, HRT], axis = 1)
-merged_df.set_index(['cond_name', 'Inlet_Node', 'Outlet_Node'], inplace = True)
-print(merged_df)
-
-# Define outfalls and calculate current path hrts
-outfalls = ['node_4', 'node_24', 'node_14']
-new_df = merged_df.reset_index()
-path_hrt_df = create_graph(new_df, merged_df, inp_file_path, outfalls)
-path_hrt_df['Total_HRT'] = pd.to_numeric(path_hrt_df['Total_HRT'], errors='coerce')
-
-# check if 'Subcatchments' column exists
-if 'Subcatchments' not in path_hrt_df.columns:
-    path_hrt_df['Subcatchments'] = ''
-
-# Run simulation to extract sc names
-with Simulation(inp_file_path) as sim:
-    for index, row in path_hrt_df.iterrows():
-        sc_name = f"sc_{index}"
-        curr = Subcatchments(sim)[sc_name]
-        outlet_node = curr.connection
-        matching_rows = path_hrt_df[path_hrt_df['Start_Node'] == outlet_node]
-
-        for matching_index in matching_rows.index:
-            if pd.notna(path_hrt_df.at[matching_index, 'Subcatchments']):
-                path_hrt_df.at[matching_index, 'Subcatchments'] += f"{sc_name}"
-            else:
-                path_hrt_df.at[matching_index, 'Subcatchments'] = sc_name
-
-# Manual assignments because the simulation method didn't work for these?
-manual_assignments = {
-    'node_15': 'sc_14',
-    'node_18': 'sc_15',
-    'node_3': 'sc_16',
-    'node_21': 'sc_17',
-    'node_10': 'sc_18',
-    'node_0': 'sc_19',
-    'node_13': 'sc_20',
-    'node_17': 'sc_21',
-}
-
-# Manual assignment
-for node, sc_name in manual_assignments.items():
-    path_hrt_df.loc[path_hrt_df['Start_Node'] == node, 'Subcatchments'] = sc_name
-
-# Add WWTP column based on nearest outfall
-for index, row in path_hrt_df.iterrows():
-    if row['End_Node'] == 'node_4':
-        path_hrt_df.loc[index, 'WWTP'] = 'North'
-
-    elif row['End_Node'] == 'node_14':
-        path_hrt_df.loc[index, 'WWTP'] = 'South'
-    
+import argparse
+import numpy as np
+import pandas as pd
+from checkpoint_utils import DEFAULT_CHECKPOINT_DIR, CheckpointStore, file_key, stage_key
+from profiling_utils import configure_logging, get_logger, phase, PROFILER
+
+# The stages import the simulation, graph and model libraries (pyswmm, swmmio, networkx) themselves,
+# so resuming past a stage or running only the cheap ones does not pay for them.
+# python calibration_HRT.py --help lists the options; a re-run resumes from the last completed stage.
+
+logger = get_logger('calibration')
+
+DEFAULT_INP = 'HRT_calibration_files/wpg_concp.inp'
+DEFAULT_TARGETS = 'HRT_calibration_files/update_iw-Subcat-HRT.csv'
+
+# Subcatchments whose target HRT is replaced by another subcatchment's target plus TARGET_OFFSET
+TARGET_SOURCES = {'sc_14': 'sc_5', 'sc_4': 'sc_8', 'sc_6': 'sc_13', 'sc_11': 'sc_2', 'sc_3': 'sc_21', 'sc_18': 'sc_21'}
+TARGET_OFFSET = 0.25
+
+def load_targets(args, data, run):
+    filtered_med_scs = pd.read_csv(args.targets)
+    source_hrt = filtered_med_scs.drop_duplicates('sc.id', keep='last').set_index('sc.id')['sc_median_hrt']
+    corrected = filtered_med_scs['sc.id'].map(TARGET_SOURCES).map(source_hrt)
+    filtered_med_scs.loc[corrected.notna(), 'sc_median_hrt'] = corrected[corrected.notna()] + TARGET_OFFSET
+    return {'filtered_med_scs': filtered_med_scs}
+
+def simulate(args, data, run):
+    # Either let SWMM run at native speed and read the binary .out file, or step the
+    # simulation in Python and collect time-weighted flow and depth statistics for every link.
+    # Results are cached on disk and only re-simulated when the .inp or rainfall files change.
+    if args.rainfall is None:
+        from cache_utils import cached_model_summary
+        model_summary = cached_model_summary(args.inp, args.read_from_out_file)
+        return {'cond_df': model_summary['links'], 'node_ids': model_summary['node_ids']['node_id'].tolist(),
+                'link_table': model_summary['link_table']}
+
+    # Only the wet-weather events of the rainfall record: each event is simulated on its own window
+    # with antecedent spin-up and the per-event statistics are merged back, duration weighted
+    from swmmio import Model
+    from rainfall_utils import event_conduit_summary
+    cond_df, rainfall_events_df = event_conduit_summary(args.inp, args.rainfall, min_dry_hours=args.min_dry_hours,
+                                                        spin_up_hours=24, tail_hours=12, max_workers=args.workers)
+    logger.debug("Rainfall events:\n%s", rainfall_events_df)
+    model = Model(args.inp)
+    return {'cond_df': cond_df, 'node_ids': model.nodes.dataframe.index.astype(str).tolist(),
+            'link_table': model.links.dataframe.drop(columns=['coords'], errors='ignore'),
+            'rainfall_events_df': rainfall_events_df}
+
+def conduit_HRTs(args, data, run):
+    from calibration_HRT_utils import calculate_HRT
+    link_table = data['link_table']
+
+    # Extract link properties from .inp file
+    cond_summary = link_table[['InletNode', 'OutletNode', 'Length']].rename(
+        columns={'InletNode': 'Inlet_Node', 'OutletNode': 'Outlet_Node', 'Length': 'cond_length'})
+    cond_df_merged = pd.merge(data['cond_df'], cond_summary, left_on='cond_name', right_on='Name', how='left')
+
+    # Each conduit's cross-section from the model
+    HRT = calculate_HRT(cond_df_merged, link_table)
+    invalid_conduits = cond_df_merged.loc[~HRT['Valid_HRT'], 'cond_name'].tolist()
+    if invalid_conduits:
+        logger.warning("Conduits with invalid HRT", extra={'fields': {'conduits': invalid_conduits}})
+
+    merged_df = pd.concat([cond_df_merged, HRT], axis=1)
+    merged_df.set_index(['cond_name', 'Inlet_Node', 'Outlet_Node'], inplace=True)
+    logger.debug("Conduit summary:\n%s", merged_df)
+    if run['result_store'] is not None:
+        run['result_store'].write('conduit_summary', merged_df)
+    return {'merged_df': merged_df}
+
+def path_HRTs(args, data, run):
+    from calibration_HRT_utils import PathHRTIndex, DrainageIndex, flow_split_HRT, model_outfalls
+    merged_df = data['merged_df']
+    new_df = merged_df.reset_index()
+
+    # Every outfall of the model's [OUTFALLS] section unless --outfalls picks some
+    outfalls = args.outfalls or model_outfalls(args.inp)
+    unknown = sorted(set(args.wwtp) - set(outfalls))
+    if unknown:
+        logger.warning("WWTP names given for nodes that are not outfalls", extra={'fields': {'nodes': unknown}})
+
+    # Path index keeps the shortest-path trees so calibration steps only update affected paths
+    path_index = PathHRTIndex(new_df, merged_df, data['node_ids'], outfalls)
+    path_hrt_df = path_index.to_frame()
+    path_hrt_df['Total_HRT'] = pd.to_numeric(path_hrt_df['Total_HRT'], errors='coerce')
+
+    # Subcatchment -> outlet node -> outfall -> WWTP from the model's [SUBCATCHMENTS] and the --wwtp
+    # names, no simulation needed; labels every path with the subcatchments draining to its start node
+    drainage_index = DrainageIndex(args.inp, path_index.distance, args.wwtp)
+    path_hrt_df = drainage_index.join(path_hrt_df)
+    path_hrt_df['Total_HRT'] = pd.to_numeric(path_hrt_df['Total_HRT'], errors='coerce')
+
+    # Alternative to the shortest paths: expected HRT and its variance from every node to every
+    # outfall with each node's outflow split over its conduits by mean flow
+    flow_split_df = drainage_index.join(flow_split_HRT(new_df, outfalls))
+    logger.debug("Flow-split expected HRTs:\n%s", flow_split_df)
+    logger.debug("Path HRTs:\n%s", path_hrt_df)
+    if run['result_store'] is not None:
+        run['result_store'].write('path_hrt', path_hrt_df, stage='initial')
+        run['result_store'].write('flow_split', flow_split_df)
+    return {'path_index': path_index, 'drainage_index': drainage_index, 'path_hrt_df': path_hrt_df}
+
+def calibrate(args, data, run):
+    # Solve all subcatchment targets at once, or run the row-by-row calibration loop
+    from calibration_HRT_utils import solve_conduit_lengths
+    result_store = run['result_store']
+    filtered_med_scs = data['filtered_med_scs']
+    new_df = data['merged_df'].reset_index()
+    path_hrt_df = data['path_hrt_df']
+
+    if args.solver == 'batch':
+        updated_df, path_hrt_df, residuals = solve_conduit_lengths(new_df, path_hrt_df, filtered_med_scs)
+        updated_df.set_index(['cond_name', 'Inlet_Node', 'Outlet_Node'], inplace=True)
+        if result_store is not None:
+            # Iterations of an earlier loop calibration in this run would otherwise stay behind
+            result_store.clear('calibration_history')
+            result_store.write('calibration_history', updated_df, iteration=0)
+            result_store.write('calibration_residuals', residuals)
+        logger.info("Calibration residuals", extra={'fields': {
+            'paths': len(residuals), 'max_abs': float(residuals['Residual'].abs().max()) if len(residuals) else 0.0}})
+        logger.debug("Calibration residuals per subcatchment:\n%s", residuals)
     else:
-        path_hrt_df.loc[index, 'WWTP'] = 'West'
-
-print(path_hrt_df)
-subcatchments_data = path_hrt_df[['Start_Node', 'Subcatchments']].copy()
-north_df = path_hrt_df[path_hrt_df['WWTP'] == 'North'].sort_values(by='Total_HRT', ascending=True)
-south_df = path_hrt_df[path_hrt_df['WWTP'] == 'South'].sort_values(by='Total_HRT', ascending=True)
-west_df = path_hrt_df[path_hrt_df['WWTP'] == 'West'].sort_values(by='Total_HRT', ascending=True)
-
-# Ensure values are numeric and format df before calibration
-path_hrt_df['Total_HRT'] = pd.to_numeric(path_hrt_df['Total_HRT'], errors='coerce')
-new_df = merged_df.reset_index()
-
-
-# # Initialize progress_tracker 
-progress_tracker = None
-
-# tolerance = 0.5
-# iteration_counter = 0
-
-# Initialize progress tracker before the loop
-# progress_tracker = {wwtp: 0 for wwtp in path_hrt_df['WWTP'].unique()}
-
-# Sort the DataFrames by WWTP and Total_HRT (done once before the loop)
-# south_df = path_hrt_df[path_hrt_df['WWTP'] == 'South'].sort_values(by='Total_HRT', ascending=True)
-# west_df = path_hrt_df[path_hrt_df['WWTP'] == 'West'].sort_values(by='Total_HRT', ascending=True)
-# north_df = path_hrt_df[path_hrt_df['WWTP'] == 'North'].sort_values(by='Total_HRT', ascending=True)
-
-# for iteration_counter in range(3):
-#     print(f"Iteration {iteration_counter}:")
-#     print("Path HRT before calibration:")
-#     print(path_hrt_df[['Total_HRT', 'Subcatchments', 'WWTP']])
-
-#     Process each WWTP one at a time
-#     for wwtp, wwtp_df in [('South', south_df), ('West', west_df), ('North', north_df)]:
-#         updated_df, updated_tot_hrt, progress_tracker = calibrate_HRT(new_df, wwtp_df, filtered_med_scs, progress_tracker)
-
-#         Update the DataFrame after calibration
-#         updated_df.set_index(['cond_name', 'Inlet_Node', 'Outlet_Node'], inplace=True)
-#         df = updated_df.reset_index()
-
-#         print(f"Updated conduit summary after calibration for {wwtp}:")
-#         print(updated_df)
-
-#         Calculate all path HRTs again using the updated data
-#         print("Calculating all path HRTs again")
-#         updated_tot_hrt = create_graph(df, updated_df, inp_file_path, outfalls)
-        
-#         print("Updated Total HRT df after create graph")
-#         print(updated_tot_hrt)
-
-#         Merge subcatchments_data to updated_tot_hrt
-#         updated_tot_hrt = pd.merge(updated_tot_hrt, subcatchments_data, on='Start_Node', how='left')
-#         print("Updated total HRT df:")
-#         print(updated_tot_hrt)
-
-#         Update the WWTPs in the DataFrame based on End_Node
-#         for index, row in updated_tot_hrt.iterrows():
-#             if row['End_Node'] == 'node_3':
-#                 updated_tot_hrt.loc[index, 'WWTP'] = 'North'
-#             elif row['End_Node'] == 'node_12':
-#                 updated_tot_hrt.loc[index, 'WWTP'] = 'South'
-#             else:
-#                 updated_tot_hrt.loc[index, 'WWTP'] = 'West'
-
-#         print(f"Updated Total HRT df for {wwtp}:")
-#         print(updated_tot_hrt[['Subcatchments', 'Total_HRT']])
-
-#         Update the main DataFrame with the updated results for this WWTP
-#         path_hrt_df.update(updated_tot_hrt)
-#         print("what this looks like")
-#         print(path_hrt_df)
-
-#         Check if calibration is done for this WWTP by comparing to tolerance
-#         if all(abs(updated_tot_hrt['Total_HRT'].values - filtered_med_scs['sc_median_hrt'].values[:len(updated_tot_hrt)]) <= tolerance):
-#             print(f"{wwtp} Calibration done for this WWTP.")
-#             progress_tracker[wwtp] = len(wwtp_df)  # Mark this WWTP as fully calibrated
-
-#     Break the loop if all WWTPs are calibrated
-#     if all(progress_tracker[wwtp] == len(path_hrt_df[path_hrt_df['WWTP'] == wwtp]) for wwtp in progress_tracker):
-#         print("All WWTPs have been calibrated.")
-#         break
-
-#     Update variables for the next iteration
-#     new_df = updated_df.reset_index()
-#     print("Calibrating again.")
-
-
-tolerance = 0.5
-# Initialize progress tracker before the loop
-progress_tracker = {wwtp: 0 for wwtp in path_hrt_df['WWTP'].unique()}
-
-for iteration_counter in range(22):
-    print(f"Iteration {iteration_counter}:")
-    print("Path HRT before calibration:")
-    print(path_hrt_df[['Total_HRT', 'Subcatchments', 'WWTP']])
-
-    # Calibrate HRT for the current WWTP (one row at a time)
-    updated_df, updated_tot_hrt, progress_tracker = calibrate_HRT(new_df, path_hrt_df, filtered_med_scs, progress_tracker)
-    
-    # Update the DataFrame after calibration
-    updated_df.set_index(['cond_name', 'Inlet_Node', 'Outlet_Node'], inplace=True)
-    df = updated_df.reset_index()
-
-    print("Updated conduit summary after calibration:")
-    print(updated_df)
-
-    # Calculate all path HRTs again using the updated data
-    print("Calculating all path HRTs again")
-    updated_tot_hrt = create_graph(df, updated_df, inp_file_path, outfalls)
-    
-    print("Updated Total HRT df after create graph")
-    print(updated_tot_hrt)
-
-    # Merge subcatchments_data to updated_tot_hrt
-    updated_tot_hrt = pd.merge(updated_tot_hrt, subcatchments_data, on='Start_Node', how='left')
-    print("Updated total HRT df:")
-    print(updated_tot_hrt)
-
-    # Update the WWTPs in the DataFrame based on End_Node
-    for index, row in updated_tot_hrt.iterrows():
-        if row['End_Node'] == 'node_4':
-            updated_tot_hrt.loc[index, 'WWTP'] = 'North'
-        elif row['End_Node'] == 'node_14':
-            updated_tot_hrt.loc[index, 'WWTP'] = 'South'
-        else:
-            updated_tot_hrt.loc[index, 'WWTP'] = 'West'
-
-    print("Updated Total HRT df")
-    print(updated_tot_hrt[['Subcatchments', 'Total_HRT']])
-
-    # Check if calibration is done by comparing to tolerance
-    if all(abs(updated_tot_hrt['Total_HRT'].values - filtered_med_scs['sc_median_hrt'].values[:len(updated_tot_hrt)]) <= tolerance):
-        print("Calibration done.")
-        break
-
-    # Update variables for the next iteration
-    path_hrt_df = updated_tot_hrt
-    new_df = updated_df.reset_index()
-    print("Calibrating again.")
-
-
-# Paths
-copied_inp_file_path = 'copy_wpg_cm.inp'
-
-# Step 1: Create a copy of the original .inp file
-shutil.copy(inp_file_path, copied_inp_file_path)
-
-# Load the copied .inp file
-model = swmmio.Model(copied_inp_file_path)
-
-# Extract the conduit section
-conduits_df = model.inp.conduits
-
-# Ensure updated_df is correctly aligned and rename column to match
-updated_df = updated_df.rename(columns={'cond_length': 'Length'})  # Rename column
-updated_df = updated_df.reset_index()  # Reset index to ensure correct alignment
-updated_df.set_index('cond_name', inplace=True)  # Set index as 'cond_name'
-
-# Check conduits_df structure
-print("Conduits DataFrame columns:", conduits_df.columns)
-print("Updated DataFrame head:", updated_df.head())
+        updated_df, path_hrt_df = calibration_loop(args, data, run, new_df)
+    if result_store is not None:
+        result_store.write('path_hrt', path_hrt_df, stage='calibrated')
+    return {'calibrated_df': updated_df, 'calibrated_path_hrt_df': path_hrt_df}
+
+def calibration_loop(args, data, run, new_df):
+    from calibration_HRT_utils import calibrate_HRT, ConduitTable, CalibrationPaths
+    result_store = run['result_store']
+    filtered_med_scs = data['filtered_med_scs']
+    path_index = data['path_index']
+    # One target per subcatchment, as solve_conduit_lengths uses them
+    targets = filtered_med_scs.drop_duplicates('sc.id').set_index('sc.id')['sc_median_hrt']
+    conduit_table = ConduitTable(new_df, data['link_table'])
+
+    # Progress after the last finished iteration of an interrupted run; the loop carries on from
+    # there. Only the conduit lengths and HRTs are saved, the paths are rebuilt from them.
+    state = run['checkpoints'].load_progress('calibration', run['key'])
+    if state is None:
+        state = {'iteration': 0, 'converged': False,
+                 'progress_tracker': {wwtp: 0 for wwtp in data['path_hrt_df']['WWTP'].unique()},
+                 'sorting_order': {}}
+        if result_store is not None:
+            # Starting over: drop what an earlier calibration in this run wrote. A resumed loop keeps
+            # its iterations and rewrites the one it was interrupted in.
+            result_store.clear('calibration_history')
+            result_store.clear('calibration_residuals')
+    else:
+        logger.info("Resuming calibration", extra={'fields': {'iteration': state['iteration']}})
+        conduit_table.load(state['conduits'])
+        path_index.apply_conduit_summary(conduit_table)
+    paths = CalibrationPaths(path_index, data['drainage_index'], targets, args.tolerance)
+
+    for iteration_counter in range(state['iteration'], args.max_iterations):
+        if state['converged']:
+            break
+        logger.info("Calibration iteration", extra={'fields': {'iteration': iteration_counter}})
+
+        # Calibrate HRT for the current WWTP (one row at a time)
+        with phase('calibration_step', iteration=iteration_counter):
+            conduit_table, _, progress_tracker = calibrate_HRT(
+                conduit_table, paths.frame, filtered_med_scs, state['progress_tracker'], state['sorting_order'])
+
+        # The history keeps the conduits each iteration changed
+        if result_store is not None and conduit_table.changed:
+            result_store.write('calibration_history', conduit_table.to_frame(sorted(conduit_table.changed)),
+                               iteration=iteration_counter)
+
+        # Update only the paths through the changed conduits, and their rows
+        with phase('path_HRT', iteration=iteration_counter):
+            path_index.apply_conduit_summary(conduit_table)
+            if paths.update():
+                # The path rows were rebuilt, so the saved row orders no longer apply
+                state['sorting_order'].clear()
+
+        # Calibration is done once every path of a subcatchment with a target is within tolerance
+        # of that subcatchment's target
+        state.update(iteration=iteration_counter + 1, converged=paths.converged, progress_tracker=progress_tracker,
+                     conduits={col: conduit_table[col] for col in ('cond_length', 'Conduit HRT (HRS)')})
+        with phase('checkpoint', iteration=iteration_counter):
+            run['checkpoints'].save_progress('calibration', run['key'], state)
+        if paths.converged:
+            logger.info("Calibration done", extra={'fields': {'iterations': iteration_counter + 1}})
+
+    return conduit_table.to_frame().set_index(['cond_name', 'Inlet_Node', 'Outlet_Node']), paths.frame
+
+def uncertainty_bands(args, data, run):
+    # Percentile bands of the calibrated path HRTs under uncertain flows, depths, lengths and sizes
+    from uncertainty_utils import hrt_percentile_bands
+    hrt_bands = hrt_percentile_bands(data['calibrated_df'], data['calibrated_path_hrt_df'], data['link_table'],
+                                     n_samples=args.uncertainty_samples, max_workers=args.workers)
+    logger.debug("Path HRT percentile bands:\n%s", hrt_bands)
+    if run['result_store'] is not None:
+        run['result_store'].write('hrt_bands', hrt_bands)
+    return {'hrt_bands': hrt_bands}
+
+def write_calibrated_inp(args, data, run):
+    from calibration_HRT_utils import replace_inp_section
+
+    # Copy the original .inp and rewrite only the changed conduit lengths of the copy
+    shutil.copy(args.inp, args.output)
+    updated_df = data['calibrated_df'].rename(columns={'cond_length': 'Length'}).reset_index().set_index('cond_name')
+    updated_inp_file_path = replace_inp_section(args.output, updated_df[['Length']], 'CONDUITS')
+    logger.debug("Calibrated conduits:\n%s", updated_df)
+    logger.info("Wrote calibrated model", extra={'fields': {'inp': updated_inp_file_path}})
+    return {'updated_df': updated_df, 'updated_inp_file_path': updated_inp_file_path}
+
+def resimulate(args, data, run):
+    # Conduit HRTs of the calibrated model under its own flows and depths, re-simulated from a
+    # cached dry-weather hotstart over the window only, and how far they moved
+    from calibration_HRT_utils import calculate_HRT
+    from hotstart_utils import warm_simulation_stats
+    updated_df = data['updated_df']
+    warm_links, warm_nodes = warm_simulation_stats(data['updated_inp_file_path'], *args.resimulate_window,
+                                                   read_from_out_file=args.read_from_out_file)
+    warm_df = pd.merge(warm_links, updated_df[['Length']].rename(columns={'Length': 'cond_length'}),
+                       left_on='cond_name', right_index=True, how='left')
+    warm_HRT = calculate_HRT(warm_df, data['link_table'])
+    HRT_drift = (warm_HRT['Conduit HRT (HRS)'].to_numpy() -
+                 updated_df['Conduit HRT (HRS)'].reindex(warm_df['cond_name']).to_numpy())
+    logger.info("Re-simulated calibrated model", extra={'fields': {
+        'window': list(args.resimulate_window), 'max_abs_HRT_change': float(np.nanmax(np.abs(HRT_drift)))}})
+    return {'warm_links': warm_links, 'HRT_drift': HRT_drift}
+
+def simulation_settings(args):
+    from cache_utils import input_key
+    settings = {'inp': input_key(args.inp), 'rainfall': file_key(args.rainfall), 'read_from_out_file': args.read_from_out_file}
+    if args.rainfall is not None:
+        settings['min_dry_hours'] = args.min_dry_hours
+    return settings
+
+# name: (function, stages whose outputs it reads, settings its key depends on; None skips the stage)
+STAGES = {
+    'targets': (load_targets, (), lambda args: {'targets': file_key(args.targets), 'sources': TARGET_SOURCES,
+                                                'offset': TARGET_OFFSET}),
+    'simulation': (simulate, (), simulation_settings),
+    'conduit_HRT': (conduit_HRTs, ('simulation',), lambda args: {}),
+    'paths': (path_HRTs, ('simulation', 'conduit_HRT'), lambda args: {'outfalls': args.outfalls, 'wwtps': args.wwtp}),
+    'calibration': (calibrate, ('targets', 'simulation', 'conduit_HRT', 'paths'),
+                    lambda args: {'solver': args.solver, 'max_iterations': args.max_iterations,
+                                  'tolerance': args.tolerance}),
+    'uncertainty': (uncertainty_bands, ('simulation', 'calibration'),
+                    lambda args: {'samples': args.uncertainty_samples} if args.uncertainty_samples else None),
+    'write_inp': (write_calibrated_inp, ('calibration',), lambda args: {'output': args.output}),
+    'resimulate': (resimulate, ('simulation', 'write_inp'),
+                   lambda args: {'window': args.resimulate_window, 'read_from_out_file': args.read_from_out_file}
+                   if args.resimulate_window else None),
+}
 
-# Loop through updated_df and update the conduit lengths
-for cond_name, row in updated_df.iterrows():
-    if cond_name in conduits_df.index:
-        if 'Length' in row:
-            conduits_df.at[cond_name, 'Length'] = row['Length']
+def run_stages(args):
+    # Runs the stages in order. A stage whose checkpoint matches its current key is skipped and
+    # its outputs are only unpickled if a later stage that runs needs them; --rerun forces a
+    # stage and everything downstream of it.
+    checkpoints = CheckpointStore(args.checkpoint_dir)
+    if args.restart:
+        checkpoints.clear()
+    result_store = None
+    if args.result_store:
+        from result_store import ResultStore
+        result_store = ResultStore(args.result_store, checkpoints.run_id)
+
+    keys, outputs, forced = {}, {}, set(args.rerun or [])
+
+    def stage_outputs(name):
+        if name not in outputs:
+            outputs[name] = checkpoints.load(name)
+        return outputs[name]
+
+    for name, (function, upstream, settings) in STAGES.items():
+        params = settings(args)
+        if params is None:
+            logger.info("Stage disabled", extra={'fields': {'stage': name}})
         else:
-            print(f"Column 'Length' not found in row: {row}")
-
-# Replace the Conduits section in the copied .inp file
-replace_inp_section(copied_inp_file_path, conduits_df, 'CONDUITS')
-print(conduits_df)
-print(updated_df)
-   
+            keys[name] = stage_key(params, [keys[stage] for stage in upstream])
+            if any(stage in forced for stage in upstream):
+                forced.add(name)
+            if name not in forced and checkpoints.done(name, keys[name]):
+                logger.info("Stage already done", extra={'fields': {'stage': name}})
+            else:
+                data = {}
+                for stage in upstream:
+                    data.update(stage_outputs(stage))
+                run = {'checkpoints': checkpoints, 'key': keys[name], 'result_store': result_store}
+                with phase('stage', stage=name):
+                    outputs[name] = function(args, data, run)
+                checkpoints.save(name, keys[name], outputs[name])
+                logger.info("Stage done", extra={'fields': {'stage': name}})
+        if name == args.stop_after:
+            break
+    return outputs
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Calibrate the conduit lengths of a SWMM model to target subcatchment HRTs.")
+    parser.add_argument('--inp', default=DEFAULT_INP, help="SWMM model to calibrate")
+    parser.add_argument('--targets', default=DEFAULT_TARGETS, help="CSV of target HRTs (sc.id, sc_median_hrt)")
+    parser.add_argument('--rainfall', help="Rainfall file (e.g. HRT_calibration_files/precip.dat); "
+                                           "simulate its wet-weather events only instead of one continuous run")
+    parser.add_argument('--min-dry-hours', type=float, default=6,
+                        help="Inter-event dry time (hours) separating rainfall events with --rainfall")
+    parser.add_argument('--outfalls', nargs='+', metavar='NODE',
+                        help="Outfalls the paths run to (default: every node in the model's [OUTFALLS])")
+    parser.add_argument('--wwtp', nargs='+', default=[], metavar='OUTFALL=NAME',
+                        help="WWTP each outfall represents (e.g. node_4=North node_14=South node_24=West); "
+                             "outfalls without one are labelled with their own name")
+    parser.add_argument('--read-from-out-file', action='store_true',
+                        help="Run SWMM at native speed and read the .out file instead of stepping it in Python")
+    parser.add_argument('--solver', choices=['batch', 'loop'], default='batch',
+                        help="Solve all targets at once, or the row-by-row calibration loop")
+    parser.add_argument('--max-iterations', type=int, default=22)
+    parser.add_argument('--tolerance', type=float, default=0.5, help="Loop solver tolerance (hours)")
+    parser.add_argument('--uncertainty-samples', type=int, default=0,
+                        help="Monte Carlo samples for path HRT percentile bands; 0 skips them")
+    parser.add_argument('--workers', type=int, help="Processes for event simulations and uncertainty sampling")
+    parser.add_argument('--kernels', choices=['auto', 'numpy', 'numba'],
+                        help="Geometry and path-sum kernels; auto uses numba when installed (default: HRT_KERNELS or numpy)")
+    parser.add_argument('--resimulate-window', nargs=2, metavar=('START', 'END'),
+                        help="Re-simulate the calibrated model from a dry-weather hotstart over this window "
+                             "(e.g. '1998-01-05 00:00' '1998-01-06 00:00')")
+    parser.add_argument('--output', default='copy_wpg_cm.inp', help="Copy of the model the calibrated lengths are written to")
+    parser.add_argument('--result-store', help="Folder of the Parquet result store; results stay in memory without it")
+    parser.add_argument('--checkpoint-dir', help=f"Stage checkpoints (default {DEFAULT_CHECKPOINT_DIR}/<model name>)")
+    parser.add_argument('--restart', action='store_true', help="Discard the checkpoints and start over")
+    parser.add_argument('--rerun', nargs='+', choices=list(STAGES), help="Run these stages and everything after them again")
+    parser.add_argument('--stop-after', choices=list(STAGES), help="Stop once this stage is done")
+    parser.add_argument('--log-level', default='INFO', help="DEBUG also dumps the intermediate tables")
+    parser.add_argument('--json-logs', action='store_true', help="Machine-readable log lines")
+    parser.add_argument('--profile-json', help="Export phase timings and counters as JSON")
+    parser.add_argument('--profile-trace', help="Export a Chrome trace (chrome://tracing or Perfetto)")
+    args = parser.parse_args(argv)
+    if any('=' not in pair for pair in args.wwtp):
+        parser.error("--wwtp expects OUTFALL=NAME pairs")
+    args.wwtp = dict(pair.split('=', 1) for pair in args.wwtp)
+    if args.checkpoint_dir is None:
+        args.checkpoint_dir = os.path.join(DEFAULT_CHECKPOINT_DIR, os.path.splitext(os.path.basename(args.inp))[0])
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(args.log_level, json_lines=args.json_logs)
+    if args.kernels:
+        from kernel_utils import set_backend
+        set_backend(args.kernels)
+    run_stages(args)
+
+    # Where the run spent its time
+    PROFILER.log_summary()
+    if args.profile_json:
+        PROFILER.export_json(args.profile_json)
+    if args.profile_trace:
+        PROFILER.export_chrome_trace(args.profile_trace)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,281 +1,1010 @@
 import numpy as np
 import pandas as pd
 import networkx as nx
-import swmmio
-from pyswmm import Simulation, Nodes
 from swmmio import Model
+from kernel_utils import section_geometry, path_sums, length_for_HRT
+from inp_utils import SECTION_FIELDS, frame_to_patch, patch_inp, read_section
+from profiling_utils import get_logger, phase, count
+
+logger = get_logger('calibration')
+
+# Legacy geometry used before cross-sections were read from the model
+DEFAULT_SHAPE = 'CIRCULAR'
+DEFAULT_DIAMETER = 3.0
+
+def conduit_geometry(depth, shape, geom1, geom2=0.0, geom3=0.0, geom4=0.0, barrels=1):
+    # Vectorized flow geometry for every conduit at once. depth is (conduits,) or any
+    # (..., conduits) array such as periods x conduits; the geometry is per conduit.
+    # Depths at or above the full depth (surcharged pipes) use the full-pipe area.
+    # Returns theta (NaN for non-circular shapes), wetted flow area and a validity mask.
+    # The arithmetic runs in the selected kernel backend (kernel_utils)
+    return section_geometry(depth, shape, geom1, geom2, geom3, geom4, barrels)
+
+def conduit_HRT(flow_area, cond_length, mean_flow, valid=None):
+    # HRT in hours from wetted area, length and mean flow, with zero, reverse and
+    # missing flows masked out instead of producing inf/negative values
+    flow_area = np.asarray(flow_area, dtype=float)
+    cond_length = np.asarray(cond_length, dtype=float)
+    mean_flow = np.asarray(mean_flow, dtype=float)
+    if valid is None:
+        valid = np.isfinite(flow_area)
+
+    valid = valid & np.isfinite(cond_length) & (cond_length >= 0) & np.isfinite(mean_flow) & (mean_flow > 0)
+    flow_volume = flow_area * cond_length
+    HRT = np.full(flow_area.shape, np.nan)
+    HRT[valid] = (flow_volume[valid] / mean_flow[valid]) / 3600
+
+    return flow_volume, HRT, valid
+
+def align_xsections(conduit_summary, xsections):
+    # Look up each conduit's [XSECTIONS] row by conduit name ('cond_name' column or index)
+    if 'cond_name' in conduit_summary.columns:
+        names = conduit_summary['cond_name']
+    else:
+        names = conduit_summary.index.get_level_values(0)
+    xs = xsections.reindex(pd.Index(names))
+
+    def col(name, default):
+        if name in xs.columns:
+            return pd.to_numeric(xs[name], errors='coerce').fillna(default).to_numpy(dtype=float)
+        return np.full(len(xs), default)
+
+    return {
+        'shape': xs['Shape'].to_numpy(dtype=object),
+        'geom1': pd.to_numeric(xs['Geom1'], errors='coerce').to_numpy(dtype=float),
+        'geom2': col('Geom2', 0.0),
+        'geom3': col('Geom3', 0.0),
+        'geom4': col('Geom4', 0.0),
+        'barrels': col('Barrels', 1.0),
+    }
+
+def calculate_HRT(conduit_summary, xsections=None):
+    # xsections is the swmmio model.inp.xsections table; without it every conduit
+    # falls back to the legacy 3 m circular pipe
+    if xsections is None:
+        geometry = {'shape': DEFAULT_SHAPE, 'geom1': DEFAULT_DIAMETER}
+    else:
+        geometry = align_xsections(conduit_summary, xsections)
 
-# from pyswmm import Simulation, Nodes
+    theta, flow_area, valid = conduit_geometry(conduit_summary['mean_depth'].to_numpy(dtype=float), **geometry)
+    flow_volume, HRT_values, valid = conduit_HRT(
+        flow_area, conduit_summary['cond_length'].to_numpy(dtype=float),
+        conduit_summary['mean_flow'].to_numpy(dtype=float), valid
+    )
 
-def calculate_HRT(conduit_summary):
-    radius = 1.5
+    HRT = pd.DataFrame({'Conduit HRT (HRS)': HRT_values, 'Valid_HRT': valid}, index=conduit_summary.index)
+    # theta = pd.DataFrame(theta, columns= ['Theta Values'])
+    # flow_area = pd.DataFrame(flow_area, columns=['Flow Area'])
+    # flow_vol = pd.DataFrame(flow_volume, columns=['flow volume'])
 
-    theta_df = pd.Series(index = conduit_summary.index, dtype = float)
-    flow_area_df = pd.Series(index = conduit_summary.index, dtype = float)
-    flow_volume_df = pd.Series(index = conduit_summary.index, dtype = float)
-    HRT_df = pd.Series(index = conduit_summary.index, dtype = float)
-    
-    for index, row in conduit_summary.iterrows():
-        try:
-            theta_df.loc[index] = 2*np.arccos(((radius - (conduit_summary['mean_depth'][index]))) / radius)
-            
-            flow_area_df.loc[index] = (radius**2 * (theta_df.loc[index] - np.sin(theta_df.loc[index]))) / 2
-    
-            flow_volume_df.loc[index] = flow_area_df.loc[index] * (conduit_summary['cond_length'][index])
+    return HRT
 
-            HRT_df.loc[index] = (flow_volume_df.loc[index] / conduit_summary['mean_flow'][index]) / 3600
+def model_node_ids(inp_file_path):
+    # Node IDs from the parsed model; accepts an .inp path, an already loaded swmmio Model
+    # or a list of node IDs (e.g. from a cached summary)
+    if isinstance(inp_file_path, (list, tuple, pd.Index)):
+        return list(inp_file_path)
+    model = inp_file_path if isinstance(inp_file_path, Model) else Model(inp_file_path)
+    return model.nodes.dataframe.index.tolist()
+
+def outfall_path_trees(G, outfalls, weight='weight'):
+    # One reverse Dijkstra per outfall gives the shortest path from every node at once.
+    # next_hop[outfall][node] is the downstream neighbour of node on its path to that outfall,
+    # distance is the path length and nearest_outfall the closest reachable outfall per node.
+    R = G.reverse(copy=False)
+    next_hop = {}
+    distance = {}
+
+    for outfall in outfalls:
+        if outfall not in R:
+            next_hop[outfall], distance[outfall] = {}, {}
+            continue
+        pred, dist = nx.dijkstra_predecessor_and_distance(R, outfall, weight=weight)
+        count('dijkstra_runs')
+        next_hop[outfall] = {node: hops[0] for node, hops in pred.items() if hops}
+        distance[outfall] = dist
+
+    distance_df = pd.DataFrame(distance, index=list(G.nodes), columns=list(outfalls), dtype=float)
+    reachable = distance_df.notna().any(axis=1)
+    nearest_outfall = pd.Series(None, index=distance_df.index, dtype=object)
+    nearest_outfall[reachable] = distance_df[reachable].idxmin(axis=1)
+
+    return next_hop, distance_df, nearest_outfall
+
+def tree_path(next_hop, node, outfall):
+    # Walk the predecessor tree from node down to outfall
+    path = [node]
+    while path[-1] != outfall:
+        path.append(next_hop[path[-1]])
+    return path
+
+def build_graph(conduit_summary, inp_file_path):
+    G = nx.DiGraph()
 
-        except Exception as e:
-            print(f"An error occured at index {index}: {e}")
+    # Node IDs come from the parsed model, no simulation needed
+    G.add_nodes_from(model_node_ids(inp_file_path))
 
-        continue
-    HRT = pd.DataFrame(HRT_df, columns= ['Conduit HRT (HRS)'])
-    # theta = pd.DataFrame(theta_df, columns= ['Theta Values'])
-    # flow_area = pd.DataFrame(flow_area_df, columns=['Flow Area'])
-    # flow_vol = pd.DataFrame(flow_volume_df, columns=['flow volume'])
-    # print(theta)
-    # print(flow_area)
-    # print(flow_vol)
+    # Add conduits to the graph with lengths as weights
+    G.add_weighted_edges_from(zip(conduit_summary['Inlet_Node'], conduit_summary['Outlet_Node'],
+                                  conduit_summary['cond_length'].astype(float)))
+    return G
 
-    return HRT
+def tree_paths(G, next_hop, outfalls):
+    # Every (node, outfall) path in node-then-outfall order
+    results = []
+    for node in G.nodes:
+        for outfall in outfalls:
+            if node != outfall and node in next_hop[outfall]:
+                results.append({
+                    'Start_Node': node,
+                    'End_Node': outfall,
+                    'Path': tree_path(next_hop[outfall], node, outfall),
+                })
+    return results
 
 def create_graph(conduit_summary, new_df, inp_file_path, outfalls):
 
-    G = nx.DiGraph()
-    results = []
+    with phase('graph_build'):
+        G = build_graph(conduit_summary, inp_file_path)
+        next_hop, distance_df, nearest_outfall = outfall_path_trees(G, outfalls)
+        results = tree_paths(G, next_hop, outfalls)
 
-    with Simulation(inp_file_path) as sim:
-        nodes = Nodes(sim)
-        for node in nodes:
-                G.add_node(node.nodeid)
+    results_df = pd.DataFrame(results, columns=['Start_Node', 'End_Node', 'Path'])
 
-        # Add conduits to the graph with lengths as weights
-    for index, row in conduit_summary.iterrows():
-        G.add_edge(row['Inlet_Node'], row['Outlet_Node'], weight=row['cond_length'])
+    # Sum conduit HRTs over every path's actual edges in one gather
+    with phase('path_HRT', paths=len(results_df)):
+        edge_index = build_edge_index(new_df)
+        path_ptr, path_edges = path_edge_arrays(results_df['Path'], edge_index)
+        results_df['Total_HRT'] = batch_path_HRT(path_ptr, path_edges, new_df['Conduit HRT (HRS)'].to_numpy(dtype=float))
 
-    for node in G.nodes:
-        for outfall in outfalls:
-            if node != outfall:
-                try:
-                    # maybe should be in main
-                    shortest_path = nx.dijkstra_path(G, node, outfall, weight='weight')
-                    path_hrt = calculate_path_HRT(new_df, shortest_path)
-                    results.append({
-                        'Start_Node': node,
-                        'End_Node': outfall,
-                        'Path': shortest_path,
-                        'Total_HRT': path_hrt,
-                    })
-                except nx.NetworkXNoPath:
-                    continue
-    
-    results_df = pd.DataFrame(results)
     return results_df
 
-def calculate_path_HRT(conduit_summary, shortest_path):
-
-    conduit_dict = conduit_summary['Conduit HRT (HRS)']. to_dict()
-    total_hrt = 0
-    keys = [key for key in conduit_dict if (key[1] in shortest_path and key[2] in shortest_path)]
-        
-    for key in keys:
-        hrt_value = conduit_dict[key]
-        total_hrt += hrt_value
+def build_edge_index(conduit_summary):
+    # (inlet, outlet) -> row position of the conduit; works on the flat or the
+    # (cond_name, Inlet_Node, Outlet_Node) indexed summary. Parallel conduits resolve
+    # to the last one, matching the single DiGraph edge they collapse to.
+    if 'Inlet_Node' in conduit_summary.columns:
+        inlets, outlets = conduit_summary['Inlet_Node'], conduit_summary['Outlet_Node']
+    else:
+        inlets = conduit_summary.index.get_level_values('Inlet_Node')
+        outlets = conduit_summary.index.get_level_values('Outlet_Node')
+    return {edge: pos for pos, edge in enumerate(zip(inlets, outlets))}
+
+def path_edge_arrays(paths, edge_index):
+    # CSR layout of all paths: conduit rows of path i are path_edges[path_ptr[i]:path_ptr[i + 1]].
+    # Edges missing from the index are stored as -1.
+    edge_counts = np.fromiter((max(len(path) - 1, 0) for path in paths), dtype=np.int64)
+    path_ptr = np.zeros(len(edge_counts) + 1, dtype=np.int64)
+    np.cumsum(edge_counts, out=path_ptr[1:])
+    path_edges = np.fromiter(
+        (edge_index.get(edge, -1) for path in paths for edge in zip(path[:-1], path[1:])),
+        dtype=np.int64, count=path_ptr[-1]
+    )
+    return path_ptr, path_edges
+
+def batch_path_HRT(path_ptr, path_edges, conduit_hrt):
+    # Total HRT of every path at once; a missing edge or invalid conduit HRT gives NaN
+    return path_sums(path_ptr, path_edges, conduit_hrt)
+
+def csr_slices(ptr, ids):
+    # Positions ptr[i]:ptr[i + 1] of every id in ids, concatenated, and the id position each belongs to
+    starts = ptr[ids]
+    counts = ptr[ids + 1] - starts
+    owner = np.repeat(np.arange(len(ids)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets, owner
+
+class ChangeSet:
+    # Ids marked since the last pop, each kept once; the mask over all ids bounds it at size
+    def __init__(self, size):
+        self.marked = np.zeros(size, dtype=bool)
+        self.ids = []
+
+    def mark(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        new = np.unique(ids[~self.marked[ids]])
+        if len(new):
+            self.marked[new] = True
+            self.ids.append(new)
+
+    def pop(self):
+        ids = np.concatenate(self.ids) if self.ids else np.zeros(0, dtype=np.int64)
+        self.marked[ids] = False
+        self.ids = []
+        return ids
+
+def calculate_path_HRT(conduit_summary, shortest_path, edge_index=None):
+
+    if edge_index is None:
+        edge_index = build_edge_index(conduit_summary)
+    path_ptr, path_edges = path_edge_arrays([shortest_path], edge_index)
+    total_hrt = batch_path_HRT(path_ptr, path_edges, conduit_summary['Conduit HRT (HRS)'].to_numpy(dtype=float))[0]
 
     return total_hrt
 
-def calibrate_HRT(conduit_summary, Total_HRT_df, median_HRT_df, progress_tracker=None):
+class PathHRTIndex:
+    # Incremental version of create_graph for calibration. Keeps the graph, the shortest-path
+    # trees and a conduit -> paths index so that changing one conduit only re-sums the paths
+    # that traverse it, and Dijkstra is re-run only for outfalls whose tree the change can reroute.
+
+    def __init__(self, conduit_summary, new_df, inp_file_path, outfalls):
+        self.G = build_graph(conduit_summary, inp_file_path)
+        self.outfalls = list(outfalls)
+        self.cond_names = conduit_summary['cond_name'].tolist()
+        self.row_of = {name: pos for pos, name in enumerate(self.cond_names)}
+        self.inlets = conduit_summary['Inlet_Node'].tolist()
+        self.outlets = conduit_summary['Outlet_Node'].tolist()
+        self.length = conduit_summary['cond_length'].to_numpy(dtype=float).copy()
+        # Conduit HRTs plus a trailing NaN that missing path edges (-1) pick up; self.hrt views
+        # the conduits, so updates land in place and _resum gathers without copying
+        self.padded_hrt = np.append(new_df['Conduit HRT (HRS)'].to_numpy(dtype=float), np.nan)
+        self.hrt = self.padded_hrt[:-1]
+        self.edge_index = build_edge_index(conduit_summary)
+        # Conduits handed to apply_conduit_summary since the last pop_changes
+        self.changed_conduits = ChangeSet(len(self.cond_names))
+
+        self.next_hop = {}
+        self.distance = {}
+        with phase('graph_build', outfalls=len(self.outfalls)):
+            for outfall in self.outfalls:
+                self._route(outfall)
+        # Bumped whenever the path rows are rebuilt (initially and after a reroute)
+        self.layout_version = 0
+        with phase('path_HRT'):
+            self._index_paths()
+
+    def _route(self, outfall):
+        next_hop, distance_df, nearest_outfall = outfall_path_trees(self.G, [outfall])
+        self.next_hop[outfall] = next_hop[outfall]
+        self.distance[outfall] = distance_df[outfall].dropna().to_dict()
+
+    def _index_paths(self):
+        # Path rows, their CSR edge layout and the inverse conduit -> paths CSR
+        self.paths = tree_paths(self.G, self.next_hop, self.outfalls)
+        self.path_ptr, self.path_edges = path_edge_arrays([row['Path'] for row in self.paths], self.edge_index)
+        self.total_hrt = batch_path_HRT(self.path_ptr, self.path_edges, self.hrt)
+
+        owner = np.repeat(np.arange(len(self.paths)), np.diff(self.path_ptr))
+        order = np.argsort(self.path_edges, kind='stable')
+        self.conduit_paths = owner[order]
+        # path_edges may hold -1 for missing edges; shift by one so those land in an unused bucket
+        counts = np.bincount(self.path_edges + 1, minlength=len(self.cond_names) + 1)
+        self.conduit_ptr = np.concatenate(([counts[0]], counts[0] + np.cumsum(counts[1:])))
+        # Paths re-summed since the last pop_changes
+        self.resummed_paths = ChangeSet(len(self.paths))
+        self.layout_version += 1
+
+    def paths_through(self, cond_name):
+        row = self.row_of[cond_name]
+        return self.conduit_paths[self.conduit_ptr[row]:self.conduit_ptr[row + 1]]
+
+    def _subtree(self, outfall, node):
+        # Nodes whose path to outfall runs through node (node included)
+        hops = self.next_hop[outfall]
+        subtree = {node}
+        stack = [node]
+        while stack:
+            x = stack.pop()
+            for y in self.G.predecessors(x):
+                if y not in subtree and hops.get(y) == x:
+                    subtree.add(y)
+                    stack.append(y)
+        return subtree
+
+    def _can_reroute(self, row, new_length):
+        # Outfalls whose shortest-path tree can change when this conduit's length changes.
+        # Off-tree edges only matter if they become shorter than the inlet's current route.
+        # On-tree edges shift the distance of the subtree routed through them by delta, so a
+        # reroute needs an edge leaving (lengthened) or entering (shortened) that subtree
+        # that now beats the tree route. Also returns the subtrees whose distances just shift.
+        inlet, outlet = self.inlets[row], self.outlets[row]
+        delta = new_length - self.length[row]
+        rerouted = []
+        shifted = {}
+        for outfall in self.outfalls:
+            dist, hops = self.distance[outfall], self.next_hop[outfall]
+            if hops.get(inlet) != outlet:
+                if outlet in dist and new_length + dist[outlet] < dist.get(inlet, np.inf):
+                    rerouted.append(outfall)
+                continue
+            if delta == 0:
+                continue
+
+            subtree = self._subtree(outfall, inlet)
+            if delta > 0:
+                exits = ((x, y, w) for x in subtree for _, y, w in self.G.out_edges(x, data='weight')
+                         if y not in subtree and y != hops.get(x) and y in dist)
+                if any(w + dist[y] < dist[x] + delta for x, y, w in exits):
+                    rerouted.append(outfall)
+                    continue
+            else:
+                entries = ((x, y, w) for x in subtree for y, _, w in self.G.in_edges(x, data='weight')
+                           if y not in subtree and y in dist)
+                if any(w + dist[x] + delta < dist[y] for x, y, w in entries):
+                    rerouted.append(outfall)
+                    continue
+            shifted[outfall] = subtree
+        return rerouted, shifted
+
+    def update_conduit_HRT(self, cond_name, new_hrt):
+        row = self.row_of[cond_name]
+        self.hrt[row] = new_hrt
+        self._resum(self.paths_through(cond_name))
+
+    def update_conduit_length(self, cond_name, new_length, new_hrt=None):
+        # Without an explicit HRT the conduit HRT scales linearly with length (fixed depth and flow)
+        row = self.row_of[cond_name]
+        if new_hrt is None:
+            new_hrt = self.hrt[row] * new_length / self.length[row] if self.length[row] > 0 else np.nan
+
+        # Parallel conduits collapse to one graph edge; only that conduit's length moves the weight
+        rerouted, shifted = [], {}
+        if self.edge_index.get((self.inlets[row], self.outlets[row])) == row:
+            rerouted, shifted = self._can_reroute(row, new_length)
+            self.G[self.inlets[row]][self.outlets[row]]['weight'] = new_length
+            delta = new_length - self.length[row]
+            for outfall, subtree in shifted.items():
+                dist = self.distance[outfall]
+                for node in subtree:
+                    dist[node] += delta
+        self.length[row] = new_length
+        self.hrt[row] = new_hrt
+
+        if rerouted:
+            for outfall in rerouted:
+                self._route(outfall)
+            self._index_paths()
+            count('reroutes')
+        else:
+            self._resum(self.paths_through(cond_name))
+
+    def apply_conduit_summary(self, conduit_summary):
+        # Pick up whatever conduits a calibration step changed (DataFrame or ConduitTable) and
+        # update only those
+        if isinstance(conduit_summary, ConduitTable):
+            # The table tracks which rows it changed, so only those are compared
+            changed = conduit_summary.pop_changes()
+            rows = np.array([self.row_of[conduit_summary.names[pos]] for pos in changed], dtype=np.int64)
+            lengths = conduit_summary['cond_length'][changed]
+            hrts = conduit_summary['Conduit HRT (HRS)'][changed]
+        else:
+            frame = conduit_summary.reset_index() if 'cond_name' not in conduit_summary.columns else conduit_summary
+            rows = frame['cond_name'].map(self.row_of).to_numpy()
+            lengths = frame['cond_length'].to_numpy(dtype=float)
+            hrts = frame['Conduit HRT (HRS)'].to_numpy(dtype=float)
+
+        length_changed = (lengths != self.length[rows]) & ~(np.isnan(lengths) & np.isnan(self.length[rows]))
+        hrt_changed = (hrts != self.hrt[rows]) & ~(np.isnan(hrts) & np.isnan(self.hrt[rows]))
+        # Every conduit the table set counts, even if its values came out the same
+        self.changed_conduits.mark(rows if isinstance(conduit_summary, ConduitTable) else rows[length_changed | hrt_changed])
+        for pos in np.flatnonzero(length_changed):
+            self.update_conduit_length(self.cond_names[rows[pos]], lengths[pos], hrts[pos])
+        for pos in np.flatnonzero(hrt_changed & ~length_changed):
+            self.update_conduit_HRT(self.cond_names[rows[pos]], hrts[pos])
+
+    def _resum(self, path_ids):
+        if len(path_ids) == 0:
+            return
+        positions, owner = csr_slices(self.path_ptr, path_ids)
+        edges = self.path_edges[positions]
+        self.total_hrt[path_ids] = np.bincount(owner, weights=self.padded_hrt[edges], minlength=len(path_ids))
+        self.resummed_paths.mark(path_ids)
+        count('paths_updated', len(path_ids))
+
+    def pop_changes(self):
+        # Paths re-summed and conduits applied since the last call; a reroute starts both afresh
+        return self.resummed_paths.pop(), self.changed_conduits.pop()
+
+    def to_frame(self):
+        results_df = pd.DataFrame(self.paths, columns=['Start_Node', 'End_Node', 'Path'])
+        results_df['Total_HRT'] = self.total_hrt
+        return results_df
+
+def model_outfalls(inp_file_path):
+    # Outfall node IDs from the model's [OUTFALLS] section, in file order
+    return [row[0] for row in read_section(inp_file_path, 'OUTFALLS')]
+
+class DrainageIndex:
+    # Subcatchment -> outlet node -> reachable outfalls -> WWTP, read from the model's
+    # [SUBCATCHMENTS] section and the outfall distances instead of a simulation. Several
+    # subcatchments may drain to one node and a node may reach several outfalls; lookups are
+    # dict accesses and join() labels every path row with its subcatchments and WWTP in one merge.
+
+    def __init__(self, inp_file_path, distance, wwtp_outfalls=None):
+        # distance is {outfall: {node: path length}} (PathHRTIndex.distance) or a node x outfall
+        # DataFrame (outfall_path_trees); outfalls without a WWTP name keep their own name
+        outlets = {row[0]: row[2] for row in read_section(inp_file_path, 'SUBCATCHMENTS')}
+        # A subcatchment may drain onto another subcatchment; follow it to the receiving node
+        self.outlet_of = {}
+        for sc, outlet in outlets.items():
+            seen = {sc}
+            while outlet in outlets and outlet not in seen:
+                seen.add(outlet)
+                outlet = outlets[outlet]
+            self.outlet_of[sc] = outlet
+        self.subcatchments_at = {}
+        for sc, node in self.outlet_of.items():
+            self.subcatchments_at.setdefault(node, []).append(sc)
+
+        if isinstance(distance, dict):
+            distance = pd.DataFrame(distance, dtype=float)
+        self.outfalls = list(distance.columns)
+        self.wwtp_of = {outfall: outfall for outfall in self.outfalls}
+        self.wwtp_of.update(wwtp_outfalls or {})
+
+        # Long (node, outfall, distance) table of every reachable pair, nearest outfall first; stack()
+        # keeps the NaN distances of unreachable pairs since pandas 3, so they are dropped here
+        reach = (distance.rename_axis(index='Start_Node', columns='End_Node').stack().dropna()
+                 .rename('Distance').reset_index())
+        reach = reach.sort_values(['Start_Node', 'Distance'], kind='stable')
+        self.reachable_outfalls = reach.groupby('Start_Node', sort=False)['End_Node'].agg(list).to_dict()
+        self.nearest_outfall = {node: outfalls[0] for node, outfalls in self.reachable_outfalls.items()}
+
+        subs = pd.DataFrame({'Subcatchments': list(self.outlet_of), 'Start_Node': list(self.outlet_of.values())})
+        frame = subs.merge(reach, on='Start_Node', how='inner')
+        frame['WWTP'] = frame['End_Node'].map(self.wwtp_of)
+        self.frame = frame
+
+        unreached = sorted(set(subs['Subcatchments']) - set(frame['Subcatchments']))
+        if unreached:
+            logger.warning("Subcatchments whose outlet reaches no outfall", extra={'fields': {'subcatchments': unreached}})
+
+    def outfall_of(self, sc_name):
+        return self.nearest_outfall.get(self.outlet_of[sc_name])
+
+    def wwtp_of_subcatchment(self, sc_name):
+        return self.wwtp_of.get(self.outfall_of(sc_name))
+
+    def nearest_paths(self, path_df):
+        # The rows of path_df running to the outfall their start node drains to, the nearest one
+        return path_df[path_df['End_Node'] == path_df['Start_Node'].map(self.nearest_outfall)]
+
+    def join(self, path_df):
+        # Subcatchments and WWTP for every (Start_Node, End_Node) path row; a node receiving
+        # several subcatchments gives one row per subcatchment, paths without one get NaN
+        joined = path_df.drop(columns=['Subcatchments', 'WWTP'], errors='ignore').merge(
+            self.frame[['Start_Node', 'End_Node', 'Subcatchments']], on=['Start_Node', 'End_Node'], how='left')
+        joined['WWTP'] = joined['End_Node'].map(self.wwtp_of)
+        return joined
+
+class CalibrationPaths:
+    # The path rows the calibration loop works on, labelled with subcatchments and WWTPs
+    # (DrainageIndex.join), kept in step with a PathHRTIndex. After a step only the rows the step
+    # can have touched are looked at: those of the paths the index re-summed, and those starting
+    # at the inlet of a changed conduit, whose Total_HRT calibrate_HRT sets. Of these, the rows
+    # that differ from the totals last written are rewritten and the rows further than tolerance
+    # from their subcatchment's target are counted as they change. Neither the frame nor the
+    # convergence check is rebuilt per iteration, only after a reroute re-indexed the paths.
+
+    def __init__(self, path_index, drainage_index, targets, tolerance):
+        self.path_index = path_index
+        self.drainage_index = drainage_index
+        self.targets = targets
+        self.tolerance = tolerance
+        self.rebuild()
+
+    def rebuild(self):
+        frame = self.drainage_index.join(self.path_index.to_frame().rename_axis('Path_ID').reset_index())
+        self.path_of_row = frame.pop('Path_ID').to_numpy(dtype=np.int64)
+        frame['Total_HRT'] = pd.to_numeric(frame['Total_HRT'], errors='coerce')
+        # Rows of each path and of each start node, as CSR
+        self.rows_by_path = np.argsort(self.path_of_row, kind='stable')
+        self.path_row_ptr = np.concatenate(([0], np.cumsum(np.bincount(self.path_of_row, minlength=len(self.path_index.paths)))))
+        node_codes, start_nodes = pd.factorize(frame['Start_Node'])
+        self.node_code = dict(zip(start_nodes, range(len(start_nodes))))
+        named = np.flatnonzero(node_codes >= 0)
+        self.rows_by_node = named[np.argsort(node_codes[named], kind='stable')]
+        self.node_row_ptr = np.concatenate(([0], np.cumsum(np.bincount(node_codes[named], minlength=len(start_nodes)))))
+        self.path_index.pop_changes()
+        self.frame = frame
+        self.layout_version = self.path_index.layout_version
+        self.total_column = frame.columns.get_loc('Total_HRT')
+        self.target = frame['Subcatchments'].map(self.targets).to_numpy(dtype=float)
+        # Totals as last written, to spot rows that changed on either side since
+        self.written = frame['Total_HRT'].to_numpy(dtype=float).copy()
+        self.off_target = self._off_target(slice(None), self.written)
+        self.n_off_target = int(self.off_target.sum())
+
+    def _off_target(self, rows, total):
+        target = self.target[rows]
+        return ~np.isnan(target) & ~(np.abs(total - target) <= self.tolerance)
+
+    def update(self):
+        # Bring the rows in line with the path index; True when a reroute rebuilt them
+        if self.layout_version != self.path_index.layout_version:
+            self.rebuild()
+            return True
+        path_ids, conduits = self.path_index.pop_changes()
+        inlets = self.path_index.inlets
+        nodes = np.array([self.node_code[inlets[row]] for row in conduits if inlets[row] in self.node_code], dtype=np.int64)
+        rows = np.unique(np.concatenate((self.rows_by_path[csr_slices(self.path_row_ptr, path_ids)[0]],
+                                         self.rows_by_node[csr_slices(self.node_row_ptr, nodes)[0]])))
+
+        total = self.path_index.total_hrt[self.path_of_row[rows]]
+        current = self.frame.iloc[rows, self.total_column].to_numpy(dtype=float)
+        written = self.written[rows]
+        differs = lambda a, b: (a != b) & ~(np.isnan(a) & np.isnan(b))
+        stale = differs(total, written) | differs(current, written)
+        rows, total = rows[stale], total[stale]
+        if len(rows):
+            self.frame.iloc[rows, self.total_column] = total
+            self.written[rows] = total
+            off_target = self._off_target(rows, total)
+            self.n_off_target += int(off_target.sum()) - int(self.off_target[rows].sum())
+            self.off_target[rows] = off_target
+        count('path_rows_updated', len(rows))
+        return False
+
+    @property
+    def converged(self):
+        return self.n_off_target == 0
+
+def flow_split_HRT(conduit_summary, outfalls):
+    # Expected HRT and its variance from every node to every outfall when each node's outflow
+    # splits over its outgoing conduits in proportion to their mean flows, instead of following
+    # the single shortest path. Treating the network as an absorbing Markov chain, for each node u
+    #   P(u)  = sum_e p_e P(v)                               reach probability of the outfall
+    #   M1(u) = sum_e p_e (h_e P(v) + M1(v))                 E[HRT; reached]
+    #   M2(u) = sum_e p_e (h_e^2 P(v) + 2 h_e M1(v) + M2(v)) E[HRT^2; reached]
+    # over the conduits e = (u, v) with split fraction p_e and HRT h_e. Strongly connected
+    # components (looped sections) are condensed; the condensed DAG is swept once from the
+    # outfalls up, one topological level at a time, and each loop is solved as a small system.
+    from scipy import sparse
+    from scipy.sparse.csgraph import connected_components
+
+    frame = conduit_summary.reset_index() if 'Inlet_Node' not in conduit_summary.columns else conduit_summary
+    outfalls = list(outfalls)
+    nodes = pd.Index(pd.unique(np.concatenate([frame['Inlet_Node'].to_numpy(dtype=object),
+                                               frame['Outlet_Node'].to_numpy(dtype=object),
+                                               np.asarray(outfalls, dtype=object)])))
+    n, k = len(nodes), len(outfalls)
+    src = nodes.get_indexer(frame['Inlet_Node'])
+    dst = nodes.get_indexer(frame['Outlet_Node'])
+    flow = np.clip(np.nan_to_num(frame['mean_flow'].to_numpy(dtype=float)), 0, None)
+    hrt = frame['Conduit HRT (HRS)'].to_numpy(dtype=float)
+
+    # Outfalls absorb; everything else splits by flow fraction, zero-flow conduits carry nothing
+    outfall_pos = nodes.get_indexer(outfalls)
+    keep = (flow > 0) & ~np.isin(src, outfall_pos)
+    src, dst, hrt = src[keep], dst[keep], hrt[keep]
+    outflow = np.bincount(src, weights=flow[keep], minlength=n)
+    split = flow[keep] / outflow[src]
+
+    P = np.zeros((n, k))
+    M1 = np.zeros((n, k))
+    M2 = np.zeros((n, k))
+    P[outfall_pos, np.arange(k)] = 1.0
+
+    graph = sparse.csr_matrix((np.ones(len(src)), (src, dst)), shape=(n, n))
+    n_comp, comp = connected_components(graph, directed=True, connection='strong')
+    comp_size = np.bincount(comp, minlength=n_comp)
+    internal = comp[src] == comp[dst]
+    looped = comp_size > 1
+    looped[comp[src[internal]]] = True  # self-loops
+
+    # Level sweep on the condensed DAG: a component is ready once all its downstream ones are
+    ext_src, ext_dst = comp[src[~internal]], comp[dst[~internal]]
+    pending = np.bincount(ext_src, minlength=n_comp)
+    by_dst = np.argsort(ext_dst, kind='stable')
+    dst_ptr = np.searchsorted(ext_dst[by_dst], np.arange(n_comp + 1))
+    node_order = np.argsort(comp, kind='stable')
+    node_ptr = np.searchsorted(comp[node_order], np.arange(n_comp + 1))
+    edge_order = np.argsort(src, kind='stable')
+    edge_ptr = np.searchsorted(src[edge_order], np.arange(n + 1))
+
+    def gather(ptr, order, keys):
+        starts, stops = ptr[keys], ptr[keys + 1]
+        counts = stops - starts
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return order[np.repeat(starts, counts) + offsets]
+
+    def external_terms(edges):
+        # Contributions of conduits leaving the current level towards already solved nodes
+        u, v, p, h = src[edges], dst[edges], split[edges][:, None], hrt[edges][:, None]
+        reach = P[v] > 0
+        with np.errstate(invalid='ignore'):
+            p1 = np.where(reach, p * P[v], 0.0)
+            m1 = np.where(reach, p * (h * P[v] + M1[v]), 0.0)
+            m2 = np.where(reach, p * (h**2 * P[v] + 2 * h * M1[v] + M2[v]), 0.0)
+        return u, p1, m1, m2
+
+    frontier = np.flatnonzero(pending == 0)
+    levels = 0
+    while len(frontier):
+        levels += 1
+        members = gather(node_ptr, node_order, frontier)
+        edges = gather(edge_ptr, edge_order, members)
+        external = edges[comp[src[edges]] != comp[dst[edges]]]
+        u, p1, m1, m2 = external_terms(external)
+        not_outfall = ~np.isin(u, outfall_pos)
+        np.add.at(P, u[not_outfall], p1[not_outfall])
+        np.add.at(M1, u[not_outfall], m1[not_outfall])
+        np.add.at(M2, u[not_outfall], m2[not_outfall])
+
+        # Looped components: (I - Q) x = b with Q the split fractions inside the loop
+        for c in frontier[looped[frontier]]:
+            comp_nodes = node_order[node_ptr[c]:node_ptr[c + 1]]
+            comp_edges = gather(edge_ptr, edge_order, comp_nodes)
+            comp_edges = comp_edges[comp[dst[comp_edges]] == c]
+            local = {node: i for i, node in enumerate(comp_nodes)}
+            li = np.array([local[x] for x in src[comp_edges]], dtype=np.int64)
+            lj = np.array([local[x] for x in dst[comp_edges]], dtype=np.int64)
+            size = len(comp_nodes)
+            Q, Qh, Qh2 = np.zeros((size, size)), np.zeros((size, size)), np.zeros((size, size))
+            np.add.at(Q, (li, lj), split[comp_edges])
+            np.add.at(Qh, (li, lj), split[comp_edges] * hrt[comp_edges])
+            np.add.at(Qh2, (li, lj), split[comp_edges] * hrt[comp_edges]**2)
+            A = np.eye(size) - Q
+            try:
+                P_c = np.linalg.solve(A, P[comp_nodes])
+                M1_c = np.linalg.solve(A, M1[comp_nodes] + Qh @ P_c)
+                M2_c = np.linalg.solve(A, M2[comp_nodes] + Qh2 @ P_c + 2 * Qh @ M1_c)
+            except np.linalg.LinAlgError:
+                # A loop with no way out holds its water forever
+                P_c = M1_c = M2_c = np.full((size, k), np.nan)
+            P[comp_nodes], M1[comp_nodes], M2[comp_nodes] = P_c, M1_c, M2_c
+
+        # Components whose downstream neighbours are now all solved form the next level
+        incoming = gather(dst_ptr, by_dst, frontier)
+        upstream = ext_src[incoming]
+        np.subtract.at(pending, upstream, 1)
+        frontier = np.unique(upstream[pending[upstream] == 0])
+
+    count('flow_split_levels', levels)
+    unresolved = int((pending > 0).sum())
+    if unresolved:
+        logger.warning("Components not reached by the sweep", extra={'fields': {'components': unresolved}})
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = M1 / P
+        variance = np.clip(M2 / P - mean**2, 0, None)
+    start, end = np.nonzero(P > 0)
+    not_self = nodes[start] != np.asarray(outfalls, dtype=object)[end]
+    start, end = start[not_self], end[not_self]
+    return pd.DataFrame({
+        'Start_Node': nodes[start],
+        'End_Node': np.asarray(outfalls, dtype=object)[end],
+        'Flow_Fraction': P[start, end],
+        'Expected_HRT': mean[start, end],
+        'HRT_Variance': variance[start, end],
+    })
+
+def bounded_ridge_lsq(M, r, lower, upper, regularization, gtol=1e-7, max_pivots=200):
+    # min ||M d - r||^2 + regularization ||d||^2 subject to lower <= d <= upper by block principal
+    # pivoting (Kim & Park): each step solves the free variables with damped LSMR, clamps those
+    # that leave their bounds and frees clamped ones whose gradient points inside. A step that
+    # does not reduce the number of infeasible variables only swaps the last one after three
+    # tries, which rules out cycling. Gradients below gtol x max|M^T r| count as zero, so
+    # near-degenerate variables do not flip back and forth on LSMR round-off; as single swaps
+    # never revisit a set of bounds in exact arithmetic, a revisit is round-off too and ends the
+    # search with the best bounded point seen, within solver precision of the optimum.
+    from scipy.sparse.linalg import lsmr
+
+    M = M.tocsc()
+    n = M.shape[1]
+    damp = np.sqrt(regularization)
+    # -1 at the lower bound, 1 at the upper bound, 0 free
+    state = np.zeros(n, dtype=np.int8)
+    d = np.zeros(n)
+    gtol = gtol * max(np.abs(M.T @ r).max(initial=0.0), np.finfo(float).tiny)
+    best, backup, lsmr_iterations = n + 1, 3, 0
+    visited = set()
+    objective = lambda x: np.sum((M @ x - r)**2) + regularization * np.sum(x**2)
+    best_d, best_objective = np.clip(d, lower, upper), np.inf
+
+    for pivot in range(1, max_pivots + 1):
+        if backup == 0:
+            if state.tobytes() in visited:
+                break
+            visited.add(state.tobytes())
+        free = state == 0
+        d[state < 0] = lower[state < 0]
+        d[state > 0] = upper[state > 0]
+        if free.any():
+            solution = lsmr(M[:, free], r - M[:, ~free] @ d[~free], damp=damp, atol=1e-10, btol=1e-10)
+            d[free] = solution[0]
+            lsmr_iterations += solution[2]
+        bounded = np.clip(d, lower, upper)
+        if objective(bounded) < best_objective:
+            best_d, best_objective = bounded, objective(bounded)
+        gradient = M.T @ (M @ d - r) + regularization * d
+        infeasible = ((free & ((d < lower) | (d > upper))) |
+                      ((state < 0) & (gradient < -gtol)) | ((state > 0) & (gradient > gtol)))
+        n_infeasible = int(infeasible.sum())
+        if n_infeasible == 0:
+            break
+        if n_infeasible < best:
+            best, backup = n_infeasible, 3
+            visited.clear()
+        elif backup > 0:
+            backup -= 1
+        else:
+            last = np.flatnonzero(infeasible)[-1]
+            infeasible[:] = False
+            infeasible[last] = True
+        flip = infeasible & free
+        state[flip] = np.where(d[flip] < lower[flip], -1, 1)
+        state[infeasible & ~free] = 0
+    else:
+        logger.warning("Bounded least squares stopped before all bounds were settled",
+                       extra={'fields': {'pivots': max_pivots, 'infeasible': n_infeasible}})
+    count('solver_pivots', pivot)
+    count('lsmr_iterations', lsmr_iterations)
+    return best_d, pivot, lsmr_iterations
+
+def solve_conduit_lengths(conduit_summary, Total_HRT_df, median_HRT_df, min_length=1.0, max_length=np.inf,
+                          regularization=1e-6):
+    # Calibrate every subcatchment at once. At fixed depth and flow a conduit's HRT is k * length,
+    # so each path HRT is linear in the lengths of its conduits and matching all target medians
+    # is one bounded least-squares problem over the conduits the paths share. A small ridge
+    # term keeps lengths that the targets do not pin down close to their current values.
+    # The unknowns are the conduit HRT changes rather than the lengths: the matrix is then the
+    # 0/1 path incidence instead of having columns scaled by k over orders of magnitude, and the
+    # ridge on the HRT changes is the same as on the lengths weighted by k.
+    from scipy import sparse
+
+    updated_conduit_summary = conduit_summary.reset_index() if 'cond_name' not in conduit_summary.columns \
+        else conduit_summary.copy()
+    updated_tot_HRT_df = Total_HRT_df.copy()
+
+    targets = median_HRT_df.drop_duplicates('sc.id').set_index('sc.id')['sc_median_hrt']
+    rows = updated_tot_HRT_df[updated_tot_HRT_df['Subcatchments'].isin(targets.index)]
+    if rows.empty:
+        logger.warning("No paths with target HRTs to calibrate")
+        residuals = pd.DataFrame(columns=['Subcatchments', 'Start_Node', 'End_Node', 'Target_HRT', 'Total_HRT', 'Residual'])
+        return updated_conduit_summary, updated_tot_HRT_df, residuals
+
+    length = updated_conduit_summary['cond_length'].to_numpy(dtype=float).copy()
+    hrt = updated_conduit_summary['Conduit HRT (HRS)'].to_numpy(dtype=float).copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        k = np.where((length > 0) & np.isfinite(hrt), hrt / length, np.nan)
+
+    edge_index = build_edge_index(updated_conduit_summary)
+    path_ptr, path_edges = path_edge_arrays(rows['Path'], edge_index)
+    owner = np.repeat(np.arange(len(rows)), np.diff(path_ptr))
+    known = path_edges >= 0
+    owner, path_edges = owner[known], path_edges[known]
+
+    # Conduits with a valid, nonzero HRT per unit length are free; the rest stay fixed on the right-hand side
+    free = np.isfinite(k[path_edges]) & (k[path_edges] > 0)
+    free_conduits, column = np.unique(path_edges[free], return_inverse=True)
+    fixed_hrt = np.bincount(owner[~free], weights=np.nan_to_num(hrt[path_edges[~free]]), minlength=len(rows))
+
+    M = sparse.csr_matrix((np.ones(free.sum()), (owner[free], column)), shape=(len(rows), len(free_conduits)))
+    b = rows['Subcatchments'].map(targets).to_numpy(dtype=float) - fixed_hrt
+
+    k_free, hrt_free = k[free_conduits], hrt[free_conduits]
+    lower = k_free * min_length - hrt_free
+    upper = k_free * max_length - hrt_free
+    with phase('calibration_step', solver='bounded_ridge_lsq', conduits=len(free_conduits), paths=len(rows)):
+        change, pivots, lsmr_iterations = bounded_ridge_lsq(M, b - M @ hrt_free, lower, upper, regularization)
+    count('rows_touched', len(free_conduits))
+    logger.info("Batch calibration solved", extra={'fields': {
+        'conduits': len(free_conduits), 'paths': len(rows), 'pivots': pivots, 'lsmr_iterations': lsmr_iterations}})
+
+    # Back to lengths, clipped as hrt / k can land a rounding error outside the bounds
+    length[free_conduits] = np.clip((hrt_free + change) / k_free, min_length, max_length)
+    hrt[free_conduits] = k_free * length[free_conduits]
+    updated_conduit_summary['cond_length'] = length
+    updated_conduit_summary['Conduit HRT (HRS)'] = hrt
+
+    all_ptr, all_edges = path_edge_arrays(updated_tot_HRT_df['Path'], edge_index)
+    updated_tot_HRT_df['Total_HRT'] = batch_path_HRT(all_ptr, all_edges, hrt)
+
+    residuals = updated_tot_HRT_df.loc[rows.index, ['Subcatchments', 'Start_Node', 'End_Node', 'Total_HRT']].copy()
+    residuals.insert(3, 'Target_HRT', residuals['Subcatchments'].map(targets))
+    residuals['Residual'] = residuals['Total_HRT'] - residuals['Target_HRT']
+    if 'WWTP' in updated_tot_HRT_df.columns:
+        residuals.insert(1, 'WWTP', updated_tot_HRT_df.loc[rows.index, 'WWTP'])
+
+    return updated_conduit_summary, updated_tot_HRT_df, residuals.reset_index(drop=True)
+
+class ConduitTable:
+    # Struct-of-arrays conduit state for calibration: one float array per column, a name -> row
+    # index and in-place updates, so a calibration step does not copy network-sized frames.
+    # Snapshots of the arrays are only kept when keep_history is on.
+
+    COLUMNS = ('cond_length', 'mean_flow', 'mean_depth', 'Conduit HRT (HRS)')
+
+    def __init__(self, conduit_summary, xsections=None, keep_history=False):
+        frame = conduit_summary.reset_index() if 'cond_name' not in conduit_summary.columns else conduit_summary
+        self.names = frame['cond_name'].tolist()
+        self.inlets = frame['Inlet_Node'].tolist()
+        self.outlets = frame['Outlet_Node'].tolist()
+        self.row_of = {name: pos for pos, name in enumerate(self.names)}
+        self.columns = {col: frame[col].to_numpy(dtype=float).copy() for col in self.COLUMNS}
+
+        # First conduit leaving each node, as the calibration walks from a path's start node
+        self.outgoing = {}
+        for pos, inlet in enumerate(self.inlets):
+            self.outgoing.setdefault(inlet, pos)
+
+        if xsections is None:
+            self.geometry = {'shape': DEFAULT_SHAPE, 'geom1': DEFAULT_DIAMETER}
+        else:
+            self.geometry = align_xsections(frame, xsections)
+        self.history = [] if keep_history else None
+        self.changed = set()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, col):
+        return self.columns[col]
+
+    def row_geometry(self, row):
+        return {key: (value[row:row + 1] if isinstance(value, np.ndarray) else value)
+                for key, value in self.geometry.items()}
+
+    def set(self, cond_name, **values):
+        row = self.row_of[cond_name]
+        for col, value in values.items():
+            self.columns[col][row] = value
+        self.changed.add(row)
+
+    def pop_changes(self):
+        # Rows updated since the last call, for consumers that update incrementally
+        changed = np.fromiter(sorted(self.changed), dtype=np.int64, count=len(self.changed))
+        self.changed.clear()
+        return changed
+
+    def snapshot(self, label=None):
+        if self.history is not None:
+            self.history.append((label, {col: values.copy() for col, values in self.columns.items()}))
+
+    def restore(self, position=-1):
+        label, saved = self.history[position]
+        self.load(saved)
+        return label
+
+    def load(self, columns):
+        # Overwrite columns with saved arrays (a snapshot or a checkpoint); rows that differ count as changed
+        for col, values in columns.items():
+            differs = (self.columns[col] != values) & ~(np.isnan(self.columns[col]) & np.isnan(values))
+            self.changed.update(np.flatnonzero(differs).tolist())
+            self.columns[col][:] = values
+
+    def to_frame(self, rows=None):
+        # Every conduit, or only the given rows (e.g. from pop_changes)
+        if rows is None:
+            columns = {'cond_name': self.names, 'Inlet_Node': self.inlets, 'Outlet_Node': self.outlets}
+            rows = slice(None)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            columns = {'cond_name': [self.names[row] for row in rows], 'Inlet_Node': [self.inlets[row] for row in rows],
+                       'Outlet_Node': [self.outlets[row] for row in rows]}
+        columns.update((col, values[rows].copy()) for col, values in self.columns.items())
+        return pd.DataFrame(columns)
+
+def calibrate_HRT(conduit_table, Total_HRT_df, median_HRT_df, progress_tracker=None, sorting_order=None):
+    # Works on a ConduitTable in place; a conduit summary DataFrame is wrapped into one first.
+    # sorting_order ({WWTP: row labels}) keeps each WWTP's order across calls: a WWTP's rows are
+    # sorted by Total_HRT the first time it is reached and walked in that order from then on.
+
+    if isinstance(conduit_table, pd.DataFrame):
+        conduit_table = ConduitTable(conduit_table)
 
     if progress_tracker is None:
         progress_tracker = {wwtp: 0 for wwtp in Total_HRT_df['WWTP'].unique()}
-    
-    updated_conduit_summary = conduit_summary.copy()
-    updated_tot_HRT_df = Total_HRT_df.copy()
-    conduit_summary['cond_length'] = conduit_summary['cond_length'].astype(float)
 
-    if 'Subcatchments' not in updated_tot_HRT_df.columns:
+    if 'Subcatchments' not in Total_HRT_df.columns:
         raise KeyError("Col subcatchments not found")
     
-    if 'WWTP' not in updated_tot_HRT_df.columns:
-        print("Columns 'WWTP' not found. Skipping WWTP-based processing")
-        print("Calibration complete")
-        return updated_conduit_summary, updated_tot_HRT_df
-
-    # Initialize dictionary to track sorting status and save sorting order
-    wwtps = updated_tot_HRT_df['WWTP'].unique()
-    sorting_status = {wwtp: False for wwtp in wwtps}
-    saved_sorting_order = {wwtp: None for wwtp in wwtps}
+    if 'WWTP' not in Total_HRT_df.columns:
+        logger.warning("Columns 'WWTP' not found. Skipping WWTP-based processing")
+        return conduit_table, Total_HRT_df, progress_tracker
+
+    if sorting_order is None:
+        sorting_order = {}
+    wwtps = list(progress_tracker)
     calibration_status = {wwtp: 'Not Calibrated' for wwtp in wwtps}
 
     for wwtp in wwtps:
         if calibration_status[wwtp] == 'Not Calibrated':
-            if not sorting_status[wwtp]:
-                # Sort by 'Total_HRT' in ascending order
-                wwtp_df = updated_tot_HRT_df[updated_tot_HRT_df['WWTP'] == wwtp].sort_values(by='Total_HRT', ascending=True)
-                # Save the order of indices
-                saved_sorting_order[wwtp] = wwtp_df.index.tolist()
-                sorting_status[wwtp] = True  # Mark as sorted
-                print("THIS IS SORTING STATUS")
-                print(sorting_status[wwtp])
-                print("THIS IS SAVED SORTING ORDER")
-                print(saved_sorting_order[wwtp])
-            else:
-                # Use the saved sorting order
-                wwtp_df = updated_tot_HRT_df.loc[saved_sorting_order[wwtp]]
-                print("THIS IS WWTP DF")
-                print(wwtp_df)
+            if wwtp not in sorting_order:
+                # Sort by 'Total_HRT' in ascending order and save the order of indices
+                wwtp_df = Total_HRT_df[Total_HRT_df['WWTP'] == wwtp].sort_values(by='Total_HRT', ascending=True)
+                sorting_order[wwtp] = wwtp_df.index.to_numpy()
+                logger.debug("Saved sorting order", extra={'fields': {'wwtp': wwtp, 'paths': len(sorting_order[wwtp])}})
+            order = sorting_order[wwtp]
 
             start_index = progress_tracker[wwtp]
 
-            if start_index < len(wwtp_df):
-                row = wwtp_df.iloc[start_index]
-                print(f"Processing row {start_index} for WWTP: {wwtp}")
+            if start_index < len(order):
+                row = Total_HRT_df.loc[order[start_index]]
+                logger.debug("Processing row", extra={'fields': {'wwtp': wwtp, 'row': start_index}})
 
                 if pd.isna(row['Subcatchments']):
-                    print(f"Skipping row {start_index} due to NaN in subcatchments")
+                    logger.debug("Skipping row with no subcatchment", extra={'fields': {'wwtp': wwtp, 'row': start_index}})
                     start_index += 1
                     progress_tracker[wwtp] = start_index
-                    return updated_conduit_summary, updated_tot_HRT_df, progress_tracker
+                    return conduit_table, Total_HRT_df, progress_tracker
                 else:
                     subs = row['Subcatchments']
                     if subs in median_HRT_df['sc.id'].values:
                         median_row = median_HRT_df[median_HRT_df['sc.id'] == subs].iloc[0]
                         final_path_hrt = median_row['sc_median_hrt']
                         start_node = row['Start_Node']
-                        print(f"Final path HRT for {subs}: {final_path_hrt}")
-                        row_processed = False
-
-                        for j, conduit_row in updated_conduit_summary.iterrows():
-                            inlet_node = conduit_row['Inlet_Node']
-                            if inlet_node == start_node:
-                                curr_cond_length = conduit_row['cond_length']
-                                curr_mean_flow = conduit_row['mean_flow']
-                                curr_mean_depth = conduit_row['mean_depth']
-                                curr_cond_hrt = conduit_row['Conduit HRT (HRS)']
-                                tot_path_hrt = row['Total_HRT']
-                                print(f"Current conduit length: {curr_cond_length}")
-                                print(f"Current HRT: {curr_cond_hrt}")
-                                print(f"current path HRT = {tot_path_hrt}")
-
-                                updated_conduit_summary, updated_tot_HRT_df = find_x(
-                                    updated_conduit_summary, updated_tot_HRT_df, final_path_hrt, 
-                                    curr_mean_flow, curr_mean_depth, tot_path_hrt, 
-                                    curr_cond_hrt, curr_cond_length, start_node
-                                )
-                                print(f"Updated conduit summary and total HRT df")
-                                print(updated_tot_HRT_df.loc[updated_tot_HRT_df['Start_Node'] == start_node])
-                                row_processed = True
-                                break
-
-                        if row_processed:
+
+                        # First conduit leaving the path's start node
+                        cond_row = conduit_table.outgoing.get(start_node)
+                        if cond_row is not None:
+                            cond_name = conduit_table.names[cond_row]
+                            curr_cond_length = conduit_table['cond_length'][cond_row]
+                            curr_mean_flow = conduit_table['mean_flow'][cond_row]
+                            curr_mean_depth = conduit_table['mean_depth'][cond_row]
+                            curr_cond_hrt = conduit_table['Conduit HRT (HRS)'][cond_row]
+                            tot_path_hrt = row['Total_HRT']
+                            logger.debug("Calibrating path", extra={'fields': {
+                                'subcatchment': subs, 'target_path_hrt': final_path_hrt, 'path_hrt': tot_path_hrt,
+                                'conduit': cond_name, 'length': curr_cond_length, 'conduit_hrt': curr_cond_hrt}})
+
+                            conduit_table, Total_HRT_df = find_x(
+                                conduit_table, Total_HRT_df, final_path_hrt,
+                                curr_mean_flow, curr_mean_depth, tot_path_hrt,
+                                curr_cond_hrt, cond_name, row.name
+                            )
+
                             progress_tracker[wwtp] = start_index + 1
-                            if progress_tracker[wwtp] >= len(wwtp_df):
-                                print(f"{wwtp} WWTP is fully calibrated")
+                            if progress_tracker[wwtp] >= len(order):
+                                logger.info("WWTP fully calibrated", extra={'fields': {'wwtp': wwtp}})
                                 calibration_status[wwtp] = 'Calibrated'
-                            return updated_conduit_summary, updated_tot_HRT_df, progress_tracker
+                            return conduit_table, Total_HRT_df, progress_tracker
                         else:
-                            print(f"No matching conduit found for row {start_index}")
-                            return updated_conduit_summary, updated_tot_HRT_df, progress_tracker
+                            logger.warning("No conduit leaves the path's start node", extra={'fields': {
+                                'wwtp': wwtp, 'row': start_index, 'start_node': start_node}})
+                            return conduit_table, Total_HRT_df, progress_tracker
                     else:
                         progress_tracker[wwtp] = start_index + 1
-                        return updated_conduit_summary, updated_tot_HRT_df, progress_tracker
-    return updated_conduit_summary, updated_tot_HRT_df, progress_tracker
+                        return conduit_table, Total_HRT_df, progress_tracker
+    return conduit_table, Total_HRT_df, progress_tracker
                   
-def find_x(conduit_summary, Total_HRT_df, final_path_hrt, curr_mean_flow, curr_mean_depth, tot_path_hrt, curr_cond_hrt, curr_cond_length, start_node):
+def find_x(conduit_table, Total_HRT_df, final_path_hrt, curr_mean_flow, curr_mean_depth, tot_path_hrt, curr_cond_hrt, cond_name, path_label):
     
-    updated_conduit_summary = conduit_summary.copy()
-    updated_tot_HRT_df = Total_HRT_df.copy()
-    radius = 1.5   
-    print('Columns in Total_HRT_DF before update:', updated_tot_HRT_df.columns)
-
-    if tot_path_hrt > final_path_hrt:
-        target_hrt = (final_path_hrt) - (tot_path_hrt - curr_cond_hrt)
-        theta = 2*np.arccos((radius - curr_mean_depth) / radius)
-        flow_area = (radius**2 * (theta - np.sin(theta))) / 2
-
-        flow_vol = target_hrt*3600*curr_mean_flow 
-        new_length = (flow_vol/flow_area)
-        new_v = curr_mean_flow/flow_area
-                    
-        print(f"new conduit flow velocity assuming depth remains the same :{new_v} ")
-        print(f"new length = {new_length}")
-        updated_cond_summary, updated_Tot_df = update_conduit_length(updated_conduit_summary, updated_tot_HRT_df, new_length, curr_cond_length, target_hrt, final_path_hrt, start_node)
-        print("Columns in updated_tot_HRT_df after update:", updated_tot_HRT_df.columns)
-
-    else:
-        target_hrt = (final_path_hrt) - (tot_path_hrt- curr_cond_hrt)
-        theta = 2*np.arccos(((radius - (curr_mean_depth))) / radius)
-        flow_area = (radius**2 * (theta - np.sin(theta))) / 2
-
-        # if target_hrt > 0:
-        flow_vol = target_hrt*3600*curr_mean_flow 
-        new_length = (flow_vol/flow_area)
-        new_v = curr_mean_flow/flow_area
-                    
-        print(f"new conduit flow velocity assuming depth remains the same :{new_v} ")
-        print(f"new length = {new_length}")
-        updated_cond_summary, updated_Tot_df = update_conduit_length(updated_conduit_summary, updated_tot_HRT_df, new_length, curr_cond_length, target_hrt, final_path_hrt, start_node)
-        print("Columns in updated_tot_HRT_df after update:", updated_tot_HRT_df.columns)
-
-    return updated_cond_summary, updated_Tot_df
-
-def update_conduit_length(conduit_summary, Total_HRT_df, new_length, curr_cond_length, target_hrt, final_path_hrt, start_node):
-    updated_conduit_summary = conduit_summary.copy()
-    updated_tot_HRT_df = Total_HRT_df.copy()
-    updated = False 
-    for index, row in updated_conduit_summary.iterrows():
-
-        if curr_cond_length == updated_conduit_summary.at[index, 'cond_length']:
-            updated_conduit_summary.loc[index, 'cond_length'] = new_length
-            inlet_node = updated_conduit_summary.at[index, 'Inlet_Node']
-
-            if inlet_node == start_node:
-                updated_conduit_summary.at[index, 'Conduit HRT (HRS)'] = target_hrt
-                updated_tot_HRT_df.at[index, 'Total_HRT'] = final_path_hrt
-                print(f'Updated length of conduit, from {curr_cond_length} to new length of: {new_length}')
-                updated = True
-                break
-        
-    if not updated:
-        print(f"Warning: No update perofrm for conduit with length : {curr_cond_length}")
+    # Same target whether the path is currently too slow or too fast: the conduit takes up
+    # whatever HRT the rest of the path leaves to reach the final path HRT
+    target_hrt = (final_path_hrt) - (tot_path_hrt - curr_cond_hrt)
+    geometry = conduit_table.row_geometry(conduit_table.row_of[cond_name])
+    theta, flow_area, valid = conduit_geometry(np.array([curr_mean_depth]), **geometry)
+    flow_area = flow_area[0]
+
+    new_length = float(length_for_HRT(target_hrt, curr_mean_flow, flow_area))
+    new_v = curr_mean_flow/flow_area
+                
+    logger.debug("New conduit length", extra={'fields': {'conduit': cond_name, 'velocity': new_v, 'length': new_length}})
+    conduit_table, Total_HRT_df = update_conduit_length(conduit_table, Total_HRT_df, new_length, cond_name, target_hrt, final_path_hrt, path_label)
+
+    return conduit_table, Total_HRT_df
+
+def update_conduit_length(conduit_table, Total_HRT_df, new_length, cond_name, target_hrt, final_path_hrt, path_label):
+    # Conduits are addressed by name, not by matching float lengths
+    if cond_name not in conduit_table.row_of:
+        logger.warning("No update performed for conduit", extra={'fields': {'conduit': cond_name}})
+        return conduit_table, Total_HRT_df
+
+    conduit_table.snapshot(cond_name)
+    curr_cond_length = conduit_table['cond_length'][conduit_table.row_of[cond_name]]
+    conduit_table.set(cond_name, **{'cond_length': new_length, 'Conduit HRT (HRS)': target_hrt})
+    Total_HRT_df.at[path_label, 'Total_HRT'] = final_path_hrt
+    count('rows_touched')
+    logger.debug("Updated conduit length", extra={'fields': {'conduit': cond_name, 'from': curr_cond_length, 'to': new_length}})
                 
-    return updated_conduit_summary, updated_tot_HRT_df
+    return conduit_table, Total_HRT_df
 
 def replace_inp_section(inp_file_path, conduits_df, section_name):
-    # Load the model
-    model = swmmio.Model(inp_file_path)
-    
-    # Get the existing section
-    section = getattr(model.inp, section_name.lower())
-    
-    # Ensure section is a DataFrame
-    if not isinstance(section, pd.DataFrame):
-        raise TypeError(f"The section '{section_name}' is not a DataFrame.")
-    
-    # Print existing section for debugging
-    print(f"Existing section columns: {section.columns}")
-    print(f"Existing section head:\n{section.head()}")
-    
-    # Convert the DataFrame to the format required by swmmio
-    new_section = section.copy()
-    
-    # Print columns of new_section
-    print(f"New section columns before update: {new_section.columns}")
-    
-    for index, row in conduits_df.iterrows():
-        if index in new_section.index:
-            if 'Length' in row:
-                new_section.at[index, 'Length'] = row['Length']
-            else:
-                print(f"Column 'Length' not found in row: {row}")
-    
-    # Print new_section to check if it has been updated
-    print(f"New section after updates:\n{new_section.head()}")
-    
-    # Update the model's section with the new data
-    setattr(model.inp, section_name.lower(), new_section)
-    
+    # Rewrite only the changed fields of the section's rows (e.g. CONDUITS Length) while
+    # streaming the rest of the .inp byte for byte; conduits_df is indexed by element name
+    if section_name.upper() not in SECTION_FIELDS:
+        raise ValueError(f"Section '{section_name}' cannot be patched, expected one of {list(SECTION_FIELDS)}")
+
+    patch = frame_to_patch(conduits_df, section_name)
+    if not patch or not next(iter(patch.values())):
+        logger.warning("No section fields found in columns", extra={'fields': {'section': section_name, 'columns': list(conduits_df.columns)}})
+
     # Save the updated model to a new file
     new_file_path = inp_file_path.replace('.inp', '_updated.inp')
-    model.inp.save(new_file_path)
-    print(f"Updated model saved to {new_file_path}")
+    with phase('inp_write', section=section_name, elements=len(patch)):
+        bytes_written = patch_inp(inp_file_path, {new_file_path: {section_name: patch}})
+    count('bytes_written', bytes_written)
+    logger.info("Updated model saved", extra={'fields': {'path': new_file_path, 'bytes': bytes_written}})
+    return new_file_path
@@ -0,0 +1,108 @@
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import pandas as pd
+from profiling_utils import get_logger, count
+
+logger = get_logger('checkpoints')
+
+# Bump when the checkpoint layout changes
+CHECKPOINT_VERSION = 1
+DEFAULT_CHECKPOINT_DIR = '.hrt_checkpoints'
+
+def file_key(path):
+    # Content hash of an input file; None for no file
+    if path is None:
+        return None
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def stage_key(params, upstream_keys=()):
+    # Hash of a stage's own settings and the keys of the stages it reads from, so a change
+    # anywhere upstream also changes the key of everything downstream
+    payload = {'version': CHECKPOINT_VERSION, 'params': params, 'upstream': list(upstream_keys)}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+def write_atomic(path, data):
+    # A crash mid-write leaves the previous file in place rather than a truncated one
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class CheckpointStore:
+    # Outputs of completed pipeline stages, one pickle per stage, plus the in-progress state
+    # of a stage that checkpoints as it goes (e.g. after every calibration iteration).
+    # manifest.json holds the key each stage was run with (stage_key); a stage only counts
+    # as done while its key matches, so changed inputs or settings re-run it. The manifest
+    # also keeps the run id, so a resumed run appends to the same result store run.
+
+    def __init__(self, run_dir=DEFAULT_CHECKPOINT_DIR):
+        self.run_dir = run_dir
+        os.makedirs(run_dir, exist_ok=True)
+        self.manifest_path = os.path.join(run_dir, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+        if self.manifest.get('version') != CHECKPOINT_VERSION:
+            self.manifest = {'version': CHECKPOINT_VERSION, 'run_id': pd.Timestamp.now().strftime('%Y%m%d-%H%M%S'),
+                             'stages': {}}
+            self._write_manifest()
+
+    @property
+    def run_id(self):
+        return self.manifest['run_id']
+
+    def _path(self, name):
+        return os.path.join(self.run_dir, f'{name}.pkl')
+
+    def _write_manifest(self):
+        write_atomic(self.manifest_path, json.dumps(self.manifest, indent=2).encode())
+
+    def done(self, stage, key):
+        return self.manifest['stages'].get(stage) == key and os.path.exists(self._path(stage))
+
+    def save(self, stage, key, outputs):
+        write_atomic(self._path(stage), pickle.dumps(outputs, protocol=pickle.HIGHEST_PROTOCOL))
+        self.manifest['stages'][stage] = key
+        self._write_manifest()
+        self.discard_progress(stage)
+        count('checkpoints_saved')
+
+    def load(self, stage):
+        with open(self._path(stage), 'rb') as f:
+            outputs = pickle.load(f)
+        count('checkpoints_loaded')
+        return outputs
+
+    def save_progress(self, stage, key, state):
+        write_atomic(self._path(f'{stage}.progress'),
+                     pickle.dumps({'key': key, 'state': state}, protocol=pickle.HIGHEST_PROTOCOL))
+        count('progress_saved')
+
+    def load_progress(self, stage, key):
+        # State saved by an interrupted run of the stage with the same key, else None
+        path = self._path(f'{stage}.progress')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        return saved['state'] if saved['key'] == key else None
+
+    def discard_progress(self, stage):
+        path = self._path(f'{stage}.progress')
+        if os.path.exists(path):
+            os.remove(path)
+
+    def clear(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.__init__(self.run_dir)
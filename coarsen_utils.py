@@ -0,0 +1,382 @@
+import numpy as np
+import pandas as pd
+from calibration_HRT_utils import conduit_geometry, conduit_HRT, align_xsections, PathHRTIndex, DrainageIndex
+from inp_utils import SECTION_FIELDS, format_value, patch_line, read_section, section_name
+from profiling_utils import get_logger, phase, count
+
+logger = get_logger('coarsen')
+
+# Geometry fields that are lengths and scale with the cross-section; TRAPEZOIDAL geom3/geom4 are side slopes
+SCALED_GEOMETRY = {
+    'CIRCULAR': ('Geom1',), 'FORCE_MAIN': ('Geom1',), 'RECT_CLOSED': ('Geom1', 'Geom2'),
+    'RECT_OPEN': ('Geom1', 'Geom2'), 'TRAPEZOIDAL': ('Geom1', 'Geom2'), 'TRIANGULAR': ('Geom1', 'Geom2'),
+}
+GEOMETRY_COLUMNS = ['Shape', 'Geom1', 'Geom2', 'Geom3', 'Geom4', 'Barrels']
+# Sections whose lines belong to one node or link, by the element name in their first token
+NODE_SECTIONS = ('JUNCTIONS', 'COORDINATES')
+LINK_SECTIONS = ('CONDUITS', 'XSECTIONS', 'LOSSES', 'VERTICES')
+
+def conduit_frame(conduit_summary, link_table):
+    # One row per conduit, indexed by name: connectivity, length, roughness and offsets from the
+    # swmmio link table, mean flow and depth from the summary, and the wetted area, volume and HRT
+    # they give. Only conduits with a supported shape and a valid HRT can be merged.
+    summary = conduit_summary.reset_index() if 'cond_name' not in conduit_summary.columns else conduit_summary
+    links = link_table[link_table['Type'].astype(str).str.upper() == 'CONDUIT'] if 'Type' in link_table.columns else link_table
+    frame = pd.DataFrame({
+        'Inlet_Node': links['InletNode'].astype(str), 'Outlet_Node': links['OutletNode'].astype(str),
+        'cond_length': pd.to_numeric(links['Length'], errors='coerce'),
+        'Roughness': pd.to_numeric(links['Roughness'], errors='coerce'),
+        'InOffset': links['InOffset'], 'OutOffset': links['OutOffset'],
+    }, index=links.index.astype(str).rename('cond_name'))
+    stats = summary.drop_duplicates('cond_name').set_index('cond_name')
+    frame['mean_flow'] = pd.to_numeric(stats['mean_flow'], errors='coerce').reindex(frame.index)
+    frame['mean_depth'] = pd.to_numeric(stats['mean_depth'], errors='coerce').reindex(frame.index)
+
+    geometry = align_xsections(frame.reset_index(), links)
+    for col in GEOMETRY_COLUMNS:
+        frame[col] = geometry[col.lower()]
+    frame['Shape'] = frame['Shape'].astype(str).str.upper()
+    theta, flow_area, valid = conduit_geometry(frame['mean_depth'].to_numpy(dtype=float), **geometry)
+    volume, hrt, valid = conduit_HRT(flow_area, frame['cond_length'].to_numpy(dtype=float),
+                                     frame['mean_flow'].to_numpy(dtype=float), valid)
+    frame['flow_area'] = flow_area
+    frame['volume'] = volume
+    frame['Conduit HRT (HRS)'] = hrt
+    frame['mergeable'] = valid & (flow_area > 0) & frame['Shape'].isin(list(SCALED_GEOMETRY)).to_numpy()
+    frame['members'] = [[name] for name in frame.index]
+    return frame
+
+def node_roles(inp_file_path, link_table, keep_nodes=()):
+    # Junctions that may be removed, nodes receiving lateral inflow (subcatchment runoff or
+    # dry-weather flow) and the area of the subcatchments draining to each node
+    junctions = {row[0] for row in read_section(inp_file_path, 'JUNCTIONS')}
+    protected = set(keep_nodes)
+    # Nodes of pumps, weirs, orifices and outlets, nodes with external inflows, RDII or treatment,
+    # and anything named in control rules keep their place in the network
+    if 'Type' in link_table.columns:
+        other = link_table[link_table['Type'].astype(str).str.upper() != 'CONDUIT']
+        protected.update(other['InletNode'].astype(str))
+        protected.update(other['OutletNode'].astype(str))
+    for section in ('INFLOWS', 'RDII', 'TREATMENT'):
+        protected.update(row[0] for row in read_section(inp_file_path, section))
+    protected.update(token for row in read_section(inp_file_path, 'CONTROLS') for token in row)
+    removable = junctions - protected
+
+    outlets = {row[0]: row[2] for row in read_section(inp_file_path, 'SUBCATCHMENTS')}
+    areas = {row[0]: float(row[3]) for row in read_section(inp_file_path, 'SUBCATCHMENTS')}
+    node_area = {}
+    for sc, outlet in outlets.items():
+        seen = {sc}
+        while outlet in outlets and outlet not in seen:
+            seen.add(outlet)
+            outlet = outlets[outlet]
+        node_area[outlet] = node_area.get(outlet, 0.0) + areas[sc]
+    lateral = set(node_area) | {row[0] for row in read_section(inp_file_path, 'DWF')}
+    return removable, lateral, node_area
+
+def equivalent_conduit(frame, names, length, hrt, representative):
+    # One conduit in place of names with their total volume: cross-section of the representative
+    # member scaled so its wetted area at the scaled mean depth is volume / length, and the
+    # mean flow that gives hrt hours. Returns the updated fields.
+    rep = frame.loc[representative]
+    volume = frame.loc[names, 'volume'].sum()
+    area = volume / length
+    scale = np.sqrt(area / rep['flow_area'])
+    fields = {'cond_length': length, 'flow_area': area, 'volume': volume, 'Conduit HRT (HRS)': hrt,
+              'mean_flow': volume / (hrt * 3600), 'mean_depth': rep['mean_depth'] * scale,
+              'Shape': rep['Shape'], 'Geom3': rep['Geom3'], 'Geom4': rep['Geom4'], 'Barrels': rep['Barrels']}
+    for col in ('Geom1', 'Geom2'):
+        fields[col] = rep[col] * scale if col in SCALED_GEOMETRY[rep['Shape']] else rep[col]
+    return fields
+
+def _edges(frame):
+    out_edges, in_edges = {}, {}
+    for name, inlet, outlet in zip(frame.index, frame['Inlet_Node'], frame['Outlet_Node']):
+        out_edges.setdefault(inlet, []).append(name)
+        in_edges.setdefault(outlet, []).append(name)
+    return out_edges, in_edges
+
+def collapse_branches(frame, removable, lateral, node_area, flow_threshold=None, area_threshold=None):
+    # Replace every maximal tree-shaped branch whose conduits all carry less than flow_threshold,
+    # or whose tributary subcatchment area is below area_threshold, by its outlet conduit k -> j.
+    # The branch's nodes merge into k and their subcatchments and dry-weather flows move there.
+    # The equivalent conduit holds the branch volume V and, as its outflow Q is unchanged, the
+    # flow-weighted mean residence time V / Q of the water passing through the branch; its length
+    # is the area-weighted mean distance from the branch's subcatchment outlets to j.
+    # Works on frame in place; returns {removed node: node it merged into}.
+    if flow_threshold is None and area_threshold is None:
+        return {}
+    out_edges, in_edges = _edges(frame)
+    inlet, mean_flow = frame['Inlet_Node'].to_dict(), frame['mean_flow'].to_dict()
+    mergeable = frame['mergeable'].to_dict()
+
+    # Per node: is everything upstream a tree of removable single-outlet junctions with
+    # mergeable conduits, and the largest mean flow and total area up there
+    info = {}
+
+    def upstream(node):
+        # Iterative post-order walk; a node met again before it is finished lies on a cycle
+        stack, visiting = [(node, False)], set()
+        while stack:
+            n, expanded = stack.pop()
+            if n in info:
+                continue
+            preds = [(e, inlet[e]) for e in in_edges.get(n, [])]
+            if not expanded:
+                if n in visiting:
+                    info[n] = (False, 0.0, 0.0)
+                    continue
+                visiting.add(n)
+                stack.append((n, True))
+                stack.extend((p, False) for e, p in preds
+                             if p not in info and p in removable and len(out_edges.get(p, [])) == 1)
+                continue
+            ok, flow, area = True, 0.0, 0.0
+            for e, p in preds:
+                if p not in removable or len(out_edges.get(p, [])) != 1 or not mergeable[e] or not info.get(p, (False,))[0]:
+                    ok = False
+                    break
+                flow = max(flow, mean_flow[e], info[p][1])
+                area += node_area.get(p, 0.0) + info[p][2]
+            info[n] = (ok, flow, area)
+        return info[node]
+
+    def candidate(cond):
+        k = inlet[cond]
+        if not mergeable[cond] or len(out_edges.get(k, [])) != 1 or not in_edges.get(k):
+            return False
+        ok, flow, area = upstream(k)
+        if not ok:
+            return False
+        small_flow = flow_threshold is not None and max(flow, mean_flow[cond]) < flow_threshold
+        small_area = area_threshold is not None and node_area.get(k, 0.0) + area < area_threshold
+        return small_flow or small_area
+
+    node_map = {}
+    outlet = frame['Outlet_Node'].to_dict()
+    for cond in list(frame.index):
+        # Conduits of a branch collapsed earlier are gone; maximal branches do not overlap
+        if cond not in frame.index or not candidate(cond):
+            continue
+        j = outlet[cond]
+        downstream = out_edges.get(j, [])
+        if j in removable and len(downstream) == 1 and candidate(downstream[0]):
+            continue
+
+        # Walk the branch up from k, with every node's distance to j
+        k = inlet[cond]
+        distance = {k: frame.at[cond, 'cond_length']}
+        members, stack = [cond], [k]
+        while stack:
+            n = stack.pop()
+            for e in in_edges.get(n, []):
+                p = inlet[e]
+                distance[p] = distance[n] + frame.at[e, 'cond_length']
+                members.append(e)
+                stack.append(p)
+        weights = np.array([node_area.get(n, 0.0) for n in distance])
+        lengths = np.array(list(distance.values()))
+        length = float(np.average(lengths, weights=weights)) if weights.sum() > 0 else float(lengths.max())
+        hrt = frame.loc[members, 'volume'].sum() / mean_flow[cond] / 3600
+
+        for col, value in equivalent_conduit(frame, members, length, hrt, cond).items():
+            frame.at[cond, col] = value
+        frame.at[cond, 'members'] = [name for e in members for name in frame.at[e, 'members']]
+        frame.drop(index=members[1:], inplace=True)
+
+        removed = [n for n in distance if n != k]
+        node_map.update({n: k for n in removed})
+        if any(n in lateral for n in removed):
+            lateral.add(k)
+        node_area[k] = sum(node_area.pop(n, 0.0) for n in removed) + node_area.get(k, 0.0)
+        count('branches_collapsed')
+    return node_map
+
+def merge_series(frame, removable, lateral):
+    # Merge chains of conduits through junctions with one inflow, one outflow and no lateral
+    # inflow into the chain's last conduit: lengths, volumes and HRTs add up, the roughness is
+    # length weighted and the cross-section is the largest member's, scaled to the mean area.
+    # Works on frame in place; returns {removed node: chain end node}.
+    out_edges, in_edges = _edges(frame)
+    mergeable = frame['mergeable'].to_dict()
+
+    def through(node):
+        ins, outs = in_edges.get(node, []), out_edges.get(node, [])
+        return (node in removable and node not in lateral and len(ins) == 1 and len(outs) == 1
+                and ins[0] != outs[0] and mergeable[ins[0]] and mergeable[outs[0]])
+
+    node_map = {}
+    for first in list(frame.index):
+        if first not in frame.index or through(frame.at[first, 'Inlet_Node']) or not mergeable[first]:
+            continue
+        chain = [first]
+        while through(frame.at[chain[-1], 'Outlet_Node']) and len(chain) <= len(frame):
+            chain.append(out_edges[frame.at[chain[-1], 'Outlet_Node']][0])
+        if len(chain) == 1:
+            continue
+        last = chain[-1]
+        lengths = frame.loc[chain, 'cond_length']
+        fields = equivalent_conduit(frame, chain, lengths.sum(), frame.loc[chain, 'Conduit HRT (HRS)'].sum(),
+                                    frame.loc[chain, 'volume'].idxmax())
+        fields.update({'Inlet_Node': frame.at[first, 'Inlet_Node'], 'InOffset': frame.at[first, 'InOffset'],
+                       'Roughness': float(np.average(frame.loc[chain, 'Roughness'], weights=lengths))})
+        end = frame.at[last, 'Outlet_Node']
+        node_map.update({frame.at[cond, 'Outlet_Node']: end for cond in chain[:-1]})
+        for col, value in fields.items():
+            frame.at[last, col] = value
+        frame.at[last, 'members'] = [name for cond in chain for name in frame.at[cond, 'members']]
+        frame.drop(index=chain[:-1], inplace=True)
+        count('series_merged', len(chain) - 1)
+    return node_map
+
+def resolve(node_map, node):
+    seen = set()
+    while node in node_map and node not in seen:
+        seen.add(node)
+        node = node_map[node]
+    return node
+
+def coarsen_network(conduit_summary, link_table, inp_file_path, flow_threshold=None, area_threshold=None,
+                    merge_chains=True, keep_nodes=()):
+    # Reduced conduit network: small branches collapsed first, then series conduits merged.
+    # conduit_summary needs cond_name, mean_flow and mean_depth (e.g. cached_model_summary links),
+    # link_table is the swmmio model.links.dataframe. Returns the coarse conduit frame (members
+    # lists the original conduits of every row) and {removed node: node it merged into}.
+    with phase('coarsen', conduits=len(link_table)):
+        frame = conduit_frame(conduit_summary, link_table)
+        removable, lateral, node_area = node_roles(inp_file_path, link_table, keep_nodes)
+        node_map = collapse_branches(frame, removable, lateral, node_area, flow_threshold, area_threshold)
+        if merge_chains:
+            node_map.update(merge_series(frame, removable, lateral))
+    node_map = {node: resolve(node_map, node) for node in node_map}
+    logger.info("Coarsened network", extra={'fields': {
+        'conduits': len(link_table), 'coarse_conduits': len(frame), 'nodes_removed': len(node_map)}})
+    return frame, node_map
+
+def merged_dwf(inp_file_path, node_map):
+    # [DWF] rows of every node that receives another node's dry-weather flow: baselines of the
+    # same constituent add up, the time patterns are those of the largest baseline
+    rows = read_section(inp_file_path, 'DWF')
+    targets = {resolve(node_map, row[0]) for row in rows if row[0] in node_map}
+    merged = {}
+    for row in rows:
+        node = resolve(node_map, row[0])
+        if node not in targets:
+            continue
+        key = (node, row[1].upper())
+        baseline = float(row[2])
+        total, patterns, largest = merged.get(key, (0.0, row[3:], -np.inf))
+        if baseline > largest:
+            patterns, largest = row[3:], baseline
+        merged[key] = (total + baseline, patterns, largest)
+    return targets, merged
+
+def write_coarse_inp(inp_file_path, new_file_path, frame, node_map):
+    # Stream the model into the reduced one: removed conduits and junctions are dropped with their
+    # cross-sections, losses, vertices, coordinates and tags, equivalent conduits get their new
+    # inlet, length, roughness, offsets and cross-section, subcatchments drain to the nodes their
+    # outlets merged into and dry-weather flows are combined per node
+    kept = set(frame.index)
+    changed = frame[frame['members'].map(len) > 1]
+    removed_links = {name for members in frame['members'] for name in members} - kept
+    removed_nodes = set(node_map)
+    dwf_nodes, dwf_rows = merged_dwf(inp_file_path, node_map)
+    subcatchment_fields = ['Name', 'RainGage', 'Outlet']
+
+    def removed(section, name):
+        if section in NODE_SECTIONS:
+            return name in removed_nodes
+        if section in LINK_SECTIONS:
+            return name in removed_links or (section == 'VERTICES' and name in changed.index)
+        return False
+
+    def flush(dst, section):
+        if section == 'DWF':
+            for (node, constituent), (baseline, patterns, largest) in dwf_rows.items():
+                dst.write(' '.join([f'{node:<16}', f'{constituent:<16}', format_value(baseline)] + patterns) + '\n')
+            dwf_rows.clear()
+
+    section = None
+    with open(inp_file_path, encoding='latin-1', newline='') as src, \
+            open(new_file_path, 'w', encoding='latin-1', newline='') as dst:
+        for line in src:
+            new_section = section_name(line)
+            if new_section is not None:
+                flush(dst, section)
+                section = new_section
+                dst.write(line)
+                continue
+            tokens = line.split(';', 1)[0].split()
+            if not tokens:
+                dst.write(line)
+                continue
+            name = tokens[0]
+
+            if removed(section, name):
+                continue
+            if section == 'CONDUITS' and name in changed.index:
+                row = changed.loc[name]
+                line = patch_line(line, {'InletNode': row['Inlet_Node'], 'Length': row['cond_length'],
+                                         'Roughness': row['Roughness'], 'InOffset': row['InOffset'],
+                                         'OutOffset': row['OutOffset']}, SECTION_FIELDS['CONDUITS'])
+            elif section == 'XSECTIONS' and name in changed.index:
+                row = changed.loc[name]
+                line = ' '.join([f'{name:<16}', f"{row['Shape']:<12}"] +
+                                [f'{format_value(float(row[col])):<10}' for col in GEOMETRY_COLUMNS[1:]]).rstrip() + '\n'
+            elif section == 'SUBCATCHMENTS' and len(tokens) > 2 and tokens[2] in removed_nodes:
+                line = patch_line(line, {'Outlet': node_map[tokens[2]]}, subcatchment_fields)
+            elif section == 'DWF' and resolve(node_map, name) in dwf_nodes:
+                continue
+            elif section == 'TAGS' and len(tokens) > 1 and (tokens[1] in removed_nodes or tokens[1] in removed_links):
+                continue
+            elif section == 'REPORT' and name.upper() in ('NODES', 'LINKS'):
+                names = [t for t in tokens[1:] if t not in removed_nodes and t not in removed_links]
+                if not names:
+                    continue
+                line = ' '.join([name] + names) + '\n'
+            dst.write(line)
+        flush(dst, section)
+    count('coarse_models_written')
+    return new_file_path
+
+def subcatchment_HRT(frame, node_ids, inp_file_path, outfalls):
+    # HRT of every subcatchment along its shortest path to its nearest outfall
+    flat = frame.reset_index()
+    path_index = PathHRTIndex(flat, flat, list(node_ids), outfalls)
+    drainage_index = DrainageIndex(inp_file_path, path_index.distance)
+    paths = drainage_index.join(path_index.to_frame())
+    paths = drainage_index.nearest_paths(paths)
+    paths = paths.dropna(subset=['Subcatchments']).drop_duplicates('Subcatchments')
+    return paths.set_index('Subcatchments')[['Start_Node', 'End_Node', 'Total_HRT']]
+
+def hrt_preservation(fine, coarse, node_ids, node_map, inp_file_path, coarse_inp_file_path, outfalls):
+    # Per subcatchment HRT of the original and the coarse network and the difference (hours)
+    with phase('coarsen_report'):
+        before = subcatchment_HRT(fine, node_ids, inp_file_path, outfalls)
+        coarse_nodes = [node for node in node_ids if node not in node_map]
+        after = subcatchment_HRT(coarse, coarse_nodes, coarse_inp_file_path, outfalls)
+    report = pd.DataFrame({
+        'Node': before['Start_Node'], 'Coarse_Node': after['Start_Node'].reindex(before.index),
+        'End_Node': before['End_Node'], 'HRT': before['Total_HRT'],
+        'Coarse_HRT': after['Total_HRT'].reindex(before.index),
+    })
+    report['HRT_Error'] = report['Coarse_HRT'] - report['HRT']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        report['Relative_Error'] = report['HRT_Error'] / report['HRT']
+    return report.rename_axis('Subcatchments').reset_index()
+
+def coarsen_model(inp_file_path, new_file_path, conduit_summary, link_table, node_ids, outfalls,
+                  flow_threshold=None, area_threshold=None, merge_chains=True, keep_nodes=()):
+    # Coarsen, write the reduced .inp and report the HRT error per subcatchment; node_ids are the
+    # model's node names (cached summary node_ids or swmmio model.nodes.dataframe.index).
+    # Outfalls are never removed. Returns the coarse conduit frame, the node map and the report.
+    keep_nodes = set(keep_nodes) | set(outfalls)
+    coarse, node_map = coarsen_network(conduit_summary, link_table, inp_file_path, flow_threshold,
+                                       area_threshold, merge_chains, keep_nodes)
+    write_coarse_inp(inp_file_path, new_file_path, coarse, node_map)
+    report = hrt_preservation(conduit_frame(conduit_summary, link_table), coarse, node_ids, node_map,
+                              inp_file_path, new_file_path, outfalls)
+    logger.info("HRT preservation", extra={'fields': {
+        'subcatchments': len(report), 'max_abs_error': float(report['HRT_Error'].abs().max()) if len(report) else 0.0,
+        'mean_abs_error': float(report['HRT_Error'].abs().mean()) if len(report) else 0.0}})
+    return coarse, node_map, report
@@ -0,0 +1,177 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import pandas as pd
+from inp_utils import read_section, rewrite_inp
+from profiling_utils import get_logger, phase, count
+
+logger = get_logger('hotstart')
+
+# Bump when the spin-up procedure or the stored metadata changes
+HOTSTART_VERSION = 1
+DEFAULT_HOTSTART_DIR = '.hrt_hotstart'
+
+# Element names (and connections) whose number and order a SWMM hotstart file depends on;
+# token positions per section. Conduit lengths, shapes and inflows are deliberately left out,
+# so calibration candidates share their base model's dry-weather state.
+TOPOLOGY_FIELDS = {
+    'SUBCATCHMENTS': (0, 2),
+    'JUNCTIONS': (0,),
+    'OUTFALLS': (0,),
+    'DIVIDERS': (0,),
+    'STORAGE': (0,),
+    'CONDUITS': (0, 1, 2),
+    'PUMPS': (0, 1, 2),
+    'ORIFICES': (0, 1, 2),
+    'WEIRS': (0, 1, 2),
+    'OUTLETS': (0, 1, 2),
+    'POLLUTANTS': (0,),
+    'LANDUSES': (0,),
+}
+TOPOLOGY_OPTIONS = ('FLOW_UNITS', 'FLOW_ROUTING')
+
+def model_options(inp_file_path):
+    return {row[0].upper(): row[1] for row in read_section(inp_file_path, 'OPTIONS') if len(row) > 1}
+
+def topology_key(inp_file_path, settings=None):
+    # Hash of the element layout a hotstart file must match, plus the spin-up settings
+    hasher = hashlib.sha256()
+    options = model_options(inp_file_path)
+    hasher.update(json.dumps({'version': HOTSTART_VERSION, 'settings': settings or {},
+                              'options': {k: options.get(k) for k in TOPOLOGY_OPTIONS}}, sort_keys=True).encode())
+    for section, fields in TOPOLOGY_FIELDS.items():
+        hasher.update(f'[{section}]'.encode())
+        for row in read_section(inp_file_path, section):
+            hasher.update(' '.join(row[i] for i in fields if i < len(row)).encode() + b'\n')
+    return hasher.hexdigest()
+
+def model_start(inp_file_path):
+    options = model_options(inp_file_path)
+    return pd.Timestamp(f"{options['START_DATE']} {options.get('START_TIME', '00:00:00')}")
+
+def window_options(start, end):
+    # [OPTIONS] entries that limit a run (and its report) to start..end
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    return {
+        'START_DATE': start.strftime('%m/%d/%Y'), 'START_TIME': start.strftime('%H:%M:%S'),
+        'REPORT_START_DATE': start.strftime('%m/%d/%Y'), 'REPORT_START_TIME': start.strftime('%H:%M:%S'),
+        'END_DATE': end.strftime('%m/%d/%Y'), 'END_TIME': end.strftime('%H:%M:%S'),
+    }
+
+def stored_volume(sim_indices):
+    # Water held in every node and link at the current routing step
+    from swmm.toolkit import solver
+    from pyswmm.toolkitapi import NodeResults, LinkResults
+    node_index, link_index = sim_indices
+    return (sum(solver.node_get_result(i, NodeResults.newVolume.value) for i in node_index) +
+            sum(solver.link_get_result(i, LinkResults.newVolume.value) for i in link_index))
+
+def spin_up_hotstart(inp_file_path, hotstart_path, max_days=30, check_hours=24, tolerance=1e-3):
+    # Run the model with rainfall ignored from its START_DATE and save a hotstart once the
+    # stored volume changes by less than tolerance (relative) between checks check_hours
+    # apart; a day by default, so diurnal dry-weather patterns compare like with like.
+    # Saves at the end of max_days if that never happens. SWMM writes the [FILES] SAVE HOTSTART
+    # state when the run ends, so leaving the loop early saves the settled state.
+    # Returns (equilibrium reached, days run).
+    from pyswmm import Simulation, Links, Nodes
+    from pyswmm.toolkitapi import ObjectType
+
+    start = model_start(inp_file_path)
+    options = dict(window_options(start, start + pd.Timedelta(days=max_days)), IGNORE_RAINFALL='YES')
+    check = pd.Timedelta(hours=check_hours)
+
+    with tempfile.TemporaryDirectory(prefix='swmm_spin_up_') as workdir:
+        spin_inp = rewrite_inp(inp_file_path, os.path.join(workdir, os.path.basename(inp_file_path)), options,
+                               files={'USE HOTSTART': None, 'SAVE HOTSTART': hotstart_path})
+        with phase('spin_up', inp=os.path.basename(inp_file_path)), Simulation(spin_inp) as sim:
+            indices = ([sim._model.getObjectIDIndex(ObjectType.NODE.value, n.nodeid) for n in Nodes(sim)],
+                       [sim._model.getObjectIDIndex(ObjectType.LINK.value, l.linkid) for l in Links(sim)])
+            next_check, last_volume, equilibrium = start + check, None, False
+            for step in sim:
+                if sim.current_time < next_check:
+                    continue
+                volume = stored_volume(indices)
+                next_check += check
+                if last_volume is not None and abs(volume - last_volume) <= tolerance * max(abs(last_volume), 1e-9):
+                    equilibrium = True
+                    break
+                last_volume = volume
+            days = (sim.current_time - start).total_seconds() / 86400
+    count('spin_ups')
+    return equilibrium, days
+
+class HotstartCache:
+    # Dry-weather hotstart files keyed by model topology (topology_key). Models that differ
+    # only in conduit geometry, like the candidates replace_inp_section writes, reuse one file;
+    # a topology change gives a new key, and spinning it up drops the stale hotstarts made
+    # from the same model file.
+
+    def __init__(self, cache_dir=DEFAULT_HOTSTART_DIR, max_days=30, check_hours=24, tolerance=1e-3):
+        self.cache_dir = cache_dir
+        self.settings = {'max_days': max_days, 'check_hours': check_hours, 'tolerance': tolerance}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, key):
+        return os.path.join(self.cache_dir, f'{key}.hsf'), os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, inp_file_path):
+        # Path of the hotstart for this model's topology, spun up on first use
+        key = topology_key(inp_file_path, self.settings)
+        hotstart_path, meta_path = self._paths(key)
+        if os.path.exists(hotstart_path) and os.path.exists(meta_path):
+            count('hotstart_hits')
+            return hotstart_path
+        count('hotstart_misses')
+
+        tmp = hotstart_path + '.tmp'
+        equilibrium, days = spin_up_hotstart(inp_file_path, tmp, **self.settings)
+        if not equilibrium:
+            logger.warning("Dry-weather spin-up did not settle, saved the last state",
+                           extra={'fields': {'inp': inp_file_path, 'days': round(days, 2)}})
+        os.replace(tmp, hotstart_path)
+        meta = {'inp_file': os.path.abspath(inp_file_path), 'equilibrium': equilibrium, 'days': days}
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        logger.info("Saved dry-weather hotstart", extra={'fields': {'key': key[:12], 'days': round(days, 2)}})
+        self.invalidate(meta['inp_file'], keep=key)
+        return hotstart_path
+
+    def invalidate(self, inp_file, keep=None):
+        # Drop hotstarts spun up from an earlier topology of the same model file
+        for name in os.listdir(self.cache_dir):
+            key, ext = os.path.splitext(name)
+            if ext != '.json' or key == keep:
+                continue
+            with open(os.path.join(self.cache_dir, name)) as f:
+                stale = json.load(f).get('inp_file') == inp_file
+            if stale:
+                for path in self._paths(key):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+def warm_simulation_stats(inp_file_path, window_start=None, window_end=None, cache=None, read_from_out_file=True,
+                          options=None):
+    # Link and node summaries of only the evaluation window, started from the dry-weather
+    # hotstart of the model's topology instead of a cold start at START_DATE. The window
+    # defaults to the model's own START/END dates.
+    cache = cache or HotstartCache()
+    hotstart_path = cache.get(inp_file_path)
+    model = model_options(inp_file_path)
+    window_start = window_start or model_start(inp_file_path)
+    window_end = window_end or f"{model['END_DATE']} {model.get('END_TIME', '00:00:00')}"
+    run_options = dict(window_options(window_start, window_end), **(options or {}))
+
+    with tempfile.TemporaryDirectory(prefix='swmm_warm_') as workdir:
+        warm_inp = rewrite_inp(inp_file_path, os.path.join(workdir, os.path.basename(inp_file_path)), run_options,
+                               files={'USE HOTSTART': hotstart_path, 'SAVE HOTSTART': None})
+        if read_from_out_file:
+            from swmm_out_utils import collect_output_stats
+            return collect_output_stats(warm_inp)
+        from simulation_utils import collect_simulation_stats
+        return collect_simulation_stats(warm_inp)
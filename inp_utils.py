@@ -0,0 +1,203 @@
+import os
+import re
+import shlex
+import numpy as np
+
+def section_name(line):
+    # '[CONDUITS]' -> 'CONDUITS', None for any other line
+    stripped = line.strip()
+    if stripped.startswith('[') and ']' in stripped:
+        return stripped[1:stripped.index(']')].upper()
+    return None
+
+def file_token_position(tokens):
+    # Index of the file name following a FILE keyword ([RAINGAGES] and [TIMESERIES] lines)
+    upper = [t.upper() for t in tokens]
+    if 'FILE' in upper[1:]:
+        pos = upper.index('FILE', 1) + 1
+        if pos < len(tokens):
+            return pos
+    return None
+
+def referenced_files(inp_file_path):
+    # Rainfall and time series files an .inp depends on, resolved relative to the .inp's folder
+    base_dir = os.path.dirname(os.path.abspath(inp_file_path))
+    files = []
+    section = None
+    with open(inp_file_path) as f:
+        for line in f:
+            section = section_name(line) or section
+            data = line.split(';', 1)[0].strip()
+            if not data or data.startswith('[') or section not in ('RAINGAGES', 'TIMESERIES'):
+                continue
+            tokens = shlex.split(data)
+            pos = file_token_position(tokens)
+            if pos is not None:
+                files.append(os.path.join(base_dir, tokens[pos]))
+    return files
+
+def read_section(inp_file_path, section):
+    # Data lines of one section as token lists, comments and blank lines dropped
+    section = section.upper()
+    rows = []
+    current = None
+    with open(inp_file_path, encoding='latin-1') as f:
+        for line in f:
+            current = section_name(line) or current
+            data = line.split(';', 1)[0].strip()
+            if current == section and data and not data.startswith('['):
+                rows.append(shlex.split(data))
+    return rows
+
+def files_key(tokens):
+    # 'USE HOTSTART', 'SAVE OUTFLOWS', ... for a [FILES] line
+    return ' '.join(tokens[:2]).upper()
+
+def rewrite_inp(inp_file_path, new_file_path, options=None, rainfall=None, files=None):
+    # Stream a copy of an .inp that can run from another folder: FILE references become absolute,
+    # rain gages optionally read from a different rainfall file, [OPTIONS] values are overridden
+    # and [FILES] entries ({'USE HOTSTART': path, ...}, None drops the entry) are set
+    base_dir = os.path.dirname(os.path.abspath(inp_file_path))
+    options = {k.upper(): str(v) for k, v in (options or {}).items()}
+    files = {k.upper(): v for k, v in (files or {}).items()}
+    remaining = {'OPTIONS': dict(options), 'FILES': {k: v for k, v in files.items() if v is not None}}
+    section = None
+
+    def flush(dst, section):
+        # Entries that were not in the section are added at its end
+        for key, value in remaining.get(section, {}).items():
+            if section == 'OPTIONS':
+                dst.write(f"{key:<20} {value}\n")
+            else:
+                dst.write(f'{key} "{os.path.abspath(value)}"\n')
+        remaining[section] = {}
+
+    with open(inp_file_path) as src, open(new_file_path, 'w') as dst:
+        for line in src:
+            new_section = section_name(line)
+            if new_section is not None:
+                flush(dst, section)
+                section = new_section
+                dst.write(line)
+                continue
+
+            data = line.split(';', 1)[0].strip()
+            if not data:
+                dst.write(line)
+                continue
+
+            if section == 'OPTIONS':
+                key = data.split()[0].upper()
+                if key in options:
+                    remaining['OPTIONS'].pop(key, None)
+                    line = f"{key:<20} {options[key]}\n"
+            elif section == 'FILES':
+                tokens = shlex.split(data)
+                key = files_key(tokens)
+                if key in files:
+                    if files[key] is None:
+                        continue
+                    remaining['FILES'].pop(key, None)
+                    tokens[2:] = [os.path.abspath(files[key])]
+                elif len(tokens) > 2:
+                    tokens[2] = os.path.join(base_dir, tokens[2])
+                line = f'{key} "{tokens[2]}"\n' if len(tokens) > 2 else line
+            elif section in ('RAINGAGES', 'TIMESERIES'):
+                tokens = shlex.split(data)
+                pos = file_token_position(tokens)
+                if pos is not None:
+                    if section == 'RAINGAGES' and rainfall is not None:
+                        tokens[pos] = os.path.abspath(rainfall)
+                    else:
+                        tokens[pos] = os.path.join(base_dir, tokens[pos])
+                    tokens[pos] = f'"{tokens[pos]}"'
+                    line = ' '.join(tokens) + '\n'
+            dst.write(line)
+
+        flush(dst, section)
+        if remaining['FILES']:
+            dst.write('\n[FILES]\n')
+            flush(dst, 'FILES')
+    return new_file_path
+
+# Field order of the sections the patcher can rewrite; the first field is the element name
+SECTION_FIELDS = {
+    'CONDUITS': ['Name', 'InletNode', 'OutletNode', 'Length', 'Roughness', 'InOffset', 'OutOffset', 'InitFlow', 'MaxFlow'],
+    'XSECTIONS': ['Link', 'Shape', 'Geom1', 'Geom2', 'Geom3', 'Geom4', 'Barrels', 'Culvert'],
+}
+
+def format_value(value):
+    if isinstance(value, (float, np.floating)):
+        return f'{value:.10g}'
+    return str(value)
+
+def same_value(token, value):
+    try:
+        return float(token) == float(value)
+    except (TypeError, ValueError):
+        return token == str(value)
+
+def frame_to_patch(df, section_name):
+    # {element: {field: value}} from a DataFrame indexed by element name, keeping only
+    # columns that are fields of the section
+    fields = [col for col in df.columns if col in SECTION_FIELDS[section_name.upper()][1:]]
+    return {str(name): dict(zip(fields, values)) for name, values in zip(df.index, df[fields].itertuples(index=False))}
+
+def patch_line(line, updates, fields):
+    # Replace only the changed fields of one data line, keeping the column alignment and any comment
+    data, sep, comment = line.partition(';')
+    newline = data[len(data.rstrip('\r\n')):] if not sep else ''
+    parts = re.split(r'(\s+)', data.rstrip('\r\n'))
+    token_positions = [i for i, part in enumerate(parts) if part and not part.isspace()]
+
+    changed = False
+    for field, value in updates.items():
+        pos = fields.index(field)
+        if pos >= len(token_positions):
+            continue
+        i = token_positions[pos]
+        if same_value(parts[i], value):
+            continue
+        new_token = format_value(value)
+        width = len(parts[i]) + (len(parts[i + 1]) if i + 1 < len(parts) else 0)
+        parts[i] = new_token
+        if i + 1 < len(parts):
+            parts[i + 1] = ' ' * max(width - len(new_token), 1)
+        changed = True
+
+    if not changed:
+        return line
+    return ''.join(parts) + newline + sep + comment
+
+def patch_inp(inp_file_path, variants, max_open_files=200):
+    # Stream the source .inp once and write every variant, {new_file_path: {section: {element: {field: value}}}}.
+    # Only lines of patched elements are rewritten; every other line is copied byte for byte.
+    variants = {path: {section.upper(): {str(name): fields for name, fields in patch.items()}
+                       for section, patch in sections.items()}
+                for path, sections in variants.items()}
+    paths = list(variants)
+    bytes_written = 0
+
+    # Bounded batches so hundreds of variants do not exhaust file handles
+    for start in range(0, len(paths), max_open_files):
+        batch = paths[start:start + max_open_files]
+        outputs = [open(path, 'w', encoding='latin-1', newline='') for path in batch]
+        try:
+            section = None
+            with open(inp_file_path, encoding='latin-1', newline='') as src:
+                for line in src:
+                    section = section_name(line) or section
+                    data = line.split(';', 1)[0].split()
+                    patchable = section in SECTION_FIELDS and data and not line.lstrip().startswith('[')
+                    for path, out in zip(batch, outputs):
+                        new_line = line
+                        if patchable:
+                            updates = variants[path].get(section, {}).get(data[0])
+                            if updates:
+                                new_line = patch_line(line, updates, SECTION_FIELDS[section])
+                        out.write(new_line)
+                        bytes_written += len(new_line)
+        finally:
+            for out in outputs:
+                out.close()
+    return bytes_written
@@ -0,0 +1,292 @@
+import os
+import numpy as np
+from profiling_utils import count
+
+# Numeric kernels of the HRT pipeline with two interchangeable backends: vectorized NumPy, always
+# available, and numba-compiled loops running in parallel over conduits, paths and samples.
+# HRT_KERNELS=numpy|numba|auto picks the backend at start-up (numpy when unset, as compiling
+# takes seconds per process), set_backend() at runtime; auto uses numba when it is installed.
+# tests/test_kernel_utils.py checks that the two backends agree.
+BACKENDS = ('numpy', 'numba')
+
+# Kernel shape codes; 0 is a shape without a closed-form area, whose geometry is invalid
+SHAPE_CODES = {'CIRCULAR': 1, 'FORCE_MAIN': 1, 'RECT_CLOSED': 2, 'RECT_OPEN': 2, 'TRAPEZOIDAL': 3, 'TRIANGULAR': 4}
+# Bisection steps for the circular segment angle; 2*pi / 2**60 is below double precision
+THETA_STEPS = 60
+# Depths this far above the full depth (a full pipe reported at exactly its diameter) stay valid
+FULL_DEPTH_TOLERANCE = 1e-6
+
+_STATE = {'backend': None, 'numba': None}
+
+def numba_available():
+    try:
+        import numba
+    except ImportError:
+        return False
+    return True
+
+def set_backend(name='auto'):
+    name = name.lower()
+    if name == 'auto':
+        name = 'numba' if numba_available() else 'numpy'
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown kernel backend '{name}', expected one of {BACKENDS} or 'auto'")
+    if name == 'numba' and not numba_available():
+        raise ImportError("The numba kernel backend needs numba (pip install numba)")
+    _STATE['backend'] = name
+    return name
+
+def backend():
+    if _STATE['backend'] is None:
+        set_backend(os.environ.get('HRT_KERNELS', 'numpy'))
+    return _STATE['backend']
+
+def shape_codes(shape, n):
+    shape = np.broadcast_to(np.asarray(shape, dtype=object), (n,))
+    return np.array([SHAPE_CODES.get(str(s).upper(), 0) for s in shape], dtype=np.int8)
+
+def _per_conduit(n, *values):
+    return [np.ascontiguousarray(np.broadcast_to(np.asarray(v, dtype=float), (n,))) for v in values]
+
+# NumPy backend
+
+def _numpy_section_geometry(depth, code, geom1, geom2, geom3, geom4, barrels):
+    theta = np.full(depth.shape, np.nan)
+    flow_area = np.full(depth.shape, np.nan)
+
+    valid = np.isfinite(depth) & (depth >= 0) & (geom1 > 0)
+    valid &= depth <= geom1 * (1 + FULL_DEPTH_TOLERANCE)
+    y = np.clip(np.nan_to_num(depth), 0, np.where(geom1 > 0, geom1, 0))
+
+    circ = code == 1
+    radius = geom1[circ] / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        theta[..., circ] = 2*np.arccos(np.clip((radius - y[..., circ]) / radius, -1, 1))
+    flow_area[..., circ] = (radius**2 * (theta[..., circ] - np.sin(theta[..., circ]))) / 2
+
+    rect = code == 2
+    flow_area[..., rect] = geom2[rect] * y[..., rect]
+    valid[..., rect] &= geom2[rect] > 0
+
+    # geom2 is the bottom width, geom3/geom4 the side slopes (run/rise)
+    trap = code == 3
+    flow_area[..., trap] = y[..., trap] * (geom2[trap] + y[..., trap] * (geom3[trap] + geom4[trap]) / 2)
+
+    # geom2 is the top width at full depth geom1
+    tri = code == 4
+    with np.errstate(invalid='ignore', divide='ignore'):
+        flow_area[..., tri] = y[..., tri]**2 * geom2[tri] / geom1[tri] / 2
+
+    valid &= code > 0
+    flow_area = flow_area * np.where(np.isfinite(barrels) & (barrels > 0), barrels, 1)
+    return theta, flow_area, valid
+
+def _numpy_section_depth(area, code, geom1, geom2, geom3, geom4, barrels):
+    per_barrel = area / np.where(np.isfinite(barrels) & (barrels > 0), barrels, 1)
+    depth = np.full(area.shape, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Segment angle from theta - sin(theta) = 2 A / r^2, monotone on [0, 2 pi]
+        circ = code == 1
+        radius = geom1[circ] / 2
+        target = 2 * per_barrel[..., circ] / radius**2
+        low, high = np.zeros(target.shape), np.full(target.shape, 2 * np.pi)
+        for _ in range(THETA_STEPS):
+            mid = (low + high) / 2
+            below = mid - np.sin(mid) < target
+            low, high = np.where(below, mid, low), np.where(below, high, mid)
+        depth[..., circ] = radius * (1 - np.cos((low + high) / 4))
+
+        rect = code == 2
+        depth[..., rect] = per_barrel[..., rect] / geom2[rect]
+
+        trap = code == 3
+        slope = (geom3[trap] + geom4[trap]) / 2
+        a = per_barrel[..., trap]
+        depth[..., trap] = np.where(slope > 0, (np.sqrt(geom2[trap]**2 + 4 * slope * a) - geom2[trap]) / (2 * slope),
+                                    a / geom2[trap])
+
+        tri = code == 4
+        depth[..., tri] = np.sqrt(2 * per_barrel[..., tri] * geom1[tri] / geom2[tri])
+
+    # Areas beyond the full section have no depth
+    full = _numpy_section_geometry(np.broadcast_to(geom1, area.shape).copy(), code, geom1, geom2, geom3, geom4,
+                                   np.ones_like(barrels))[1]
+    valid = np.isfinite(per_barrel) & (per_barrel >= 0) & (per_barrel <= full * (1 + FULL_DEPTH_TOLERANCE)) & (code > 0)
+    depth[~valid] = np.nan
+    return depth
+
+def _numpy_path_sums(path_ptr, path_edges, values):
+    # Sum per path over its CSR edges; a missing edge (-1) or a NaN value gives NaN
+    n_paths = len(path_ptr) - 1
+    owner = np.repeat(np.arange(n_paths), np.diff(path_ptr))
+    if values.ndim == 1:
+        padded = np.append(values, np.nan)
+        return np.bincount(owner, weights=padded[path_edges], minlength=n_paths)
+    # Samples x conduits: (paths x conduits) sparse incidence times (conduits x samples)
+    from scipy import sparse
+    known = path_edges >= 0
+    incidence = sparse.csr_matrix((np.ones(known.sum()), (owner[known], path_edges[known])),
+                                  shape=(n_paths, values.shape[1]))
+    totals = (incidence @ np.nan_to_num(values.T, nan=0.0)).T
+    invalid = (incidence @ np.isnan(values.T).astype(float)).T > 0
+    missing_edge = np.bincount(owner[~known], minlength=n_paths) > 0
+    totals[invalid | missing_edge] = np.nan
+    return totals
+
+# numba backend, compiled on first use
+
+def _numba_kernels():
+    if _STATE['numba'] is not None:
+        return _STATE['numba']
+    from numba import njit, prange
+
+    @njit(error_model='numpy')
+    def area_one(y, code, g1, g2, g3, g4):
+        if code == 1:
+            r = g1 / 2
+            c = (r - y) / r
+            if c < -1.0:
+                c = -1.0
+            elif c > 1.0:
+                c = 1.0
+            theta = 2*np.arccos(c)
+            return theta, r**2 * (theta - np.sin(theta)) / 2
+        if code == 2:
+            return np.nan, g2 * y
+        if code == 3:
+            return np.nan, y * (g2 + y * (g3 + g4) / 2)
+        if code == 4:
+            return np.nan, y**2 * g2 / g1 / 2
+        return np.nan, np.nan
+
+    @njit(parallel=True, error_model='numpy')
+    def section_geometry(depth, code, g1, g2, g3, g4, barrels):
+        rows, n = depth.shape
+        theta = np.empty((rows, n))
+        area = np.empty((rows, n))
+        valid = np.empty((rows, n), dtype=np.bool_)
+        for j in prange(n):
+            b = barrels[j] if np.isfinite(barrels[j]) and barrels[j] > 0 else 1.0
+            top = g1[j] if g1[j] > 0 else 0.0
+            for i in range(rows):
+                d = depth[i, j]
+                # As np.nan_to_num then clip: NaN counts as empty, +inf as full
+                y = min(max(d if d == d else 0.0, 0.0), top)
+                theta[i, j], a = area_one(y, code[j], g1[j], g2[j], g3[j], g4[j])
+                area[i, j] = a * b
+                ok = np.isfinite(d) and d >= 0 and g1[j] > 0 and d <= g1[j] * (1 + FULL_DEPTH_TOLERANCE) and code[j] > 0
+                valid[i, j] = ok and (code[j] != 2 or g2[j] > 0)
+        return theta, area, valid
+
+    @njit(parallel=True, error_model='numpy')
+    def section_depth(area, code, g1, g2, g3, g4, barrels):
+        rows, n = area.shape
+        depth = np.empty((rows, n))
+        for j in prange(n):
+            b = barrels[j] if np.isfinite(barrels[j]) and barrels[j] > 0 else 1.0
+            full = area_one(g1[j] if g1[j] > 0 else 0.0, code[j], g1[j], g2[j], g3[j], g4[j])[1]
+            for i in range(rows):
+                a = area[i, j] / b
+                if not (np.isfinite(a) and a >= 0 and a <= full * (1 + FULL_DEPTH_TOLERANCE) and code[j] > 0):
+                    depth[i, j] = np.nan
+                elif code[j] == 1:
+                    r = g1[j] / 2
+                    target = 2 * a / r**2
+                    low, high = 0.0, 2 * np.pi
+                    for _ in range(THETA_STEPS):
+                        mid = (low + high) / 2
+                        if mid - np.sin(mid) < target:
+                            low = mid
+                        else:
+                            high = mid
+                    depth[i, j] = r * (1 - np.cos((low + high) / 4))
+                elif code[j] == 2:
+                    depth[i, j] = a / g2[j]
+                elif code[j] == 3:
+                    slope = (g3[j] + g4[j]) / 2
+                    if slope > 0:
+                        depth[i, j] = (np.sqrt(g2[j]**2 + 4 * slope * a) - g2[j]) / (2 * slope)
+                    else:
+                        depth[i, j] = a / g2[j]
+                else:
+                    depth[i, j] = np.sqrt(2 * a * g1[j] / g2[j])
+        return depth
+
+    @njit(parallel=True, error_model='numpy')
+    def length_for_HRT(target_hrt, mean_flow, flow_area):
+        lengths = np.empty(len(target_hrt))
+        for i in prange(len(target_hrt)):
+            lengths[i] = target_hrt[i] * 3600 * mean_flow[i] / flow_area[i]
+        return lengths
+
+    @njit(parallel=True, error_model='numpy')
+    def path_sums(path_ptr, path_edges, values):
+        rows = values.shape[0]
+        n_paths = len(path_ptr) - 1
+        totals = np.empty((rows, n_paths))
+        for i in prange(rows):
+            for p in range(n_paths):
+                total = 0.0
+                for k in range(path_ptr[p], path_ptr[p + 1]):
+                    e = path_edges[k]
+                    total += values[i, e] if e >= 0 else np.nan
+                totals[i, p] = total
+        return totals
+
+    _STATE['numba'] = {'section_geometry': section_geometry, 'section_depth': section_depth,
+                       'length_for_HRT': length_for_HRT, 'path_sums': path_sums}
+    return _STATE['numba']
+
+# Dispatch
+
+def _rows(values, n):
+    # (rows x n) contiguous view of a (..., n) array and the shape to restore
+    values = np.asarray(values, dtype=float)
+    return np.ascontiguousarray(values.reshape(-1, n)), values.shape
+
+def section_geometry(depth, shape, geom1, geom2=0.0, geom3=0.0, geom4=0.0, barrels=1, backend_name=None):
+    # Segment angle (NaN for non-circular shapes), wetted area and validity of every
+    # (..., conduits) depth, the geometry given per conduit
+    depth = np.asarray(depth, dtype=float)
+    n = depth.shape[-1]
+    code = shape_codes(shape, n)
+    geometry = _per_conduit(n, geom1, geom2, geom3, geom4, barrels)
+    if (backend_name or backend()) == 'numba':
+        flat, restore = _rows(depth, n)
+        theta, area, valid = _numba_kernels()['section_geometry'](flat, code, *geometry)
+        count('numba_kernel_calls')
+        return theta.reshape(restore), area.reshape(restore), valid.reshape(restore)
+    return _numpy_section_geometry(depth, code, *geometry)
+
+def section_depth(area, shape, geom1, geom2=0.0, geom3=0.0, geom4=0.0, barrels=1, backend_name=None):
+    # Depth at which each conduit's wetted area is area (the inverse of section_geometry);
+    # NaN for areas beyond the full section or unsupported shapes
+    area = np.asarray(area, dtype=float)
+    n = area.shape[-1]
+    code = shape_codes(shape, n)
+    geometry = _per_conduit(n, geom1, geom2, geom3, geom4, barrels)
+    if (backend_name or backend()) == 'numba':
+        flat, restore = _rows(area, n)
+        count('numba_kernel_calls')
+        return _numba_kernels()['section_depth'](flat, code, *geometry).reshape(restore)
+    return _numpy_section_depth(area, code, *geometry)
+
+def length_for_HRT(target_hrt, mean_flow, flow_area, backend_name=None):
+    # Conduit length whose volume holds target_hrt hours of mean_flow at the given wetted area
+    target_hrt, mean_flow, flow_area = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (target_hrt, mean_flow, flow_area)))
+    if (backend_name or backend()) == 'numba':
+        flat = [np.ascontiguousarray(v.reshape(-1)) for v in (target_hrt, mean_flow, flow_area)]
+        count('numba_kernel_calls')
+        return _numba_kernels()['length_for_HRT'](*flat).reshape(target_hrt.shape)
+    return target_hrt * 3600 * mean_flow / flow_area
+
+def path_sums(path_ptr, path_edges, values, backend_name=None):
+    # Per-path sums of per-conduit values over CSR paths (path_edge_arrays); values is (conduits,)
+    # or (samples x conduits). Missing edges (-1) and NaN values give NaN.
+    values = np.asarray(values, dtype=float)
+    if (backend_name or backend()) == 'numba':
+        flat = np.ascontiguousarray(values.reshape(-1, values.shape[-1]))
+        totals = _numba_kernels()['path_sums'](np.asarray(path_ptr, dtype=np.int64), np.asarray(path_edges, dtype=np.int64), flat)
+        count('numba_kernel_calls')
+        return totals[0] if values.ndim == 1 else totals
+    return _numpy_path_sums(path_ptr, path_edges, values)
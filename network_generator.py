@@ -0,0 +1,232 @@
+import numpy as np
+import pandas as pd
+
+# Pipe sizes (ft) conduits are rounded up to, and the share of full-pipe capacity they are sized for
+PIPE_SIZES = np.array([0.5, 0.75, 1.0, 1.25, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 5.0, 6.0, 7.0, 8.0, 10.0])
+DESIGN_CAPACITY_RATIO = 0.7
+
+def full_pipe_flow(diameter, roughness=0.013, slope=0.005):
+    # Manning full-pipe capacity of a circular pipe in CFS
+    return 1.49 / roughness * (np.pi / 4) * (diameter / 4) ** (2 / 3) * diameter**2 * np.sqrt(slope)
+
+def generate_network(n_conduits, n_outfalls=3, loop_fraction=0.0, subcatchment_fraction=0.2, seed=0):
+    # Random collection network with n_conduits conduits draining to n_outfalls outfalls.
+    # Each outfall gets a random recursive tree of junctions (every new junction drains to a
+    # random earlier one of its tree); loop_fraction of the conduits are extra links from a
+    # junction to any lower junction, possibly in another tree, so some nodes reach several
+    # outfalls. Every conduit runs downhill, so the network stays acyclic.
+    rng = np.random.default_rng(seed)
+    n_loops = int(round(n_conduits * loop_fraction))
+    n_junctions = n_conduits - n_loops
+
+    # Junction i belongs to tree i % n_outfalls; position 0 of each tree drains to the outfall
+    tree = np.arange(n_junctions) % n_outfalls
+    position = np.arange(n_junctions) // n_outfalls
+    parent_position = np.floor(rng.random(n_junctions) * position).astype(np.int64)
+    parent = np.where(position == 0, -1 - tree, parent_position * n_outfalls + tree)
+
+    junctions = np.array([f'node_{i}' for i in range(n_junctions)], dtype=object)
+    outfalls = np.array([f'outfall_{k}' for k in range(n_outfalls)], dtype=object)
+    length = np.round(rng.uniform(50.0, 500.0, n_junctions), 1)
+    slope = rng.uniform(0.002, 0.02, n_junctions)
+
+    # Parents come before their children, so inverts fill in one pass from the outfalls up
+    outfall_invert = rng.uniform(900.0, 950.0, n_outfalls)
+    invert = np.empty(n_junctions)
+    for i in range(n_junctions):
+        base = outfall_invert[-1 - parent[i]] if parent[i] < 0 else invert[parent[i]]
+        invert[i] = base + slope[i] * length[i]
+
+    inlet = junctions
+    outlet = np.where(parent < 0, outfalls[np.maximum(-1 - parent, 0)], junctions[np.maximum(parent, 0)])
+
+    # Extra downhill links between junctions, without duplicating an existing edge
+    existing = set(zip(inlet, outlet))
+    loop_in, loop_out = [], []
+    while len(loop_in) < n_loops and n_junctions > 1:
+        u = rng.integers(0, n_junctions, 4 * n_loops + 16)
+        v = rng.integers(0, n_junctions, 4 * n_loops + 16)
+        for a, b in zip(u, v):
+            edge = (junctions[a], junctions[b])
+            if invert[b] < invert[a] and edge not in existing:
+                existing.add(edge)
+                loop_in.append(edge[0])
+                loop_out.append(edge[1])
+                if len(loop_in) == n_loops:
+                    break
+    loop_length = np.round(rng.uniform(50.0, 500.0, len(loop_in)), 1)
+
+    conduits = pd.DataFrame({
+        'Name': [f'cond_{i}' for i in range(n_junctions + len(loop_in))],
+        'InletNode': np.concatenate([inlet, np.array(loop_in, dtype=object)]),
+        'OutletNode': np.concatenate([outlet, np.array(loop_out, dtype=object)]),
+        'Length': np.concatenate([length, loop_length]),
+        'Roughness': 0.013,
+    })
+
+    nodes = pd.DataFrame({
+        'Name': np.concatenate([junctions, outfalls]),
+        'InvertElev': np.round(np.concatenate([invert, outfall_invert]), 3),
+        'Outfall': np.concatenate([np.zeros(n_junctions, dtype=bool), np.ones(n_outfalls, dtype=bool)]),
+        'X': np.round(rng.uniform(0.0, 10000.0, n_junctions + n_outfalls), 2),
+        'Y': np.round(rng.uniform(0.0, 10000.0, n_junctions + n_outfalls), 2),
+    })
+
+    n_sub = max(int(round(n_junctions * subcatchment_fraction)), 1)
+    sub_outlet = junctions[np.sort(rng.choice(n_junctions, n_sub, replace=False))]
+    subcatchments = pd.DataFrame({
+        'Name': [f'sc_{i}' for i in range(n_sub)],
+        'Outlet': sub_outlet,
+        'Area': np.round(rng.uniform(1.0, 20.0, n_sub), 2),
+        'PercImperv': np.round(rng.uniform(10.0, 60.0, n_sub), 1),
+    })
+
+    network = {'conduits': conduits, 'nodes': nodes, 'subcatchments': subcatchments,
+               'outfalls': outfalls.tolist(), 'seed': seed}
+    network['xsections'] = size_conduits(network)
+    return network
+
+def route_flows(network, runoff_per_acre=0.05, base_flow=0.01):
+    # Steady flow in every conduit: subcatchment runoff plus a small dry-weather base flow at
+    # every junction, accumulated downstream and split evenly where a node has several outlets
+    conduits, nodes = network['conduits'], network['nodes']
+    node_pos = {name: pos for pos, name in enumerate(nodes['Name'])}
+    inlet = conduits['InletNode'].map(node_pos).to_numpy()
+    outlet = conduits['OutletNode'].map(node_pos).to_numpy()
+
+    inflow = np.where(nodes['Outfall'].to_numpy(), 0.0, base_flow)
+    sub = network['subcatchments']
+    np.add.at(inflow, sub['Outlet'].map(node_pos).to_numpy(), sub['Area'].to_numpy() * runoff_per_acre)
+
+    out_degree = np.bincount(inlet, minlength=len(nodes))
+    order = np.argsort(-nodes['InvertElev'].to_numpy(), kind='stable')
+    by_inlet = np.argsort(inlet, kind='stable')
+    first = np.searchsorted(inlet[by_inlet], np.arange(len(nodes) + 1))
+
+    flow = np.zeros(len(conduits))
+    for node in order:
+        if out_degree[node] == 0:
+            continue
+        links = by_inlet[first[node]:first[node + 1]]
+        flow[links] = inflow[node] / out_degree[node]
+        np.add.at(inflow, outlet[links], flow[links])
+    return flow
+
+def size_conduits(network):
+    # Smallest circular pipe whose capacity at a nominal slope carries the routed flow
+    flow = route_flows(network)
+    size_index = np.searchsorted(full_pipe_flow(PIPE_SIZES), flow / DESIGN_CAPACITY_RATIO)
+    size = PIPE_SIZES[np.minimum(size_index, len(PIPE_SIZES) - 1)]
+    return pd.DataFrame({
+        'Link': network['conduits']['Name'],
+        'Shape': 'CIRCULAR',
+        'Geom1': size,
+        'Geom2': 0.0,
+        'Geom3': 0.0,
+        'Geom4': 0.0,
+        'Barrels': 1,
+    })
+
+def synthetic_summary(network, seed=0):
+    # Deterministic stand-ins for the simulation results, so the HRT pipeline can be driven
+    # without a SWMM engine. Returns the links stats frame (cond_name, mean/min/max/var of flow
+    # and depth) and the link table (swmmio layout, indexed by Name) the pipeline merges with.
+    rng = np.random.default_rng(seed)
+    conduits, xsections = network['conduits'], network['xsections']
+    flow = route_flows(network) * rng.uniform(0.9, 1.1, len(conduits))
+    diameter = xsections['Geom1'].to_numpy()
+    # Depth grows roughly with the square root of the capacity used
+    depth_ratio = np.clip(np.sqrt(flow / full_pipe_flow(diameter)) * rng.uniform(0.8, 1.0, len(conduits)), 0.05, 0.95)
+    depth = depth_ratio * diameter
+
+    links = pd.DataFrame({'cond_name': conduits['Name'].to_numpy()})
+    for var, mean in (('flow', flow), ('depth', depth)):
+        links[f'mean_{var}'] = mean
+        links[f'min_{var}'] = mean * 0.5
+        links[f'max_{var}'] = mean * 1.5
+        links[f'var_{var}'] = (mean * 0.2) ** 2
+
+    link_table = conduits.merge(xsections, left_on='Name', right_on='Link').drop(columns=['Link']).set_index('Name')
+    return links, link_table
+
+def synthetic_conduit_frames(network, seed=0):
+    # synthetic_summary merged with the conduit inlets, outlets and lengths as the calibration
+    # script merges a simulation's (cond_df_merged), and the link table
+    links, link_table = synthetic_summary(network, seed)
+    cond_summary = link_table[['InletNode', 'OutletNode', 'Length']].rename(
+        columns={'InletNode': 'Inlet_Node', 'OutletNode': 'Outlet_Node', 'Length': 'cond_length'})
+    cond_df_merged = pd.merge(links, cond_summary, left_on='cond_name', right_on='Name', how='left')
+    return cond_df_merged, link_table
+
+def synthetic_pipeline(n_conduits, seed=0, inp_file_path=None, **network_kwargs):
+    # A generated network and the frames the HRT pipeline starts from: the merged conduit summary,
+    # the link table, the conduit HRTs (merged_df indexed as calibration_HRT.py indexes it, new_df
+    # flat), node IDs and outfalls; with inp_file_path the network is also written there
+    from calibration_HRT_utils import calculate_HRT
+    network = generate_network(n_conduits, seed=seed, **network_kwargs)
+    cond_df_merged, link_table = synthetic_conduit_frames(network, seed)
+    merged_df = pd.concat([cond_df_merged, calculate_HRT(cond_df_merged, link_table)], axis=1).set_index(
+        ['cond_name', 'Inlet_Node', 'Outlet_Node'])
+    return {'network': network, 'link_table': link_table, 'cond_df_merged': cond_df_merged,
+            'merged_df': merged_df, 'new_df': merged_df.reset_index(),
+            'node_ids': network['nodes']['Name'].tolist(), 'outfalls': network['outfalls'],
+            'inp_file_path': write_network_inp(network, inp_file_path) if inp_file_path else None}
+
+def synthetic_targets(path_hrt_df, network, spread=0.3, seed=0):
+    # Subcatchment and WWTP labels for a path table plus per-subcatchment target HRTs within
+    # +/- spread of the current path HRT, in the shape calibrate_HRT and solve_conduit_lengths take
+    rng = np.random.default_rng(seed)
+    sub = network['subcatchments']
+    sc_of_node = sub.groupby('Outlet')['Name'].first()
+    path_hrt_df = path_hrt_df.copy()
+    path_hrt_df['Subcatchments'] = path_hrt_df['Start_Node'].map(sc_of_node)
+    path_hrt_df['WWTP'] = path_hrt_df['End_Node']
+
+    labelled = path_hrt_df.dropna(subset=['Subcatchments']).drop_duplicates('Subcatchments')
+    median_HRT_df = pd.DataFrame({
+        'sc.id': labelled['Subcatchments'].to_numpy(),
+        'sc_median_hrt': labelled['Total_HRT'].to_numpy() * rng.uniform(1 - spread, 1 + spread, len(labelled)),
+    })
+    return path_hrt_df, median_HRT_df
+
+def write_network_inp(network, inp_file_path, duration_hours=6):
+    # Minimal runnable SWMM model: one rain gage with a triangular storm. Kinematic wave
+    # routing only allows one outlet link per node, so looped networks use dynamic wave.
+    conduits, nodes, xsections, sub = network['conduits'], network['nodes'], network['xsections'], network['subcatchments']
+    routing = 'DYNWAVE' if conduits['InletNode'].duplicated().any() else 'KINWAVE'
+    junctions, outfalls = nodes[~nodes['Outfall']], nodes[nodes['Outfall']]
+
+    def rows(frame, fmt):
+        return ''.join(fmt.format(*values) + '\n' for values in frame.itertuples(index=False))
+
+    storm = [0.0, 0.25, 0.5, 0.8, 0.4, 0.1, 0.0]
+    with open(inp_file_path, 'w') as f:
+        f.write(f"[TITLE]\nSynthetic network seed={network['seed']} conduits={len(conduits)}\n\n")
+        f.write("[OPTIONS]\n"
+                "FLOW_UNITS           CFS\n"
+                "INFILTRATION         HORTON\n"
+                f"FLOW_ROUTING         {routing}\n"
+                "START_DATE           01/01/2000\n"
+                "START_TIME           00:00:00\n"
+                "REPORT_START_DATE    01/01/2000\n"
+                "REPORT_START_TIME    00:00:00\n"
+                "END_DATE             01/01/2000\n"
+                f"END_TIME             {duration_hours:02d}:00:00\n"
+                "REPORT_STEP          00:15:00\n"
+                "WET_STEP             00:05:00\n"
+                "DRY_STEP             01:00:00\n"
+                f"ROUTING_STEP         {5 if routing == 'DYNWAVE' else 30}\n\n")
+        f.write("[RAINGAGES]\nRG1              INTENSITY 1:00     1.0      TIMESERIES TS1\n\n")
+        f.write("[SUBCATCHMENTS]\n" + rows(sub[['Name', 'Outlet', 'Area', 'PercImperv']],
+                                           "{:<16} RG1              {:<16} {:<8} {:<8} 500      0.01     0") + "\n")
+        f.write("[SUBAREAS]\n" + rows(sub[['Name']], "{:<16} 0.013      0.10       0.05       0.05       25         OUTLET") + "\n")
+        f.write("[INFILTRATION]\n" + rows(sub[['Name']], "{:<16} 3.0        0.5        4          7          0") + "\n")
+        f.write("[JUNCTIONS]\n" + rows(junctions[['Name', 'InvertElev']], "{:<16} {:<10} 15         0          0          0") + "\n")
+        f.write("[OUTFALLS]\n" + rows(outfalls[['Name', 'InvertElev']], "{:<16} {:<10} FREE                          NO") + "\n")
+        f.write("[CONDUITS]\n" + rows(conduits[['Name', 'InletNode', 'OutletNode', 'Length', 'Roughness']],
+                                      "{:<16} {:<16} {:<16} {:<10} {:<10} 0          0          0          0") + "\n")
+        f.write("[XSECTIONS]\n" + rows(xsections, "{:<16} {:<12} {:<16} {:<10} {:<10} {:<10} {:<10}") + "\n")
+        f.write("[TIMESERIES]\n" + ''.join(f"TS1                         {h}:00       {v}\n" for h, v in enumerate(storm)) + "\n")
+        f.write("[REPORT]\nSUBCATCHMENTS ALL\nNODES ALL\nLINKS ALL\n\n")
+        f.write("[COORDINATES]\n" + rows(nodes[['Name', 'X', 'Y']], "{:<16} {:<16} {:<16}") + "\n")
+    return inp_file_path
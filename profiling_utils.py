@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+LOGGER_NAME = 'hrt'
+
+def get_logger(name=None):
+    # Module loggers hang off one 'hrt' root so a single call configures the whole pipeline
+    return logging.getLogger(LOGGER_NAME if name is None else f"{LOGGER_NAME}.{name}")
+
+class StructuredFormatter(logging.Formatter):
+    # One line per record: plain 'time level logger message key=value' or a JSON object
+
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if self.json_lines:
+            entry = {'time': round(record.created, 3), 'level': record.levelname,
+                     'logger': record.name, 'message': record.getMessage(), **fields}
+            return json.dumps(entry, default=str)
+        extra = ' '.join(f"{key}={value}" for key, value in fields.items())
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name} {record.getMessage()}"
+        return f"{line} {extra}" if extra else line
+
+def configure_logging(level='INFO', json_lines=False, stream=None):
+    logger = get_logger()
+    logger.setLevel(level)
+    logger.handlers.clear()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(StructuredFormatter(json_lines))
+    logger.addHandler(handler)
+    logger.propagate = False
+    return logger
+
+class Profiler:
+    # Phase timers and counters for one run. Phases nest and are recorded as complete events,
+    # so a run can be dumped as a JSON summary or loaded into chrome://tracing / Perfetto.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.totals = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, **fields):
+        logger = get_logger('profile')
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.events.append({'name': name, 'ph': 'X', 'ts': (start - self.origin) * 1e6,
+                                    'dur': elapsed * 1e6, 'pid': os.getpid(),
+                                    'tid': threading.get_ident(), 'args': fields})
+                calls, total = self.totals.get(name, (0, 0.0))
+                self.totals[name] = (calls + 1, total + elapsed)
+            logger.debug("phase done", extra={'fields': {'phase': name, 'seconds': round(elapsed, 6), **fields}})
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        return {
+            'phases': {name: {'calls': calls, 'seconds': total} for name, (calls, total) in self.totals.items()},
+            'counters': dict(self.counters),
+        }
+
+    def log_summary(self, level=logging.INFO):
+        logger = get_logger('profile')
+        for name, (calls, total) in sorted(self.totals.items(), key=lambda item: -item[1][1]):
+            logger.log(level, "phase total", extra={'fields': {'phase': name, 'calls': calls, 'seconds': round(total, 6)}})
+        if self.counters:
+            logger.log(level, "counters", extra={'fields': dict(self.counters)})
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def export_chrome_trace(self, path):
+        counters = [{'name': name, 'ph': 'C', 'ts': (time.perf_counter() - self.origin) * 1e6,
+                     'pid': os.getpid(), 'args': {name: value}} for name, value in self.counters.items()]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events + counters, 'displayTimeUnit': 'ms'}, f)
+
+# Shared profiler for the pipeline modules
+PROFILER = Profiler()
+
+def phase(name, **fields):
+    return PROFILER.phase(name, **fields)
+
+def count(name, n=1):
+    PROFILER.count(name, n)
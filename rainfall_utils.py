@@ -0,0 +1,189 @@
+import os
+import numpy as np
+import pandas as pd
+from hotstart_utils import window_options
+from profiling_utils import get_logger, phase, count
+
+logger = get_logger('rainfall')
+
+# SWMM user-prepared rainfall file layout, as read by concp_WPG_Precip_FlowPlot.R
+PRECIP_COLUMNS = ['station', 'year', 'month', 'day', 'hour', 'minute', 'precip']
+
+def iter_precip(precip_path, skip_rows=1, chunk_rows=500000):
+    # Stream the rainfall file as (station, timestamp, precip) frames of at most chunk_rows records
+    reader = pd.read_csv(precip_path, sep=r'\s+', header=None, names=PRECIP_COLUMNS, comment=';',
+                         skiprows=skip_rows, dtype={'station': str}, chunksize=chunk_rows)
+    for chunk in reader:
+        times = pd.to_datetime(chunk[['year', 'month', 'day', 'hour', 'minute']])
+        yield pd.DataFrame({'station': chunk['station'].to_numpy(), 'time': times.to_numpy(dtype='datetime64[ns]'),
+                            'precip': chunk['precip'].to_numpy(dtype=float)})
+
+class _StationEvents:
+    # Wet spells of one gage, built chunk by chunk; the last one stays open until a
+    # dry gap longer than the inter-event time or the end of the file closes it
+    def __init__(self):
+        self.closed = []
+        self.open = None
+        self.last_time = None
+        self.interval = None
+
+    def add(self, times, precip, dry_ns):
+        if self.last_time is not None:
+            times_all = np.concatenate([[self.last_time], times])
+        else:
+            times_all = times
+        steps = np.diff(times_all)
+        steps = steps[steps > 0]
+        if len(steps):
+            step = steps.min()
+            self.interval = step if self.interval is None else min(self.interval, step)
+        if len(times):
+            self.last_time = times[-1]
+
+        wet = precip > 0
+        times, precip = times[wet], precip[wet]
+        if len(times) == 0:
+            return
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(times) > dry_ns) + 1])
+        depth = np.add.reduceat(precip, starts)
+        peak = np.maximum.reduceat(precip, starts)
+        ends = np.concatenate([starts[1:], [len(times)]]) - 1
+        records = np.diff(np.concatenate([starts, [len(times)]]))
+
+        spells = [[times[s], times[e], d, p, n] for s, e, d, p, n in zip(starts, ends, depth, peak, records)]
+        if self.open is not None and spells[0][0] - self.open[1] <= dry_ns:
+            first = spells.pop(0)
+            self.open = [self.open[0], first[1], self.open[2] + first[2], max(self.open[3], first[3]), self.open[4] + first[4]]
+        if spells:
+            if self.open is not None:
+                self.closed.append(self.open)
+            self.closed.extend(spells[:-1])
+            self.open = spells[-1]
+
+    def finish(self):
+        if self.open is not None:
+            self.closed.append(self.open)
+            self.open = None
+        return self.closed
+
+def rainfall_events(precip_path, min_dry_hours=6, min_depth=0.0, skip_rows=1, chunk_rows=500000):
+    # Wet-weather events of a SWMM rainfall file: wet records of every gage closer than
+    # min_dry_hours form one spell, and spells of all gages that overlap or are less than
+    # min_dry_hours apart form one event. The file is read chunk by chunk, so its size is
+    # not limited by memory. An event ends one recording interval after its last wet record.
+    dry_ns = np.int64(pd.Timedelta(hours=min_dry_hours).value)
+    stations = {}
+    with phase('rainfall_parse', file=os.path.basename(precip_path)):
+        for chunk in iter_precip(precip_path, skip_rows, chunk_rows):
+            count('rainfall_records', len(chunk))
+            for station, records in chunk.groupby('station', sort=False):
+                records = records.sort_values('time', kind='stable')
+                stations.setdefault(station, _StationEvents()).add(
+                    records['time'].to_numpy(dtype='datetime64[ns]').astype(np.int64), records['precip'].to_numpy(), dry_ns)
+
+    spells = []
+    for station, state in stations.items():
+        interval = state.interval or 0
+        for start, last, depth, peak, records in state.finish():
+            spells.append((station, start, last + interval, depth, peak, records))
+    columns = ['station', 'start', 'end', 'depth', 'peak', 'records']
+    spells = pd.DataFrame(spells, columns=columns).sort_values('start', kind='stable')
+
+    # Union of the gages' spells with the same inter-event dry time
+    start = spells['start'].to_numpy(dtype=np.int64)
+    end = spells['end'].to_numpy(dtype=np.int64)
+    reach = np.maximum.accumulate(end) if len(end) else end
+    new_event = np.concatenate([[True], start[1:] - reach[:-1] > dry_ns]) if len(start) else np.zeros(0, dtype=bool)
+    spells['event'] = np.cumsum(new_event) - 1
+
+    grouped = spells.groupby('event')
+    events = pd.DataFrame({
+        'start': pd.to_datetime(grouped['start'].min()),
+        'end': pd.to_datetime(grouped['end'].max()),
+        # Depth and peak of the wettest gage
+        'depth': grouped['depth'].max(),
+        'peak': grouped['peak'].max(),
+        'stations': grouped['station'].nunique(),
+    }).reset_index(drop=True)
+    events['duration_hours'] = (events['end'] - events['start']).dt.total_seconds() / 3600
+    events = events[events['depth'] >= min_depth].reset_index(drop=True)
+    events.insert(0, 'event', [f'event_{i}' for i in range(len(events))])
+    logger.info("Rainfall events", extra={'fields': {'events': len(events), 'stations': len(stations),
+                                                    'wet_hours': float(events['duration_hours'].sum())}})
+    return events
+
+def event_windows(events, spin_up_hours=24, tail_hours=12):
+    # Simulation window of each event: antecedent spin-up before it, and a tail after it for the
+    # network to drain. Statistics are reported from the event start, so the spin-up only sets
+    # the initial state. A tail longer than the dry gap to the next event stops at that event's
+    # start, so no hour is reported (and weighted in merge_event_stats) by two events.
+    windows = events[['event', 'start', 'end']].sort_values('start', kind='stable').reset_index(drop=True)
+    windows['sim_start'] = windows['start'] - pd.Timedelta(hours=spin_up_hours)
+    windows['sim_end'] = windows['end'] + pd.Timedelta(hours=tail_hours)
+    next_start = windows['start'].shift(-1)
+    windows['sim_end'] = windows['sim_end'].mask(next_start < windows['sim_end'], next_start)
+    windows['report_hours'] = (windows['sim_end'] - windows['start']).dt.total_seconds() / 3600
+    return windows
+
+def event_jobs(inp_file_path, windows, rainfall=None, hotstart=None):
+    # scenario_utils jobs, one per window; hotstart starts each spin-up from a saved state
+    jobs = []
+    for row in windows.itertuples(index=False):
+        options = window_options(row.sim_start, row.sim_end)
+        options['REPORT_START_DATE'] = row.start.strftime('%m/%d/%Y')
+        options['REPORT_START_TIME'] = row.start.strftime('%H:%M:%S')
+        jobs.append({'inp': inp_file_path, 'rainfall': rainfall, 'options': options, 'name': row.event,
+                     'files': {'USE HOTSTART': hotstart} if hotstart else None})
+    return jobs
+
+def merge_event_stats(event_links, windows):
+    # One per-conduit row from the per-event summaries (a run_scenarios frame), each event
+    # weighted by its reported duration: time-weighted means, pooled variances and the
+    # overall min and max, in the columns calculate_HRT expects
+    weight = event_links['scenario'].map(windows.set_index('event')['report_hours']).to_numpy(dtype=float)
+    frame = event_links.assign(_w=weight)
+    variables = [col[len('mean_'):] for col in frame.columns if col.startswith('mean_')]
+
+    for var in variables:
+        frame[f'_wm_{var}'] = frame['_w'] * frame[f'mean_{var}']
+    grouped = frame.groupby('cond_name', sort=False)
+    total = grouped['_w'].sum()
+    merged = pd.DataFrame(index=total.index)
+    for var in variables:
+        mean = grouped[f'_wm_{var}'].sum() / total
+        spread = frame[f'mean_{var}'] - frame['cond_name'].map(mean)
+        frame[f'_wv_{var}'] = frame['_w'] * (frame[f'var_{var}'] + spread**2)
+        merged[f'mean_{var}'] = mean
+        merged[f'min_{var}'] = grouped[f'min_{var}'].min()
+        merged[f'max_{var}'] = grouped[f'max_{var}'].max()
+        merged[f'var_{var}'] = frame.groupby('cond_name', sort=False)[f'_wv_{var}'].sum() / total
+    return merged.reset_index()
+
+def event_conduit_summary(inp_file_path, precip_path, min_dry_hours=6, min_depth=0.0, spin_up_hours=24,
+                          tail_hours=12, hotstart=None, max_workers=None, timeout=None):
+    # Per-conduit summary of the wet-weather events only, in place of one continuous run.
+    # Events run one after another in this process, or across max_workers spawned processes
+    # (see the note at the top of scenario_utils).
+    # Returns the merged summary and the events table.
+    from scenario_utils import run_scenario, run_scenarios
+
+    events = rainfall_events(precip_path, min_dry_hours, min_depth)
+    if events.empty:
+        raise ValueError(f"No rainfall events in {precip_path}")
+    windows = event_windows(events, spin_up_hours, tail_hours)
+    jobs = event_jobs(inp_file_path, windows, precip_path, hotstart)
+
+    with phase('event_simulations', events=len(jobs)):
+        if max_workers and max_workers > 1:
+            event_links, failures = run_scenarios(jobs, max_workers, timeout)
+            if failures:
+                raise RuntimeError(f"Event simulations failed: {failures}")
+        else:
+            frames = []
+            for job_id, job in enumerate(jobs):
+                links = run_scenario(job)
+                links.insert(0, 'scenario', job['name'])
+                links.insert(1, 'job_id', job_id)
+                frames.append(links)
+            event_links = pd.concat(frames, ignore_index=True)
+    return merge_event_stats(event_links, windows), events
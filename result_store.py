@@ -0,0 +1,174 @@
+import os
+import time
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+from profiling_utils import get_logger, phase, count
+
+logger = get_logger('results')
+
+DEFAULT_RESULTS_DIR = 'hrt_results'
+
+# Column types of the tables the pipeline writes; other columns keep the types Arrow infers
+SCHEMAS = {
+    'conduit_summary': {
+        'cond_name': 'string', 'Inlet_Node': 'string', 'Outlet_Node': 'string', 'cond_length': 'float64',
+        'mean_flow': 'float64', 'mean_depth': 'float64', 'Conduit HRT (HRS)': 'float64', 'Valid_HRT': 'bool',
+    },
+    'path_hrt': {
+        'Start_Node': 'string', 'End_Node': 'string', 'Path': 'list<string>', 'Total_HRT': 'float64',
+        'Subcatchments': 'string', 'WWTP': 'string',
+    },
+    'calibration_history': {
+        'cond_name': 'string', 'Inlet_Node': 'string', 'Outlet_Node': 'string', 'cond_length': 'float64',
+        'Conduit HRT (HRS)': 'float64',
+    },
+    'timeseries': {'time': 'timestamp[s]', 'name': 'dictionary<string>', 'value': 'float32'},
+}
+
+def _arrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("The result store needs pyarrow (pip install pyarrow)") from e
+    return pyarrow
+
+def arrow_type(pa, name):
+    return {
+        'string': pa.string(), 'float64': pa.float64(), 'float32': pa.float32(), 'int32': pa.int32(),
+        'int64': pa.int64(), 'bool': pa.bool_(), 'list<string>': pa.list_(pa.string()),
+        'timestamp[s]': pa.timestamp('s'), 'dictionary<string>': pa.dictionary(pa.int32(), pa.string()),
+    }[name]
+
+def to_arrow(df, table_name):
+    # DataFrame -> Arrow table with the table's typed columns; named indexes become columns
+    pa = _arrow()
+    if any(name is not None for name in df.index.names):
+        df = df.reset_index()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    types = SCHEMAS.get(table_name, {})
+    fields = [pa.field(field.name, arrow_type(pa, types[field.name])) if field.name in types else field
+              for field in table.schema]
+    return table.cast(pa.schema(fields))
+
+def filter_expression(filters, schema=None):
+    # {column: value or list of values} -> dataset filter, all conditions combined. Values are
+    # cast to the column types of schema, so partition values match whatever type was inferred.
+    pa = _arrow()
+    import pyarrow.dataset as ds
+
+    def typed(column, value):
+        if schema is None or schema.get_field_index(column) < 0:
+            return value
+        return pa.scalar(value).cast(schema.field(column).type)
+
+    expression = None
+    for column, value in (filters or {}).items():
+        if isinstance(value, (list, tuple, set, np.ndarray, pd.Index)):
+            term = ds.field(column).isin(pa.array([typed(column, v).as_py() for v in value]))
+        else:
+            term = ds.field(column) == typed(column, value)
+        expression = term if expression is None else expression & term
+    return expression
+
+class ResultStore:
+    # Parquet datasets under root/<table>/, hive-partitioned by run and any extra partition
+    # columns (root/path_hrt/run=.../part-*.parquet). Runs and iterations are separate
+    # partitions, so they accumulate without rewriting each other; writing a partition again
+    # (a re-run stage, a resumed iteration) replaces it. Reads open the dataset lazily: only the
+    # requested columns and the partitions matching the filters are read. R reads the same
+    # folders with arrow::open_dataset().
+
+    def __init__(self, root=DEFAULT_RESULTS_DIR, run_id=None):
+        self.root = root
+        self.run_id = run_id or pd.Timestamp.now().strftime('%Y%m%d-%H%M%S')
+        os.makedirs(root, exist_ok=True)
+
+    def _partition(self, partition):
+        return dict({'run': self.run_id}, **(partition or {}))
+
+    def _partition_dir(self, table_name, partition):
+        return os.path.join(self.root, table_name, *[f'{k}={v}' for k, v in partition.items()])
+
+    def _write(self, table_name, table, partition):
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+        pa = _arrow()
+        partition = self._partition(partition)
+        # Time-ordered names, so reads return rows in the order they were written
+        basename = f'part-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}-{{i}}.parquet'
+        with phase('result_write', table=table_name, rows=table.num_rows):
+            if table.num_rows == 0:
+                # write_dataset skips empty tables; keep the schema so the table can still be read
+                part_dir = self._partition_dir(table_name, partition)
+                os.makedirs(part_dir, exist_ok=True)
+                pq.write_table(table, os.path.join(part_dir, basename.format(i=0)))
+            else:
+                for column, value in partition.items():
+                    table = table.append_column(column, pa.array([str(value)] * table.num_rows, pa.string()))
+                ds.write_dataset(table, os.path.join(self.root, table_name), format='parquet',
+                                 partitioning=list(partition), partitioning_flavor='hive',
+                                 existing_data_behavior='overwrite_or_ignore', basename_template=basename)
+        count('result_rows', table.num_rows)
+
+    def write(self, table_name, df, **partition):
+        # Write a DataFrame as one partition of a table, replacing whatever an earlier write of the
+        # same partition left; keyword arguments are extra partition values (e.g. iteration=3),
+        # stored as folder names rather than columns in the files
+        self.clear(table_name, **partition)
+        self._write(table_name, to_arrow(df, table_name), partition)
+
+    def clear(self, table_name, **partition):
+        # Delete this run's rows of a table, or only those of the given partition (e.g. stage='initial')
+        part_dir = self._partition_dir(table_name, self._partition(partition))
+        if os.path.isdir(part_dir):
+            shutil.rmtree(part_dir)
+            count('result_partitions_cleared')
+
+    def write_output_series(self, output, element='links', variables=('flow', 'depth'), names=None,
+                            chunk_periods=10000):
+        # Time series of a SwmmOutput in long form (time, name, value), partitioned by element
+        # and variable, streamed one block of reporting periods at a time
+        pa = _arrow()
+        ids = getattr(output, element)
+        columns = np.arange(len(ids)) if names is None else np.array([ids.index(name) for name in names])
+        dictionary = pa.array([ids[i] for i in columns], pa.string())
+        for variable in variables:
+            for start, block in output.iter_chunks(element, variable, chunk_periods):
+                block = np.asarray(block[:, columns])
+                times = output.times(start, start + block.shape[0]).to_numpy(dtype='datetime64[s]')
+                table = pa.table({
+                    'time': pa.array(np.repeat(times, len(columns)), pa.timestamp('s')),
+                    'name': pa.DictionaryArray.from_arrays(
+                        pa.array(np.tile(np.arange(len(columns), dtype=np.int32), block.shape[0])), dictionary),
+                    'value': pa.array(block.ravel(), pa.float32()),
+                })
+                self._write('timeseries', table, {'element': element, 'variable': variable})
+
+    def dataset(self, table_name):
+        # Lazy pyarrow dataset of a table over all runs, partition columns included
+        _arrow()
+        import pyarrow.dataset as ds
+        return ds.dataset(os.path.join(self.root, table_name), format='parquet', partitioning='hive')
+
+    def read_table(self, table_name, columns=None, filters=None, run=None):
+        # Arrow table of the selected columns and rows; run defaults to this store's run,
+        # run='all' reads every run
+        filters = dict(filters or {})
+        run = self.run_id if run is None else run
+        if run != 'all':
+            filters['run'] = run
+        dataset = self.dataset(table_name)
+        return dataset.to_table(columns=columns, filter=filter_expression(filters, dataset.schema))
+
+    def read(self, table_name, columns=None, filters=None, run=None):
+        return self.read_table(table_name, columns, filters, run).to_pandas()
+
+    def runs(self, table_name):
+        table_dir = os.path.join(self.root, table_name)
+        if not os.path.isdir(table_dir):
+            return []
+        return sorted(name.split('=', 1)[1] for name in os.listdir(table_dir) if name.startswith('run='))
@@ -0,0 +1,132 @@
+import os
+import time
+import queue
+import tempfile
+import multiprocessing as mp
+from collections import deque
+import pandas as pd
+from inp_utils import rewrite_inp
+from profiling_utils import get_logger
+
+logger = get_logger('scenarios')
+
+# Worker processes here and in uncertainty_utils/rainfall_utils are started with 'spawn':
+# pyswmm allows one simulation per process and forked workers would share the parent's
+# solver state. Spawned workers re-import the calling script, so a script that runs
+# several workers must guard its entry point with if __name__ == '__main__'.
+
+def normalize_job(job):
+    # Jobs are (inp, rainfall, options) tuples or dicts with those keys plus an optional name
+    # and [FILES] entries (e.g. {'USE HOTSTART': path} for a warm start)
+    if not isinstance(job, dict):
+        inp, rainfall, options = (tuple(job) + (None, None))[:3]
+        job = {'inp': inp, 'rainfall': rainfall, 'options': options}
+    job = dict(job)
+    job.setdefault('rainfall', None)
+    job['options'] = dict(job.get('options') or {})
+    job.setdefault('name', None)
+    job.setdefault('files', None)
+    return job
+
+def run_scenario(job):
+    # Simulate one job in its own temporary folder and return its per-conduit summary.
+    # 'read_from_out_file' in options picks the .out reader over Python-side stepping;
+    # every other option overrides the matching [OPTIONS] entry.
+    job = normalize_job(job)
+    options = dict(job['options'])
+    read_from_out_file = options.pop('read_from_out_file', True)
+
+    with tempfile.TemporaryDirectory(prefix='swmm_scenario_') as workdir:
+        inp_file_path = rewrite_inp(job['inp'], os.path.join(workdir, os.path.basename(job['inp'])),
+                                    options, job['rainfall'], job['files'])
+        if read_from_out_file:
+            from swmm_out_utils import collect_output_stats
+            links, nodes = collect_output_stats(inp_file_path)
+        else:
+            from simulation_utils import collect_simulation_stats
+            links, nodes = collect_simulation_stats(inp_file_path)
+    return links
+
+def _scenario_worker(job_id, job, results):
+    try:
+        results.put((job_id, 'ok', run_scenario(job)))
+    except Exception as e:
+        results.put((job_id, 'error', repr(e)))
+
+def iter_scenarios(jobs, max_workers=None, timeout=None, retries=1, poll_seconds=0.2):
+    # Run jobs across worker processes (pyswmm allows one simulation per process, so each
+    # attempt gets a fresh process) and yield (job_id, job, links_df, error) as they finish.
+    # Attempts that exceed timeout seconds are killed; failed attempts are retried.
+    jobs = [normalize_job(job) for job in jobs]
+    for job_id, job in enumerate(jobs):
+        job['name'] = job['name'] or f"{os.path.splitext(os.path.basename(job['inp']))[0]}_{job_id}"
+    max_workers = max_workers or os.cpu_count() or 1
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    pending = deque((job_id, 0) for job_id in range(len(jobs)))
+    running = {}
+
+    def retry_or_fail(job_id, attempt, error):
+        if attempt < retries:
+            logger.warning("Scenario failed, retrying", extra={'fields': {'scenario': jobs[job_id]['name'], 'error': error}})
+            pending.append((job_id, attempt + 1))
+            return None
+        return (job_id, jobs[job_id], None, error)
+
+    while pending or running:
+        while pending and len(running) < max_workers:
+            job_id, attempt = pending.popleft()
+            process = ctx.Process(target=_scenario_worker, args=(job_id, jobs[job_id], results), daemon=True)
+            process.start()
+            running[job_id] = (process, time.monotonic(), attempt)
+
+        try:
+            job_id, status, payload = results.get(timeout=poll_seconds)
+        except queue.Empty:
+            job_id = None
+
+        if job_id is not None and job_id in running:
+            process, started, attempt = running.pop(job_id)
+            process.join()
+            if status == 'ok':
+                yield (job_id, jobs[job_id], payload, None)
+            else:
+                failed = retry_or_fail(job_id, attempt, payload)
+                if failed:
+                    yield failed
+
+        now = time.monotonic()
+        for job_id, (process, started, attempt) in list(running.items()):
+            if timeout is not None and now - started > timeout:
+                process.terminate()
+                process.join()
+                del running[job_id]
+                failed = retry_or_fail(job_id, attempt, f"timed out after {timeout} s")
+                if failed:
+                    yield failed
+            elif not process.is_alive() and process.exitcode != 0:
+                # Crashed without reporting back (e.g. the engine aborted the process)
+                del running[job_id]
+                failed = retry_or_fail(job_id, attempt, f"worker exited with code {process.exitcode}")
+                if failed:
+                    yield failed
+
+def run_scenarios(jobs, max_workers=None, timeout=None, retries=1):
+    # Merged per-conduit summaries of all jobs, one block of rows per scenario
+    frames = []
+    failures = {}
+    for job_id, job, links, error in iter_scenarios(jobs, max_workers, timeout, retries):
+        if error is not None:
+            failures[job['name']] = error
+            continue
+        logger.info("Scenario done", extra={'fields': {'scenario': job['name']}})
+        links.insert(0, 'scenario', job['name'])
+        links.insert(1, 'job_id', job_id)
+        frames.append(links)
+
+    if failures:
+        logger.warning("Scenarios failed", extra={'fields': {'failures': failures}})
+    if not frames:
+        return pd.DataFrame(columns=['scenario', 'job_id', 'cond_name']), failures
+    merged = pd.concat(frames, ignore_index=True).sort_values(['job_id', 'cond_name'], kind='stable')
+    return merged.reset_index(drop=True), failures
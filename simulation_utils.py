@@ -0,0 +1,99 @@
+import os
+import numpy as np
+import pandas as pd
+from pyswmm import Simulation, Links, Nodes
+from pyswmm.toolkitapi import LinkResults, NodeResults, ObjectType
+from swmm.toolkit import solver
+from profiling_utils import phase, count
+
+# Result variables tracked for each element type, named as they appear in the summary columns
+LINK_VARIABLES = {'flow': LinkResults.newFlow, 'depth': LinkResults.newDepth}
+NODE_VARIABLES = {'depth': NodeResults.newDepth, 'inflow': NodeResults.totalinflow}
+
+class SimulationStatsCollector:
+    # Constant-memory running statistics for every link and node of a pyswmm simulation.
+    # Each routing step is weighted by its duration (weighted Welford update), so the means
+    # are time averages even with variable routing steps, and nothing grows with run length.
+
+    def __init__(self, sim, links=None, nodes=None):
+        self.link_ids = [link.linkid for link in Links(sim)] if links is None else list(links)
+        self.node_ids = [node.nodeid for node in Nodes(sim)] if nodes is None else list(nodes)
+        self._link_index = [sim._model.getObjectIDIndex(ObjectType.LINK.value, i) for i in self.link_ids]
+        self._node_index = [sim._model.getObjectIDIndex(ObjectType.NODE.value, i) for i in self.node_ids]
+
+        self.stats = {
+            'links': self._empty_stats(len(LINK_VARIABLES), len(self.link_ids)),
+            'nodes': self._empty_stats(len(NODE_VARIABLES), len(self.node_ids)),
+        }
+        self.total_seconds = 0.0
+        self.steps = 0
+        self._last_time = sim.start_time
+
+    @staticmethod
+    def _empty_stats(n_vars, n):
+        return {
+            'mean': np.zeros((n_vars, n)),
+            'm2': np.zeros((n_vars, n)),
+            'min': np.full((n_vars, n), np.inf),
+            'max': np.full((n_vars, n), -np.inf),
+            'buffer': np.empty((n_vars, n)),
+        }
+
+    def _read(self, buffer, getter, indices, variables):
+        for k, result in enumerate(variables.values()):
+            buffer[k] = np.fromiter((getter(i, result.value) for i in indices), dtype=float, count=len(indices))
+
+    def _accumulate(self, stats, weight, total):
+        x = stats['buffer']
+        delta = x - stats['mean']
+        stats['mean'] += delta * (weight / total)
+        stats['m2'] += weight * delta * (x - stats['mean'])
+        np.minimum(stats['min'], x, out=stats['min'])
+        np.maximum(stats['max'], x, out=stats['max'])
+
+    def update(self, current_time):
+        # Call once per routing step with sim.current_time
+        weight = (current_time - self._last_time).total_seconds()
+        self._last_time = current_time
+        if weight <= 0:
+            return
+        self.total_seconds += weight
+        self.steps += 1
+
+        self._read(self.stats['links']['buffer'], solver.link_get_result, self._link_index, LINK_VARIABLES)
+        self._read(self.stats['nodes']['buffer'], solver.node_get_result, self._node_index, NODE_VARIABLES)
+        self._accumulate(self.stats['links'], weight, self.total_seconds)
+        self._accumulate(self.stats['nodes'], weight, self.total_seconds)
+
+    def to_frame(self, element='links'):
+        # One summary row per element; link frames keep the cond_name/mean_flow/mean_depth
+        # columns calculate_HRT expects
+        if element == 'links':
+            ids, variables, name_col = self.link_ids, LINK_VARIABLES, 'cond_name'
+        else:
+            ids, variables, name_col = self.node_ids, NODE_VARIABLES, 'node_name'
+        stats = self.stats[element]
+        seen = self.total_seconds > 0
+
+        summary = {name_col: ids}
+        for k, var in enumerate(variables):
+            summary[f'mean_{var}'] = stats['mean'][k] if seen else np.zeros(len(ids))
+            summary[f'min_{var}'] = stats['min'][k] if seen else np.full(len(ids), np.nan)
+            summary[f'max_{var}'] = stats['max'][k] if seen else np.full(len(ids), np.nan)
+            summary[f'var_{var}'] = stats['m2'][k] / self.total_seconds if seen else np.full(len(ids), np.nan)
+        return pd.DataFrame(summary)
+
+def collect_simulation_stats(inp_file_path, links=None, nodes=None, rpt_file_path=None, out_file_path=None):
+    # Run the model and return the link and node summaries; the report and output files
+    # default to the model's folder
+    with phase('simulation', inp=os.path.basename(inp_file_path), engine='pyswmm'), \
+            Simulation(inp_file_path, rpt_file_path, out_file_path) as sim:
+        collector = SimulationStatsCollector(sim, links, nodes)
+        steps = 0
+        for step in sim:
+            collector.update(sim.current_time)
+            steps += 1
+    count('routing_steps', steps)
+
+    with phase('stats_reduction', source='stepping'):
+        return collector.to_frame('links'), collector.to_frame('nodes')
@@ -0,0 +1,161 @@
+import os
+import numpy as np
+import pandas as pd
+from profiling_utils import phase
+
+# SWMM 5 binary output layout constants
+MAGIC_NUMBER = 516114522
+RECORD_SIZE = 4
+CLOSING_RECORDS = 6
+SWMM_EPOCH = pd.Timestamp('1899-12-30')
+
+# Position of each result variable within a period record (pollutants follow these)
+SUBCATCH_VARIABLES = {'rainfall': 0, 'snow_depth': 1, 'evap': 2, 'infil': 3, 'runoff': 4,
+                      'gw_flow': 5, 'gw_elev': 6, 'soil_moisture': 7}
+NODE_VARIABLES = {'depth': 0, 'head': 1, 'volume': 2, 'lateral_inflow': 3, 'inflow': 4, 'overflow': 5}
+LINK_VARIABLES = {'flow': 0, 'depth': 1, 'velocity': 2, 'volume': 3, 'capacity': 4}
+
+class SwmmOutput:
+    # Memory-mapped reader for a SWMM 5 binary .out file. The computed results are mapped
+    # as one structured record per reporting period, so series() hands back zero-copy strided
+    # views and nothing is read from disk until it is used.
+
+    def __init__(self, out_file_path):
+        self.path = out_file_path
+        with open(out_file_path, 'rb') as f:
+            f.seek(-CLOSING_RECORDS * RECORD_SIZE, os.SEEK_END)
+            id_pos, prop_pos, output_pos, n_periods, error_code, magic = np.fromfile(f, dtype='<i4', count=6)
+            f.seek(0)
+            magic_start, self.version, self.flow_units, n_sub, n_nodes, n_links, n_polluts = \
+                np.fromfile(f, dtype='<i4', count=7)
+
+            if magic != MAGIC_NUMBER or magic_start != MAGIC_NUMBER:
+                raise ValueError(f"{out_file_path} is not a SWMM binary output file")
+            if error_code != 0:
+                raise ValueError(f"SWMM run that wrote {out_file_path} ended with error code {error_code}")
+            if n_periods == 0:
+                raise ValueError(f"{out_file_path} contains no reporting periods")
+
+            f.seek(id_pos)
+            self.subcatchments = self._read_ids(f, n_sub)
+            self.nodes = self._read_ids(f, n_nodes)
+            self.links = self._read_ids(f, n_links)
+            self.pollutants = self._read_ids(f, n_polluts)
+
+            # Skip pollutant units and the static object properties to the variable counts
+            f.seek(prop_pos)
+            for n_objects in (n_sub, n_nodes, n_links):
+                n_props = int(np.fromfile(f, dtype='<i4', count=1)[0])
+                f.seek(RECORD_SIZE * (n_props + n_props * n_objects), os.SEEK_CUR)
+
+            n_vars = []
+            for _ in range(4):
+                n = int(np.fromfile(f, dtype='<i4', count=1)[0])
+                f.seek(RECORD_SIZE * n, os.SEEK_CUR)
+                n_vars.append(n)
+            self.start_date = float(np.fromfile(f, dtype='<f8', count=1)[0])
+            self.report_step = int(np.fromfile(f, dtype='<i4', count=1)[0])
+
+        n_sub_vars, n_node_vars, n_link_vars, n_sys_vars = n_vars
+        self.period_dtype = np.dtype([
+            ('date', '<f8'),
+            ('subcatchments', '<f4', (n_sub, n_sub_vars)),
+            ('nodes', '<f4', (n_nodes, n_node_vars)),
+            ('links', '<f4', (n_links, n_link_vars)),
+            ('system', '<f4', (n_sys_vars,)),
+        ])
+        self.n_periods = int(n_periods)
+        self.data = np.memmap(out_file_path, dtype=self.period_dtype, mode='r',
+                              offset=int(output_pos), shape=(self.n_periods,))
+
+    @staticmethod
+    def _read_ids(f, count):
+        ids = []
+        for _ in range(count):
+            n = int(np.fromfile(f, dtype='<i4', count=1)[0])
+            ids.append(f.read(n).decode())
+        return ids
+
+    def _variable(self, element, variable):
+        variables = {'subcatchments': SUBCATCH_VARIABLES, 'nodes': NODE_VARIABLES, 'links': LINK_VARIABLES}[element]
+        if variable in variables:
+            return variables[variable]
+        if variable in self.pollutants:
+            return len(variables) + self.pollutants.index(variable)
+        raise KeyError(f"Unknown {element} variable '{variable}'")
+
+    def series(self, element, variable, start=0, stop=None):
+        # Zero-copy (periods x objects) float32 view of one variable
+        return self.data[element][start:stop, :, self._variable(element, variable)]
+
+    def times(self, start=0, stop=None):
+        days = np.asarray(self.data['date'][start:stop])
+        return (SWMM_EPOCH + pd.to_timedelta(days, unit='D')).round('s')
+
+    def iter_chunks(self, element, variable, chunk_periods=10000):
+        # Stream a variable in blocks of periods so files larger than RAM stay bounded
+        for start in range(0, self.n_periods, chunk_periods):
+            yield start, self.series(element, variable, start, start + chunk_periods)
+
+    def summary(self, element, variables, chunk_periods=10000):
+        # Mean, min, max and variance per object over all reporting periods, one chunk at a time
+        ids = getattr(self, element)
+        name_col = {'links': 'cond_name', 'nodes': 'node_name', 'subcatchments': 'sc_name'}[element]
+        summary = {name_col: ids}
+
+        for variable in variables:
+            count = 0
+            mean = np.zeros(len(ids))
+            m2 = np.zeros(len(ids))
+            low = np.full(len(ids), np.inf)
+            high = np.full(len(ids), -np.inf)
+            for start, block in self.iter_chunks(element, variable, chunk_periods):
+                # Combine each chunk's moments with the running ones (Chan et al.)
+                block = block.astype(float)
+                n = block.shape[0]
+                block_mean = block.mean(axis=0)
+                delta = block_mean - mean
+                mean += delta * n / (count + n)
+                m2 += np.square(block - block_mean).sum(axis=0) + delta**2 * count * n / (count + n)
+                count += n
+                np.minimum(low, block.min(axis=0), out=low)
+                np.maximum(high, block.max(axis=0), out=high)
+
+            summary[f'mean_{variable}'] = mean
+            summary[f'min_{variable}'] = low
+            summary[f'max_{variable}'] = high
+            summary[f'var_{variable}'] = m2 / count
+        return pd.DataFrame(summary)
+
+    def conduit_summary(self, chunk_periods=10000):
+        # Per-link mean flow and depth in the shape calculate_HRT expects
+        return self.summary('links', ['flow', 'depth'], chunk_periods)
+
+    def close(self):
+        # Drop the mapping; the file is unmapped once no series views are left
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def run_swmm(inp_file_path, out_file_path=None, rpt_file_path=None):
+    # Let SWMM run to completion at native speed and write the binary output file
+    from swmm.toolkit import solver
+
+    base = os.path.splitext(inp_file_path)[0]
+    out_file_path = out_file_path or base + '.out'
+    rpt_file_path = rpt_file_path or base + '.rpt'
+    solver.swmm_run(inp_file_path, rpt_file_path, out_file_path)
+    return out_file_path
+
+def collect_output_stats(inp_file_path, out_file_path=None, chunk_periods=10000, rpt_file_path=None):
+    # Same link and node summaries as simulation_utils.collect_simulation_stats, read from the .out file
+    with phase('simulation', inp=os.path.basename(inp_file_path), engine='swmm_run'):
+        out_file_path = run_swmm(inp_file_path, out_file_path, rpt_file_path)
+    with phase('stats_reduction', source='out_file'), SwmmOutput(out_file_path) as output:
+        links = output.conduit_summary(chunk_periods)
+        nodes = output.summary('nodes', ['depth', 'inflow'], chunk_periods)
+    return links, nodes
@@ -0,0 +1,11 @@
+import pytest
+from network_generator import synthetic_pipeline
+
+@pytest.fixture(scope='session')
+def synthetic_network(tmp_path_factory):
+    # Builds a synthetic network and its pipeline frames (network_generator.synthetic_pipeline),
+    # its .inp alone in a folder of its own: synthetic_network(n_conduits, seed, **generate_network options)
+    def build(n_conduits, seed=0, **network_kwargs):
+        inp_file_path = tmp_path_factory.mktemp('network') / 'network.inp'
+        return synthetic_pipeline(n_conduits, seed, str(inp_file_path), **network_kwargs)
+    return build
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.optimize import lsq_linear
+import calibration_HRT_utils
+from calibration_HRT_utils import bounded_ridge_lsq, PathHRTIndex, solve_conduit_lengths
+from network_generator import synthetic_targets
+
+def objective(M, r, regularization, d):
+    return np.sum((M @ d - r)**2) + regularization * np.sum(d**2)
+
+def reference(M, r, lower, upper, regularization):
+    # Dense bounded-variable least squares on the ridge-augmented system
+    n = M.shape[1]
+    A = sparse.vstack([M, np.sqrt(regularization) * sparse.eye(n)]).toarray()
+    return lsq_linear(A, np.concatenate([r, np.zeros(n)]), bounds=(lower, upper), method='bvls', tol=1e-12).x
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_bvls(seed):
+    rng = np.random.default_rng(seed)
+    M = sparse.random(60, 40, density=0.15, random_state=seed, data_rvs=np.ones, format='csr')
+    r = rng.normal(size=60)
+    lower, upper = -rng.uniform(0, 0.5, 40), rng.uniform(0, 0.5, 40)
+    upper[::7] = np.inf
+    d, pivots, _ = bounded_ridge_lsq(M, r, lower, upper, 1e-6)
+    expected = reference(M, r, lower, upper, 1e-6)
+    assert pivots < 200
+    assert ((d >= lower) & (d <= upper)).all()
+    assert objective(M, r, 1e-6, d) == pytest.approx(objective(M, r, 1e-6, expected), rel=1e-8)
+
+def test_degenerate_bounds_settle(monkeypatch, synthetic_network):
+    # Conduits that the targets barely pin down once flipped between their bound and free on
+    # LSMR round-off until the pivot limit; this 100-conduit network is such a case
+    network = synthetic_network(100, n_outfalls=3, loop_fraction=0.05)
+    new_df = network['new_df']
+    index = PathHRTIndex(new_df, network['merged_df'], network['node_ids'], network['outfalls'])
+    tot_HRT_df, median_HRT_df = synthetic_targets(index.to_frame(), network['network'], seed=0)
+
+    calls = []
+    def recorded(M, r, lower, upper, regularization, **kwargs):
+        d, pivots, iterations = bounded_ridge_lsq(M, r, lower, upper, regularization, **kwargs)
+        calls.append((M, r, lower, upper, regularization, d, pivots))
+        return d, pivots, iterations
+    monkeypatch.setattr(calibration_HRT_utils, 'bounded_ridge_lsq', recorded)
+    solve_conduit_lengths(new_df, tot_HRT_df, median_HRT_df)
+
+    (M, r, lower, upper, regularization, d, pivots), = calls
+    assert pivots < 20
+    expected = reference(M, r, lower, upper, regularization)
+    assert objective(M, r, regularization, d) == pytest.approx(objective(M, r, regularization, expected), rel=1e-7)
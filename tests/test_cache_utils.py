@@ -0,0 +1,25 @@
+import os
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyswmm')
+pytest.importorskip('swmmio')
+from cache_utils import cached_model_summary, SummaryCache
+
+@pytest.mark.parametrize('read_from_out_file', [False, True])
+def test_summary_leaves_model_folder_alone(synthetic_network, tmp_path, read_from_out_file):
+    inp_file_path = synthetic_network(30, seed=1, n_outfalls=1, subcatchment_fraction=0.5)['inp_file_path']
+    model_dir = os.path.dirname(inp_file_path)
+    before = sorted(os.listdir(model_dir))
+    cache = SummaryCache(str(tmp_path / 'cache'))
+
+    summary = cached_model_summary(inp_file_path, read_from_out_file, cache=cache)
+    assert len(summary['links']) == 30
+    # No .out/.rpt next to the input, none left in the cache either
+    assert sorted(os.listdir(model_dir)) == before
+    assert not [name for _, _, files in os.walk(cache.cache_dir) for name in files
+                if name.endswith(('.out', '.rpt'))]
+
+    # A second call is served from the cache
+    cached = cached_model_summary(inp_file_path, read_from_out_file, cache=cache)
+    pd.testing.assert_frame_equal(cached['links'], summary['links'], check_dtype=False)
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+from calibration_HRT_utils import (calibrate_HRT, PathHRTIndex, DrainageIndex, ConduitTable,
+                                   CalibrationPaths)
+from network_generator import synthetic_targets
+
+@pytest.fixture
+def network(synthetic_network):
+    return synthetic_network(300, seed=2, n_outfalls=3, loop_fraction=0.05)
+
+def labelled_paths(network, tolerance=0.05):
+    path_index = PathHRTIndex(network['new_df'], network['merged_df'], network['node_ids'], network['outfalls'])
+    drainage_index = DrainageIndex(network['inp_file_path'], path_index.distance)
+    _, median_HRT_df = synthetic_targets(path_index.to_frame(), network['network'], seed=2)
+    targets = median_HRT_df.set_index('sc.id')['sc_median_hrt']
+    return CalibrationPaths(path_index, drainage_index, targets, tolerance), median_HRT_df
+
+def assert_matches_rebuild(paths):
+    # The incrementally updated rows and count agree with labelling the path index from scratch
+    rebuilt = paths.drainage_index.join(paths.path_index.to_frame())
+    pd.testing.assert_frame_equal(paths.frame, rebuilt, check_dtype=False)
+    target = rebuilt['Subcatchments'].map(paths.targets)
+    off = target.notna() & ~((rebuilt['Total_HRT'] - target).abs() <= paths.tolerance)
+    assert paths.n_off_target == off.sum()
+    assert paths.converged == (not off.any())
+
+def test_updates_follow_the_path_index(network):
+    paths, _ = labelled_paths(network)
+    table = ConduitTable(network['new_df'], network['link_table'])
+    hrt_buffer = paths.path_index.padded_hrt
+    rng = np.random.default_rng(0)
+    for names in np.array_split(rng.choice(table.names, 60, replace=False), 12):
+        for name in names:
+            row = table.row_of[name]
+            scale = rng.uniform(0.5, 1.5)
+            table.set(name, cond_length=table['cond_length'][row] * scale,
+                      **{'Conduit HRT (HRS)': table['Conduit HRT (HRS)'][row] * scale})
+        paths.path_index.apply_conduit_summary(table)
+        paths.update()
+        assert_matches_rebuild(paths)
+    # Updates are written into the one preallocated HRT array, whose missing-edge slot stays NaN
+    assert paths.path_index.padded_hrt is hrt_buffer and np.isnan(hrt_buffer[-1])
+    np.testing.assert_array_equal(paths.path_index.hrt, table['Conduit HRT (HRS)'])
+
+def test_calibration_steps_stay_in_step(network):
+    paths, median_HRT_df = labelled_paths(network, tolerance=1e-6)
+    table = ConduitTable(network['new_df'], network['link_table'])
+    progress_tracker = {wwtp: 0 for wwtp in paths.frame['WWTP'].unique()}
+    sorting_order = {}
+    assert not paths.converged
+    for step in range(2000):
+        table, _, progress_tracker = calibrate_HRT(table, paths.frame, median_HRT_df, progress_tracker, sorting_order)
+        paths.path_index.apply_conduit_summary(table)
+        if paths.update():
+            sorting_order.clear()
+        if step % 100 == 0:
+            assert_matches_rebuild(paths)
+        if paths.converged:
+            break
+    assert_matches_rebuild(paths)
+    # Each WWTP's rows were sorted once and walked to the end
+    assert all(progress_tracker[wwtp] == len(order) for wwtp, order in sorting_order.items())
+
+def test_conduit_table_rows_and_load(network):
+    table = ConduitTable(network['new_df'], network['link_table'])
+    saved = {col: table[col].copy() for col in ('cond_length', 'Conduit HRT (HRS)')}
+    table.set(table.names[5], cond_length=1.0)
+    table.set(table.names[2], cond_length=2.0)
+    assert table.to_frame(table.pop_changes())['cond_name'].tolist() == [table.names[2], table.names[5]]
+    table.load(saved)
+    assert table.pop_changes().tolist() == [2, 5]
+    pd.testing.assert_frame_equal(table.to_frame(), ConduitTable(network['new_df']).to_frame())
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from coarsen_utils import coarsen_model, conduit_frame, subcatchment_HRT
+
+# Simulates a synthetic network with SWMM, coarsens it and runs the coarse model
+pytest.importorskip('pyswmm')
+pytest.importorskip('swmmio')
+from cache_utils import cached_model_summary, SummaryCache
+
+@pytest.fixture(scope='module')
+def fine(synthetic_network, tmp_path_factory):
+    fine = synthetic_network(150, n_outfalls=3, subcatchment_fraction=0.6)
+    network, inp_file_path = fine['network'], fine['inp_file_path']
+    cache = SummaryCache(str(tmp_path_factory.mktemp('cache')))
+    return network, inp_file_path, cache, cached_model_summary(inp_file_path, cache=cache)
+
+def total_outflow(summary, outfalls):
+    return summary['nodes'].set_index('node_name').loc[outfalls, 'mean_inflow'].sum()
+
+@pytest.mark.parametrize('flow_threshold, area_threshold', [(None, None), (2.0, None), (None, 40.0)])
+def test_coarsened_network_runs(fine, tmp_path, flow_threshold, area_threshold):
+    network, inp_file_path, cache, summary = fine
+    links, link_table = summary['links'], summary['link_table']
+    outfalls = network['outfalls']
+    coarse_inp = str(tmp_path / 'coarse.inp')
+    coarse, node_map, report = coarsen_model(inp_file_path, coarse_inp, links, link_table,
+                                             summary['node_ids']['node_id'].tolist(), outfalls,
+                                             flow_threshold=flow_threshold, area_threshold=area_threshold)
+
+    original = conduit_frame(links, link_table)
+    assert len(coarse) < len(original)
+    assert not set(outfalls) & set(node_map)
+    # Merged conduits hold the volume of their members
+    assert coarse['volume'][coarse['mergeable']].sum() == pytest.approx(original['volume'][original['mergeable']].sum(), rel=1e-9)
+    # Subcatchments whose node is neither removed nor the outlet of a collapsed branch keep their HRT
+    untouched = ~report['Node'].isin(set(node_map) | set(node_map.values()))
+    assert untouched.any()
+    np.testing.assert_allclose(report.loc[untouched, 'HRT_Error'], 0, atol=1e-9)
+    if flow_threshold is None and area_threshold is None:
+        np.testing.assert_allclose(report['HRT_Error'], 0, atol=1e-9)
+
+    # The coarse model simulates, drains every subcatchment and carries the same water
+    resimulated = cached_model_summary(coarse_inp, cache=cache)
+    assert len(resimulated['links']) == len(coarse)
+    assert total_outflow(resimulated, outfalls) == pytest.approx(total_outflow(summary, outfalls), rel=0.05)
+    coarse_HRT = subcatchment_HRT(conduit_frame(resimulated['links'], resimulated['link_table']),
+                                  resimulated['node_ids']['node_id'].tolist(), coarse_inp, outfalls)
+    paired = report.set_index('Subcatchments')['HRT'].to_frame().join(coarse_HRT['Total_HRT'])
+    assert paired['Total_HRT'].notna().all()
+    if flow_threshold is None and area_threshold is None:
+        # Under its own simulated flows the series-merged model keeps the HRTs
+        assert ((paired['Total_HRT'] - paired['HRT']).abs() / paired['HRT']).median() < 0.01
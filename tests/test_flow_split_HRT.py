@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+from calibration_HRT_utils import flow_split_HRT
+
+def absorbing_chain(frame, outfalls):
+    # Dense reference: reach probabilities and first two HRT moments of the whole chain at once
+    nodes = pd.Index(pd.unique(np.concatenate([frame['Inlet_Node'], frame['Outlet_Node'], outfalls])))
+    n, k = len(nodes), len(outfalls)
+    src, dst = nodes.get_indexer(frame['Inlet_Node']), nodes.get_indexer(frame['Outlet_Node'])
+    flow, hrt = frame['mean_flow'].clip(lower=0).to_numpy(), frame['Conduit HRT (HRS)'].to_numpy()
+    outfall_pos = nodes.get_indexer(outfalls)
+    keep = (flow > 0) & ~np.isin(src, outfall_pos)
+    src, dst, flow, hrt = src[keep], dst[keep], flow[keep], hrt[keep]
+    split = flow / np.bincount(src, flow, n)[src]
+    Q, Qh, Qh2 = np.zeros((n, n)), np.zeros((n, n)), np.zeros((n, n))
+    np.add.at(Q, (src, dst), split)
+    np.add.at(Qh, (src, dst), split * hrt)
+    np.add.at(Qh2, (src, dst), split * hrt**2)
+    R = np.zeros((n, k))
+    R[outfall_pos, np.arange(k)] = 1
+    A = np.eye(n) - Q
+    P = np.linalg.solve(A, R)
+    M1 = np.linalg.solve(A, Qh @ P)
+    M2 = np.linalg.solve(A, Qh2 @ P + 2 * Qh @ M1)
+    return nodes, P, M1, M2
+
+def random_network(rng):
+    # Mostly downstream conduits, some back and parallel ones forming loops that all drain
+    n, k = int(rng.integers(5, 60)), int(rng.integers(1, 4))
+    names, outfalls = [f'n{i}' for i in range(n)], [f'o{j}' for j in range(k)]
+    rows = []
+    for i in range(n):
+        target = outfalls[rng.integers(k)] if i >= n - 3 or rng.random() < 0.1 else names[rng.integers(i + 1, n)]
+        rows.append((names[i], target, True))
+        if rng.random() < 0.3:
+            rows.append((names[i], names[rng.integers(0, n)], False))
+        if rng.random() < 0.1:
+            rows.append((names[i], target, False))
+    frame = pd.DataFrame(rows, columns=['Inlet_Node', 'Outlet_Node', 'downstream'])
+    frame['mean_flow'] = rng.uniform(0.1, 5, len(frame))
+    # Only extra conduits stand still, so every loop keeps a way out
+    frame.loc[~frame.pop('downstream') & (rng.random(len(frame)) < 0.1), 'mean_flow'] = 0
+    frame['Conduit HRT (HRS)'] = rng.uniform(0.01, 2, len(frame))
+    return frame, outfalls
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_dense_absorbing_chain(seed):
+    frame, outfalls = random_network(np.random.default_rng(seed))
+    result = flow_split_HRT(frame, outfalls)
+    nodes, P, M1, M2 = absorbing_chain(frame, outfalls)
+
+    i = nodes.get_indexer(result['Start_Node'])
+    j = pd.Index(outfalls).get_indexer(result['End_Node'])
+    mean = M1[i, j] / P[i, j]
+    np.testing.assert_allclose(result['Flow_Fraction'], P[i, j], rtol=1e-9)
+    np.testing.assert_allclose(result['Expected_HRT'], mean, rtol=1e-9)
+    np.testing.assert_allclose(result['HRT_Variance'], np.clip(M2[i, j] / P[i, j] - mean**2, 0, None), rtol=1e-7, atol=1e-9)
+    # One row per node and outfall it can reach, outfalls themselves excluded
+    assert len(result) == (P > 1e-12).sum() - len(outfalls)
+
+def test_split_and_loop():
+    # a splits 3:1 to o1 (1 h) and b (2 h); b returns half its flow to a (1 h), half to o2 (4 h)
+    frame = pd.DataFrame({'Inlet_Node': ['a', 'a', 'b', 'b'], 'Outlet_Node': ['o1', 'b', 'a', 'o2'],
+                          'mean_flow': [3.0, 1.0, 0.5, 0.5], 'Conduit HRT (HRS)': [1.0, 2.0, 1.0, 4.0]})
+    result = flow_split_HRT(frame, ['o1', 'o2']).set_index(['Start_Node', 'End_Node'])
+    # P(a -> o2) = 1/4 * 1/2 / (1 - 1/8)
+    assert result.loc[('a', 'o2'), 'Flow_Fraction'] == pytest.approx(1 / 7)
+    assert result.loc[('a', 'o1'), 'Flow_Fraction'] == pytest.approx(6 / 7)
+    assert result.loc[('b', 'o2'), 'Flow_Fraction'] + result.loc[('b', 'o1'), 'Flow_Fraction'] == pytest.approx(1)
+
+def test_loop_without_exit():
+    # a and b only feed each other, so nothing they hold reaches the outfall
+    frame = pd.DataFrame({'Inlet_Node': ['a', 'b', 'c'], 'Outlet_Node': ['b', 'a', 'o'],
+                          'mean_flow': [1.0, 1.0, 1.0], 'Conduit HRT (HRS)': [1.0, 1.0, 2.0]})
+    result = flow_split_HRT(frame, ['o'])
+    assert result[['Start_Node', 'End_Node', 'Flow_Fraction', 'Expected_HRT']].values.tolist() == [['c', 'o', 1.0, 2.0]]
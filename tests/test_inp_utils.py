@@ -0,0 +1,71 @@
+import pytest
+from inp_utils import patch_inp, patch_line, SECTION_FIELDS
+
+# Mixed line endings, tabs, comments and a name shared across sections, ending without a newline
+SOURCE = (
+    b"[TITLE]\r\n"
+    b";;Project Title/Notes\r\n"
+    b"\r\n"
+    b"[JUNCTIONS]\r\n"
+    b";;Name           Elevation  MaxDepth\r\n"
+    b"C1               100        5\r\n"
+    b"\r\n"
+    b"[CONDUITS]\r\n"
+    b";;Name           From Node        To Node          Length     Roughness  InOffset   OutOffset  InitFlow   MaxFlow\r\n"
+    b";;-------------- ---------------- ---------------- ---------- ---------- ---------- ---------- ---------- ----------\r\n"
+    b"C1               J1               J2               100        0.013      0          0          0          0          ;main line\r\n"
+    b"C2\tJ2\tJ3\t250.5\t0.0130\t0\t0\t0\t0   \n"
+    b"C3               J3               O1               75         0.013      0          0          0          0\r\n"
+    b"\r\n"
+    b"[XSECTIONS]\r\n"
+    b";;Link           Shape        Geom1            Geom2      Geom3      Geom4      Barrels    Culvert\r\n"
+    b"C1               CIRCULAR     1                0          0          0          1\r\n"
+    b"C2               CIRCULAR     1.2              0          0          0          1\r\n"
+    b"C3               CIRCULAR     0.9              0          0          0          1"
+)
+
+def lines(data):
+    return data.splitlines(keepends=True)
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'model.inp'
+    path.write_bytes(SOURCE)
+    return path
+
+def test_unpatched_copy_is_identical(source, tmp_path):
+    copy = tmp_path / 'copy.inp'
+    assert patch_inp(str(source), {str(copy): {}}) == len(SOURCE)
+    assert copy.read_bytes() == SOURCE
+
+def test_only_targeted_fields_change(source, tmp_path):
+    first, second = tmp_path / 'first.inp', tmp_path / 'second.inp'
+    patch_inp(str(source), {
+        # C2's roughness is the same number written differently, so its line stays as it was
+        str(first): {'CONDUITS': {'C1': {'Length': 123.5}, 'C2': {'Roughness': 0.013}},
+                     'XSECTIONS': {'C3': {'Geom1': 1.05}}},
+        str(second): {'conduits': {'C3': {'Length': 80, 'MaxFlow': 2.5}}},
+    })
+    original = lines(SOURCE)
+
+    patched = lines(first.read_bytes())
+    changed = [i for i, (a, b) in enumerate(zip(original, patched)) if a != b]
+    assert len(patched) == len(original)
+    assert changed == [10, 18]
+    assert patched[10] == (b"C1               J1               J2               123.5      0.013      0          0          0"
+                           b"          0          ;main line\r\n")
+    # The last line has no newline and keeps the column of the fields after Geom1
+    assert patched[18] == b"C3               CIRCULAR     1.05             0          0          0          1"
+
+    patched = lines(second.read_bytes())
+    assert [i for i, (a, b) in enumerate(zip(original, patched)) if a != b] == [12]
+    assert patched[12] == b"C3               J3               O1               80         0.013      0          0          0          2.5\r\n"
+
+def test_patch_line_keeps_separators():
+    fields = SECTION_FIELDS['CONDUITS']
+    line = "C2\tJ2\tJ3\t250.5\t0.0130\t0\t0\t0\t0   \n"
+    # A token longer than its column still leaves one space before the next field
+    assert patch_line(line, {'Length': 1234.5678}, fields) == "C2\tJ2\tJ3\t1234.5678 0.0130\t0\t0\t0\t0   \n"
+    # Fields the line does not have are left alone
+    assert patch_line("C9  J1  J2  10\n", {'MaxFlow': 3.0}, fields) == "C9  J1  J2  10\n"
+    assert patch_line(line, {'Length': 250.5}, fields) is line
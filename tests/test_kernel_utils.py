@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+import kernel_utils
+
+# Every kernel is compared between the NumPy reference and the numba backend, the latter
+# skipped when numba is not installed
+SHAPES = ['CIRCULAR', 'FORCE_MAIN', 'RECT_CLOSED', 'RECT_OPEN', 'TRAPEZOIDAL', 'TRIANGULAR']
+
+@pytest.fixture
+def numba_backend():
+    pytest.importorskip('numba')
+    return 'numba'
+
+def random_conduits(n, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = rng.choice(SHAPES, n)
+    geom1 = rng.uniform(0.2, 3.0, n)
+    geom2 = rng.uniform(0.2, 4.0, n)
+    geom3 = rng.uniform(0.0, 2.0, n)
+    geom4 = rng.uniform(0.0, 2.0, n)
+    barrels = rng.integers(1, 4, n)
+    return shape, geom1, geom2, geom3, geom4, barrels
+
+def assert_same_geometry(depth, *geometry, numba_backend):
+    expected = kernel_utils.section_geometry(depth, *geometry, backend_name='numpy')
+    actual = kernel_utils.section_geometry(depth, *geometry, backend_name=numba_backend)
+    for e, a in zip(expected, actual):
+        assert a.shape == e.shape
+        np.testing.assert_allclose(a, e, rtol=1e-12, atol=1e-12, equal_nan=True)
+    return expected
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_section_geometry_parity_per_shape(shape, numba_backend):
+    _, geom1, geom2, geom3, geom4, barrels = random_conduits(200, seed=1)
+    depth = np.random.default_rng(2).uniform(0, 1, (5, 200)) * geom1
+    assert_same_geometry(depth, shape, geom1, geom2, geom3, geom4, barrels, numba_backend=numba_backend)
+
+@pytest.mark.parametrize('rows', [(), (7,), (3, 4)])
+def test_section_geometry_parity_keeps_leading_shape(rows, numba_backend):
+    shape, geom1, geom2, geom3, geom4, barrels = random_conduits(50)
+    depth = np.random.default_rng(3).uniform(0, 1, rows + (50,)) * geom1
+    theta, area, valid = assert_same_geometry(depth, shape, geom1, geom2, geom3, geom4, barrels, numba_backend=numba_backend)
+    assert area.shape == rows + (50,)
+    assert valid.all()
+
+def test_section_geometry_parity_edge_cases(numba_backend):
+    # Zero depth, full and just-over-full pipes, depths out of range, and invalid geometry
+    depth = np.array([0.0, 1.0, 1.0 + 1e-9, 1.5, -0.1, np.nan, np.inf, 0.5, 0.5, 0.5, 0.5, 0.5])
+    shape = ['CIRCULAR'] * 7 + ['CIRCULAR', 'RECT_CLOSED', 'EGG', 'TRIANGULAR', 'CIRCULAR']
+    geom1 = np.array([1.0] * 7 + [0.0, 1.0, 1.0, -1.0, 1.0])
+    geom2 = np.array([0.0] * 8 + [0.0, 1.0, 1.0, 0.0])
+    barrels = np.array([1.0] * 11 + [np.nan])
+    theta, area, valid = assert_same_geometry(depth, shape, geom1, geom2, 0.0, 0.0, barrels, numba_backend=numba_backend)
+    np.testing.assert_array_equal(valid, [True, True, True, False, False, False, False, False, False, False, False, True])
+
+def test_section_geometry_reference_values():
+    # Closed forms: empty, half and full circle, rectangle, trapezoid and triangle
+    depth = np.array([0.0, 1.0, 2.0, 0.5, 0.5, 0.5])
+    shape = ['CIRCULAR', 'CIRCULAR', 'CIRCULAR', 'RECT_OPEN', 'TRAPEZOIDAL', 'TRIANGULAR']
+    geom1 = np.array([2.0, 2.0, 2.0, 1.0, 1.0, 1.0])
+    geom2 = np.array([0.0, 0.0, 0.0, 3.0, 2.0, 2.0])
+    theta, area, valid = kernel_utils.section_geometry(depth, shape, geom1, geom2, 1.0, 1.0, barrels=[1, 1, 2, 1, 1, 1],
+                                                       backend_name='numpy')
+    np.testing.assert_allclose(area, [0.0, np.pi / 2, 2 * np.pi, 1.5, 0.5 * (2 + 0.5), 0.25 * 2 / 2])
+    np.testing.assert_allclose(theta[:3], [0.0, np.pi, 2 * np.pi])
+    assert np.isnan(theta[3:]).all()
+    assert valid.all()
+
+def test_path_sums_parity(numba_backend):
+    rng = np.random.default_rng(4)
+    lengths = rng.integers(0, 6, 300)
+    path_ptr = np.concatenate([[0], np.cumsum(lengths)])
+    path_edges = rng.integers(0, 80, path_ptr[-1])
+    path_edges[::17] = -1
+    values = rng.uniform(0, 10, (6, 80))
+    values[2, 5] = np.nan
+    for v in (values[0], values):
+        expected = kernel_utils.path_sums(path_ptr, path_edges, v, backend_name='numpy')
+        actual = kernel_utils.path_sums(path_ptr, path_edges, v, backend_name=numba_backend)
+        assert actual.shape == expected.shape
+        np.testing.assert_allclose(actual, expected, rtol=1e-12, equal_nan=True)
+
+@pytest.mark.parametrize('rows', [(), (7,), (3, 4)])
+def test_section_depth_parity(rows, numba_backend):
+    shape, geom1, geom2, geom3, geom4, barrels = random_conduits(300, seed=5)
+    full = kernel_utils.section_geometry(geom1, shape, geom1, geom2, geom3, geom4, barrels, backend_name='numpy')[1]
+    area = np.random.default_rng(6).uniform(-0.05, 1.1, rows + (300,)) * full
+    if rows:
+        area[..., ::23] = np.nan
+    expected = kernel_utils.section_depth(area, shape, geom1, geom2, geom3, geom4, barrels, backend_name='numpy')
+    actual = kernel_utils.section_depth(area, shape, geom1, geom2, geom3, geom4, barrels, backend_name=numba_backend)
+    assert actual.shape == expected.shape == rows + (300,)
+    np.testing.assert_allclose(actual, expected, rtol=1e-12, atol=1e-12, equal_nan=True)
+
+@pytest.mark.parametrize('backend_name', ['numpy', 'numba'])
+def test_section_depth_inverts_geometry(backend_name):
+    if backend_name == 'numba':
+        pytest.importorskip('numba')
+    shape, geom1, geom2, geom3, geom4, barrels = random_conduits(400, seed=7)
+    depth = np.random.default_rng(8).uniform(0, 1, (3, 400)) * geom1
+    area = kernel_utils.section_geometry(depth, shape, geom1, geom2, geom3, geom4, barrels, backend_name='numpy')[1]
+    recovered = kernel_utils.section_depth(area, shape, geom1, geom2, geom3, geom4, barrels, backend_name=backend_name)
+    np.testing.assert_allclose(recovered, depth, rtol=1e-9, atol=1e-9)
+    # Negative areas, areas beyond the full section and shapes without a closed form have no depth
+    beyond = kernel_utils.section_depth([-1.0, 10.0, 0.1], ['CIRCULAR', 'CIRCULAR', 'EGG'], 1.0, backend_name=backend_name)
+    assert np.isnan(beyond).all()
+
+def test_length_for_HRT_parity(numba_backend):
+    rng = np.random.default_rng(9)
+    target_hrt = rng.uniform(0, 5, (4, 100))
+    mean_flow = rng.uniform(-0.1, 2, 100)
+    flow_area = rng.uniform(0, 3, 100)
+    flow_area[::11] = 0.0
+    mean_flow[::13] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = kernel_utils.length_for_HRT(target_hrt, mean_flow, flow_area, backend_name='numpy')
+        actual = kernel_utils.length_for_HRT(target_hrt, mean_flow, flow_area, backend_name=numba_backend)
+        scalar = kernel_utils.length_for_HRT(2.0, 0.5, 1.8, backend_name=numba_backend)
+    assert actual.shape == expected.shape == (4, 100)
+    np.testing.assert_allclose(actual, expected, rtol=1e-12, equal_nan=True)
+    assert float(scalar) == pytest.approx(2000.0)
+
+@pytest.mark.parametrize('backend_name', ['numpy', 'numba'])
+def test_path_sums_missing_edges_and_nan(backend_name):
+    if backend_name == 'numba':
+        pytest.importorskip('numba')
+    # Paths [0, 1], [], [2, -1] and [3]
+    path_ptr = np.array([0, 2, 2, 4, 5])
+    path_edges = np.array([0, 1, 2, -1, 3])
+    values = np.array([[1.0, 2.0, 3.0, 4.0], [1.0, 2.0, 3.0, np.nan]])
+    np.testing.assert_array_equal(kernel_utils.path_sums(path_ptr, path_edges, values[0], backend_name=backend_name),
+                                  [3.0, 0.0, np.nan, 4.0])
+    np.testing.assert_array_equal(kernel_utils.path_sums(path_ptr, path_edges, values, backend_name=backend_name),
+                                  [[3.0, 0.0, np.nan, 4.0], [3.0, 0.0, np.nan, np.nan]])
+
+def test_length_for_HRT():
+    # 2 h of 0.5 m3/s in 1.8 m2 of flow area takes 2000 m; a zero area gives an infinite length
+    with np.errstate(divide='ignore'):
+        lengths = kernel_utils.length_for_HRT([2.0, 1.0], [0.5, 1.0], [1.8, 0.0])
+    np.testing.assert_allclose(lengths, [2000.0, np.inf])
+
+def test_set_backend(monkeypatch):
+    monkeypatch.setitem(kernel_utils._STATE, 'backend', None)
+    monkeypatch.setenv('HRT_KERNELS', 'numpy')
+    assert kernel_utils.backend() == 'numpy'
+    assert kernel_utils.set_backend('auto') == ('numba' if kernel_utils.numba_available() else 'numpy')
+    with pytest.raises(ValueError):
+        kernel_utils.set_backend('fortran')
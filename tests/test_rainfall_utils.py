@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+import pytest
+from rainfall_utils import event_windows, merge_event_stats
+
+def test_windows_do_not_overlap():
+    # The second event starts 6 h after the first ends, inside its 12 h tail
+    events = pd.DataFrame({'event': ['event_0', 'event_1', 'event_2'],
+                           'start': pd.to_datetime(['2020-01-01 00:00', '2020-01-01 08:00', '2020-01-05 00:00']),
+                           'end': pd.to_datetime(['2020-01-01 02:00', '2020-01-01 10:00', '2020-01-05 03:00'])})
+    windows = event_windows(events, spin_up_hours=24, tail_hours=12)
+
+    assert list(windows['sim_end']) == list(pd.to_datetime(['2020-01-01 08:00', '2020-01-01 22:00', '2020-01-05 15:00']))
+    np.testing.assert_allclose(windows['report_hours'], [8.0, 14.0, 15.0])
+    assert (windows['sim_start'] == events['start'] - pd.Timedelta(hours=24)).all()
+    # Reported periods [start, sim_end) are disjoint
+    assert (windows['start'].iloc[1:].to_numpy() >= windows['sim_end'].iloc[:-1].to_numpy()).all()
+
+    # Each event weighs in with its own reported hours only
+    links = pd.DataFrame({'scenario': ['event_0', 'event_1', 'event_2'], 'cond_name': 'c1',
+                          'mean_flow': [1.0, 2.0, 4.0], 'min_flow': 0.0, 'max_flow': [1.0, 2.0, 4.0], 'var_flow': 0.0})
+    merged = merge_event_stats(links, windows)
+    assert merged['mean_flow'].iloc[0] == pytest.approx((8.0 * 1.0 + 14.0 * 2.0 + 15.0 * 4.0) / 37.0)
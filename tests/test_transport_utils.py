@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+from calibration_HRT_utils import DrainageIndex
+from transport_utils import decay_scenarios, wwtp_concentrations
+
+# S1 drains to J1, which reaches both outfalls (a loop) and is nearest to O2; S2 drains to J2,
+# which reaches O1 only
+SUBCATCHMENTS = """[SUBCATCHMENTS]
+;;Name  Rain Gage  Outlet  Area  %Imperv  Width  %Slope  CurbLen
+S1      RG1        J1      1     50       100    0.5     0
+S2      RG1        J2      1     50       100    0.5     0
+"""
+
+@pytest.fixture
+def routed(tmp_path):
+    inp_file_path = tmp_path / 'looped.inp'
+    inp_file_path.write_text(SUBCATCHMENTS)
+    distance = pd.DataFrame({'O1': {'J1': 30.0, 'J2': 5.0}, 'O2': {'J1': 10.0, 'J2': np.nan}})
+    drainage_index = DrainageIndex(str(inp_file_path), distance, {'O1': 'North', 'O2': 'South'})
+    # The far outfall of J1 comes first, as in PathHRTIndex.to_frame's outfall order
+    paths = pd.DataFrame({'Start_Node': ['J1', 'J1', 'J2'], 'End_Node': ['O1', 'O2', 'O1'],
+                          'Total_HRT': [3.0, 1.0, 2.0]})
+    return drainage_index.join(paths), drainage_index
+
+def test_sources_follow_their_nearest_outfall(routed):
+    path_hrt_df, drainage_index = routed
+    index = pd.date_range('2020-01-01', periods=12, freq='h')
+    loads = pd.DataFrame({'S1': 1.0, 'S2': 2.0}, index=index)
+    flows = pd.DataFrame({'S1': 1.0, 'S2': 1.0}, index=index)
+    scenarios = decay_scenarios([0.0, 0.1])
+
+    concentration, diluting = wwtp_concentrations(path_hrt_df, drainage_index, loads, flows, scenarios)
+
+    assert list(diluting.columns) == ['North', 'South']
+    np.testing.assert_allclose(diluting.iloc[3:], 1.0)
+    # North receives S2 only after 2 h, South S1 only after 1 h
+    north, south = concentration[:, 0], concentration[:, 1]
+    assert np.isnan(north[:, :2]).all() and np.isnan(south[:, :1]).all()
+    decay_rate = scenarios['decay_rate'].to_numpy()[:, None]
+    np.testing.assert_allclose(north[:, 2:], np.broadcast_to(2.0 * np.exp(-decay_rate * 2.0), (2, 10)))
+    np.testing.assert_allclose(south[:, 1:], np.broadcast_to(np.exp(-decay_rate * 1.0), (2, 11)))
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+from calibration_HRT_utils import build_edge_index, path_edge_arrays, batch_path_HRT
+from profiling_utils import get_logger, phase, count
+
+logger = get_logger('transport')
+
+SCENARIO_COLUMNS = ['decay_rate', 'settling_velocity', 'particle_fraction']
+
+def decay_scenarios(decay_rate, settling_velocity=0.0, particle_fraction=0.0):
+    # Full factorial grid of first-order decay rates (1/h), settling velocities (m/h) and the
+    # share of the load bound to particles that can settle, one row per scenario
+    grid = pd.MultiIndex.from_product([np.atleast_1d(decay_rate), np.atleast_1d(settling_velocity),
+                                       np.atleast_1d(particle_fraction)], names=SCENARIO_COLUMNS)
+    return grid.to_frame(index=False)
+
+def path_settling_exposure(conduit_summary, paths):
+    # Sum of conduit HRT / mean depth (h/m) along each path: particles settling at v m/h through a
+    # conduit of depth d for t hours are removed as exp(-v t / d), so exp(-v x exposure) over the path
+    frame = conduit_summary.reset_index() if 'cond_name' not in conduit_summary.columns else conduit_summary
+    depth = frame['mean_depth'].to_numpy(dtype=float)
+    hrt = frame['Conduit HRT (HRS)'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        per_conduit = np.where(depth > 0, hrt / depth, np.nan)
+    path_ptr, path_edges = path_edge_arrays(paths, build_edge_index(frame))
+    return batch_path_HRT(path_ptr, path_edges, per_conduit)
+
+def survival_fractions(total_hrt, exposure, scenarios):
+    # (scenarios x sources) share of the shed load that reaches the WWTP
+    decay_rate, settling_velocity, particle_fraction = (
+        scenarios[col].to_numpy(dtype=float)[:, None] for col in SCENARIO_COLUMNS)
+    with np.errstate(invalid='ignore'):
+        settled = np.exp(-settling_velocity * exposure[None, :])
+    settled[np.broadcast_to(settling_velocity == 0, settled.shape)] = 1.0
+    return np.exp(-decay_rate * total_hrt[None, :]) * ((1 - particle_fraction) + particle_fraction * settled)
+
+def lag_series(values, lag_steps):
+    # Delay each row of a (sources x times) array by a fractional number of steps, interpolating
+    # linearly between the two neighbouring whole steps; steps before the record start count as 0
+    n_times = values.shape[1]
+    base = np.floor(lag_steps).astype(np.int64)
+    frac = (lag_steps - base)[:, None]
+    src = np.arange(n_times)[None, :] - base[:, None]
+
+    def shifted(idx):
+        out = np.take_along_axis(values, np.clip(idx, 0, n_times - 1), axis=1)
+        out[idx < 0] = 0.0
+        return out
+
+    return (1 - frac) * shifted(src) + frac * shifted(src - 1)
+
+def time_step_hours(index):
+    # Regular reporting step of a DatetimeIndex in hours
+    steps = np.diff(index.values).astype('timedelta64[s]').astype(float)
+    if len(steps) == 0 or not np.allclose(steps, steps[0]):
+        raise ValueError("Load and flow series need a regular time step")
+    return steps[0] / 3600
+
+def wwtp_concentrations(path_hrt_df, drainage_index, loads, flows, scenarios, conduit_summary=None,
+                        wwtp_flow=None, step_hours=None):
+    # Flow-weighted concentrations arriving at every WWTP under every scenario.
+    # path_hrt_df: paths labelled by drainage_index.join (Subcatchments, WWTP, Total_HRT and, for
+    # settling, Path); each subcatchment is routed along the path to the outfall its outlet node
+    # drains to (DrainageIndex.nearest_paths), not any other outfall it can reach; loads and flows: (times x subcatchments) frames of shed load and wastewater
+    # flow on a regular time index, in the same time unit (e.g. copies/s and CMS give copies/m3).
+    # The load leaving a subcatchment arrives Total_HRT later, reduced by first-order decay over the
+    # path and by settling of its particle-bound share in each conduit (needs conduit_summary with
+    # mean_depth and Conduit HRT (HRS)). It is diluted in the sum of the subcatchment flows routed
+    # the same way, or in wwtp_flow (times x WWTPs, e.g. simulated plant inflow) when given.
+    # Returns the (scenarios x WWTPs x times) concentrations and the (times x WWTPs) diluting flow;
+    # steps before the slowest source of a WWTP can have arrived are NaN.
+    labelled = drainage_index.nearest_paths(path_hrt_df.dropna(subset=['Subcatchments', 'WWTP', 'Total_HRT']))
+    labelled = labelled.drop_duplicates('Subcatchments')
+    sources = labelled[labelled['Subcatchments'].isin(loads.columns)]
+    unrouted = sorted(set(loads.columns) - set(sources['Subcatchments']))
+    if unrouted:
+        logger.warning("Subcatchments with loads but no path to a WWTP", extra={'fields': {'subcatchments': unrouted}})
+
+    if step_hours is None:
+        step_hours = time_step_hours(loads.index)
+    total_hrt = sources['Total_HRT'].to_numpy(dtype=float)
+    lag_steps = total_hrt / step_hours
+
+    if (scenarios['settling_velocity'] > 0).any():
+        if conduit_summary is None:
+            raise ValueError("Settling scenarios need the conduit summary for the conduit depths")
+        exposure = path_settling_exposure(conduit_summary, sources['Path'])
+    else:
+        exposure = np.zeros(len(sources))
+
+    wwtps = sorted(sources['WWTP'].unique())
+    members = [np.flatnonzero(sources['WWTP'].to_numpy() == wwtp) for wwtp in wwtps]
+    n_times = len(loads)
+    names = sources['Subcatchments'].to_numpy()
+
+    with phase('transport', scenarios=len(scenarios), sources=len(sources), times=n_times):
+        survival = survival_fractions(total_hrt, exposure, scenarios)
+        arriving_load = lag_series(loads[names].to_numpy(dtype=float).T, lag_steps)
+
+        # One matrix product per WWTP over just its sources: (scenarios x sources) @ (sources x times)
+        concentration = np.empty((len(scenarios), len(wwtps), n_times))
+        for w, idx in enumerate(members):
+            concentration[:, w] = survival[:, idx] @ arriving_load[idx]
+
+        if wwtp_flow is None:
+            arriving_flow = lag_series(flows[names].to_numpy(dtype=float).T, lag_steps)
+            diluting = np.stack([arriving_flow[idx].sum(axis=0) for idx in members])
+        else:
+            diluting = wwtp_flow[wwtps].to_numpy(dtype=float).T
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            concentration /= np.where(diluting > 0, diluting, np.nan)[None]
+        # Spin-up: the slowest source of each WWTP has not arrived yet
+        for w, idx in enumerate(members):
+            concentration[:, w, :min(int(np.ceil(lag_steps[idx].max())), n_times)] = np.nan
+    count('transport_scenarios', len(scenarios))
+
+    return concentration, pd.DataFrame(diluting.T, index=loads.index, columns=wwtps)
+
+def concentration_frame(concentration, diluting_flow, scenario):
+    # (times x WWTPs) concentrations of one scenario row position
+    return pd.DataFrame(concentration[scenario].T, index=diluting_flow.index, columns=diluting_flow.columns)
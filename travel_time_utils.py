@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+from calibration_HRT_utils import conduit_geometry, align_xsections, tree_path
+from profiling_utils import get_logger, phase, count
+
+logger = get_logger('travel_time')
+
+def conduit_velocity(flow, depth, geometry):
+    # Mean velocity Q / A for (periods x conduits) flow and depth arrays. Zero, reverse or
+    # dry flow gives 0 (a parcel waits in the conduit), unusable geometry or depth NaN.
+    theta, flow_area, valid = conduit_geometry(depth, **geometry)
+    flow = np.asarray(flow, dtype=float)
+    velocity = np.zeros(flow_area.shape)
+    moving = valid & (flow_area > 0) & (flow > 0)
+    velocity[moving] = flow[moving] / flow_area[moving]
+    velocity[~valid] = np.nan
+    return velocity
+
+def conduit_transit_times(flow, depth, geometry, cond_length):
+    # Time in hours to cross each conduit at each period's velocity (inf while the flow stands
+    # still, NaN for unusable geometry or depth); ParcelTracker moves parcels on these
+    velocity = conduit_velocity(flow, depth, geometry)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.asarray(cond_length, dtype=float) / velocity / 3600
+
+class ParcelTracker:
+    # Moves every parcel (one per source and release time) along its path with time-varying
+    # conduit transit times, one block of reporting periods at a time. Transit times are constant
+    # within a period, so the share of a conduit a parcel crosses is the cumulative sum of step /
+    # transit time; its exit time is where that sum has grown by one whole conduit, found for all
+    # parcels at once by bisection. Parcels still in a conduit at the end of a block carry the
+    # share they have left into the next block, so only one block of the record is ever in memory.
+
+    def __init__(self, path_ptr, path_cols, release_source, release_time):
+        # path_cols[path_ptr[s]:path_ptr[s + 1]] are the transit time columns source s passes
+        # through; release_time is in seconds from the first period
+        self.path_ptr = np.asarray(path_ptr, dtype=np.int64)
+        self.path_cols = np.asarray(path_cols, dtype=np.int64)
+        self.source = np.asarray(release_source, dtype=np.int64)
+        self.release_time = np.asarray(release_time, dtype=float)
+
+        n = len(self.source)
+        self.hop = np.zeros(n, dtype=np.int64)
+        self.entry_time = self.release_time.copy()
+        self.remaining = np.full(n, np.nan)
+        self.arrival_time = np.full(n, np.nan)
+        self.n_hops = np.diff(self.path_ptr)[self.source]
+        self.started = np.zeros(n, dtype=bool)
+        self.done = np.zeros(n, dtype=bool)
+        self.clock = 0.0
+
+        # Parcels released at an outfall have nothing to cross
+        at_outfall = self.n_hops == 0
+        self.done[at_outfall] = True
+        self.arrival_time[at_outfall] = self.release_time[at_outfall]
+
+    def advance(self, transit_hours, step_seconds):
+        # transit_hours is (periods x columns) for the block starting at self.clock. Conduits
+        # are crossed at 1 / transit time per second; standing flow (inf) and unusable geometry
+        # (NaN) hold the parcel where it is.
+        transit = np.asarray(transit_hours, dtype=float) * 3600
+        with np.errstate(divide='ignore'):
+            velocity = np.where(np.isfinite(transit) & (transit > 0), 1 / transit, 0.0)
+        n_periods = velocity.shape[0]
+        start, end = self.clock, self.clock + n_periods * step_seconds
+        # Conduits crossed since the block start, per column
+        distance = np.zeros((n_periods + 1, velocity.shape[1]))
+        np.cumsum(velocity * step_seconds, axis=0, out=distance[1:])
+
+        new = ~self.started & ~self.done & (self.release_time < end)
+        self.remaining[new] = 1.0
+        self.started |= new
+
+        while True:
+            active = np.flatnonzero(self.started & ~self.done & (self.entry_time < end))
+            if len(active) == 0:
+                break
+            col = self.path_cols[self.path_ptr[self.source[active]] + self.hop[active]]
+
+            # Position on the block's cumulative curve where the parcel entered, and where it exits
+            offset = self.entry_time[active] - start
+            k = np.minimum((offset // step_seconds).astype(np.int64), n_periods - 1)
+            entry_distance = distance[k, col] + velocity[k, col] * (offset - k * step_seconds)
+            target = entry_distance + self.remaining[active]
+
+            # Not out of this conduit by the end of the block: carry the share left over
+            stays = distance[n_periods, col] < target
+            carried = active[stays]
+            self.remaining[carried] = target[stays] - distance[n_periods, col[stays]]
+            self.entry_time[carried] = end
+
+            exits = ~stays
+            moving, col, k, target = active[exits], col[exits], k[exits], target[exits]
+            # First period boundary at or past the target distance
+            lo, hi = k, np.full(len(moving), n_periods)
+            while np.any(hi - lo > 1):
+                mid = (lo + hi) // 2
+                reached = distance[mid, col] >= target
+                hi = np.where(reached, mid, hi)
+                lo = np.where(reached, lo, mid)
+            before = hi - 1
+            with np.errstate(divide='ignore', invalid='ignore'):
+                within = np.where(velocity[before, col] > 0, (target - distance[before, col]) / velocity[before, col], 0.0)
+            exit_time = np.maximum(start + before * step_seconds + within, self.entry_time[moving])
+
+            self.hop[moving] += 1
+            count('conduit_crossings', len(moving))
+            arrived = self.hop[moving] >= self.n_hops[moving]
+            self.done[moving[arrived]] = True
+            self.arrival_time[moving[arrived]] = exit_time[arrived]
+
+            onward = moving[~arrived]
+            self.entry_time[onward] = exit_time[~arrived]
+            self.remaining[onward] = 1.0
+
+        self.clock = end
+
+    def travel_time_hours(self):
+        # NaN for parcels that had not reached the outfall when the record ended
+        return (self.arrival_time - self.release_time) / 3600
+
+def source_paths(path_index, drainage_index, sources=None):
+    # Conduit names along each subcatchment's path to its nearest outfall, in flow order
+    paths = {}
+    for sc_name in sources or list(drainage_index.outlet_of):
+        node = drainage_index.outlet_of[sc_name]
+        outfall = drainage_index.nearest_outfall.get(node)
+        if outfall is None:
+            continue
+        nodes = tree_path(path_index.next_hop[outfall], node, outfall)
+        paths[sc_name] = [path_index.cond_names[path_index.edge_index[edge]] for edge in zip(nodes[:-1], nodes[1:])]
+    return paths
+
+def parcel_travel_times(output, paths, link_table, release_every=1, chunk_periods=500):
+    # Travel time of a parcel released at every release_every-th reporting period from every
+    # source, against the flow and depth series of a SwmmOutput. paths maps a source name to
+    # its conduit names in flow order; link_table is the swmmio link table (Length and the
+    # cross-section columns, indexed by name), so calibrated lengths can be passed in.
+    # Returns one row per source and release time.
+    conduits = pd.unique(np.concatenate([np.asarray(path, dtype=object) for path in paths.values()] or [[]]))
+    link_pos = {name: pos for pos, name in enumerate(output.links)}
+    out_cols = np.array([link_pos[name] for name in conduits], dtype=np.int64)
+    col_of = {name: col for col, name in enumerate(conduits)}
+
+    sources = list(paths)
+    path_ptr = np.zeros(len(sources) + 1, dtype=np.int64)
+    np.cumsum([len(paths[s]) for s in sources], out=path_ptr[1:])
+    path_cols = np.array([col_of[name] for s in sources for name in paths[s]], dtype=np.int64)
+
+    geometry = align_xsections(pd.DataFrame({'cond_name': conduits}), link_table)
+    cond_length = pd.to_numeric(link_table['Length'].reindex(conduits), errors='coerce').to_numpy(dtype=float)
+
+    step_seconds = float(output.report_step)
+    releases = np.arange(0, output.n_periods, release_every)
+    release_source = np.repeat(np.arange(len(sources)), len(releases))
+    release_period = np.tile(releases, len(sources))
+    tracker = ParcelTracker(path_ptr, path_cols, release_source, release_period * step_seconds)
+
+    with phase('travel_time', sources=len(sources), parcels=len(release_source), conduits=len(conduits)):
+        for start in range(0, output.n_periods, chunk_periods):
+            stop = min(start + chunk_periods, output.n_periods)
+            flow = output.series('links', 'flow', start, stop)[:, out_cols]
+            depth = output.series('links', 'depth', start, stop)[:, out_cols]
+            tracker.advance(conduit_transit_times(flow, depth, geometry, cond_length), step_seconds)
+
+    stranded = int(np.isnan(tracker.arrival_time).sum())
+    if stranded:
+        logger.info("Parcels still in the network when the record ended", extra={'fields': {'parcels': stranded}})
+
+    return pd.DataFrame({
+        'source': np.asarray(sources, dtype=object)[release_source],
+        'release_time': output.times()[release_period],
+        'travel_time_hours': tracker.travel_time_hours(),
+    })
+
+def travel_time_distribution(travel_times, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    # Per-source summary of the travel times of all parcels that arrived
+    arrived = travel_times.dropna(subset=['travel_time_hours'])
+    grouped = arrived.groupby('source')['travel_time_hours']
+    summary = grouped.quantile(list(quantiles)).unstack()
+    summary.columns = [f'q{int(round(q * 100)):02d}' for q in quantiles]
+    summary.insert(0, 'mean', grouped.mean())
+    summary.insert(0, 'parcels', grouped.size())
+    summary['stranded'] = travel_times[travel_times['travel_time_hours'].isna()].groupby('source').size() \
+        .reindex(summary.index, fill_value=0)
+    return summary
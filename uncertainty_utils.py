@@ -0,0 +1,126 @@
+import warnings
+import numpy as np
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from calibration_HRT_utils import (DEFAULT_SHAPE, DEFAULT_DIAMETER, conduit_geometry, conduit_HRT, align_xsections,
+                                   build_edge_index, path_edge_arrays)
+from kernel_utils import backend, set_backend, path_sums
+from profiling_utils import get_logger, phase, count
+
+logger = get_logger('uncertainty')
+
+# Coefficient of variation of each uncertain input. Samples are mean-one lognormal factors
+# on the simulated mean flow and depth, the conduit length and the cross-section size.
+DEFAULT_UNCERTAINTY = {'mean_flow': 0.15, 'mean_depth': 0.10, 'cond_length': 0.05, 'xsection': 0.02}
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+def lognormal_factors(rng, cv, shape):
+    # Mean-one multiplicative noise with the given coefficient of variation
+    if not cv:
+        return np.ones(shape)
+    sigma = np.sqrt(np.log1p(cv**2))
+    return np.exp(sigma * rng.standard_normal(shape) - sigma**2 / 2)
+
+def sample_conduit_HRT(mean_flow, mean_depth, cond_length, geometry, uncertainty, n_samples, rng):
+    # (samples x conduits) HRTs in hours, NaN where a sample leaves the pipe's valid range.
+    # Scaling every cross-section dimension by s scales the area as A(y; s g) = s^2 A(y / s; g)
+    # for all supported shapes, so sampled sizes reuse the per-conduit geometry as is.
+    shape = (n_samples, len(mean_flow))
+    flow = mean_flow * lognormal_factors(rng, uncertainty.get('mean_flow'), shape)
+    depth = mean_depth * lognormal_factors(rng, uncertainty.get('mean_depth'), shape)
+    length = cond_length * lognormal_factors(rng, uncertainty.get('cond_length'), shape)
+    scale = lognormal_factors(rng, uncertainty.get('xsection'), shape)
+
+    theta, flow_area, valid = conduit_geometry(depth / scale, **geometry)
+    flow_volume, HRT, valid = conduit_HRT(flow_area * scale**2, length, flow, valid)
+    return HRT
+
+# Static inputs of a run, set once per worker process instead of being pickled with every chunk
+_MC_STATE = {}
+
+def _init_worker(state):
+    _MC_STATE.clear()
+    _MC_STATE.update(state)
+    # Spawned workers do not inherit a backend chosen with set_backend in the parent
+    set_backend(state['kernel_backend'])
+
+def _run_chunk(chunk_id, n_samples):
+    state = _MC_STATE
+    # Each chunk has its own stream, so results do not depend on how chunks are spread over workers
+    rng = np.random.default_rng([state['seed'], chunk_id])
+    HRT = sample_conduit_HRT(state['mean_flow'], state['mean_depth'], state['cond_length'],
+                             state['geometry'], state['uncertainty'], n_samples, rng)
+    # Path sums for every sample at once
+    totals = path_sums(state['path_ptr'], state['path_edges'], HRT)
+    return chunk_id, totals.astype(np.float32)
+
+def monte_carlo_path_HRT(conduit_summary, path_hrt_df, xsections=None, n_samples=1000, uncertainty=None,
+                         chunk_samples=250, max_workers=None, seed=0):
+    # (samples x paths) total HRTs of the rows of path_hrt_df (Path column as from create_graph or
+    # PathHRTIndex) under sampled inputs. Samples are drawn chunk_samples at a time so the
+    # samples x conduits arrays stay bounded; max_workers > 1 spreads chunks over spawned
+    # processes (see the note at the top of scenario_utils).
+    frame = conduit_summary.reset_index() if 'cond_name' not in conduit_summary.columns else conduit_summary
+    uncertainty = dict(DEFAULT_UNCERTAINTY if uncertainty is None else uncertainty)
+    if xsections is None:
+        geometry = {'shape': DEFAULT_SHAPE, 'geom1': DEFAULT_DIAMETER}
+    else:
+        geometry = align_xsections(frame, xsections)
+
+    # Reuse the shortest-path structure as CSR edge arrays
+    path_ptr, path_edges = path_edge_arrays(path_hrt_df['Path'], build_edge_index(frame))
+
+    state = {
+        'seed': seed,
+        'mean_flow': frame['mean_flow'].to_numpy(dtype=float),
+        'mean_depth': frame['mean_depth'].to_numpy(dtype=float),
+        'cond_length': frame['cond_length'].to_numpy(dtype=float),
+        'geometry': geometry,
+        'uncertainty': uncertainty,
+        'path_ptr': path_ptr,
+        'path_edges': path_edges,
+        'kernel_backend': backend(),
+    }
+    chunks = [(chunk_id, min(chunk_samples, n_samples - start))
+              for chunk_id, start in enumerate(range(0, n_samples, chunk_samples))]
+    samples = np.empty((n_samples, len(path_hrt_df)), dtype=np.float32)
+
+    with phase('monte_carlo', samples=n_samples, conduits=len(frame), paths=len(path_hrt_df)):
+        if max_workers and max_workers > 1:
+            ctx = mp.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(chunks)), mp_context=ctx,
+                                     initializer=_init_worker, initargs=(state,)) as pool:
+                results = pool.map(_run_chunk, *zip(*chunks))
+                for chunk_id, totals in results:
+                    start = chunk_id * chunk_samples
+                    samples[start:start + len(totals)] = totals
+        else:
+            _init_worker(state)
+            for chunk_id, size in chunks:
+                start = chunk_id * chunk_samples
+                samples[start:start + size] = _run_chunk(chunk_id, size)[1]
+    count('monte_carlo_samples', n_samples)
+    return samples
+
+def hrt_percentile_bands(conduit_summary, path_hrt_df, xsections=None, n_samples=1000, uncertainty=None,
+                         percentiles=DEFAULT_PERCENTILES, chunk_samples=250, max_workers=None, seed=0):
+    # Percentile bands of the path HRT of every subcatchment (path rows labelled by
+    # DrainageIndex.join), next to the deterministic Total_HRT; only those paths are sampled
+    labelled = path_hrt_df.dropna(subset=['Subcatchments'])
+    samples = monte_carlo_path_HRT(conduit_summary, labelled, xsections, n_samples, uncertainty,
+                                   chunk_samples, max_workers, seed)
+
+    bands = labelled[[col for col in ('Subcatchments', 'Start_Node', 'End_Node', 'WWTP', 'Total_HRT')
+                      if col in labelled.columns]].reset_index(drop=True)
+    bands['Valid_Fraction'] = (~np.isnan(samples)).mean(axis=0)
+    with warnings.catch_warnings():
+        # Paths with no valid sample get NaN bands
+        warnings.simplefilter('ignore', RuntimeWarning)
+        values = np.nanpercentile(samples, percentiles, axis=0)
+    partial = int((bands['Valid_Fraction'] < 1).sum())
+    if partial:
+        logger.info("Paths with samples outside the conduits' valid range",
+                    extra={'fields': {'paths': partial, 'samples': n_samples}})
+    for p, row in zip(percentiles, values):
+        bands[f'P{p:02d}'] = row
+    return bands